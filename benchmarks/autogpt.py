@@ -0,0 +1,180 @@
+"""
+Measures the wall-clock time AutoGPT (see `experiments/mergedbots_copilot/autogpt.py`) takes per goal with a scripted
+chat model: a goal takes `--commands` independent commands and then `finish`. The LLM, the commands and the embedding
+of memories only sleep, for `--llm-latency-ms`, `--tool-latency-ms` and `--embedding-latency-ms` respectively.
+
+Three setups are compared:
+
+- one command per turn with the memory written before the next turn (the way the agent used to work);
+- one command per turn with the memory written while the next LLM call is made;
+- `--commands-per-turn` commands per turn (run at the same time) with the memory written in the background.
+
+    python -m benchmarks.autogpt [--goals 3] [--commands 8] [--commands-per-turn 4]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import Any, Optional
+
+import numpy as np
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult, Document
+from langchain.tools.base import BaseTool
+
+from experiments.common.vector_indexes import AdaptiveFAISS
+from experiments.mergedbots_copilot.autogpt import AutoGPT, HumanInputRun
+
+EMBEDDING_SIZE = 64
+
+
+class ScriptedChatModel(BaseChatModel):
+    """A chat model that answers with the next reply of a script after `latency_seconds`."""
+
+    replies: list[str]
+    latency_seconds: float
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text) // 4
+
+    def _generate(self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None) -> ChatResult:
+        raise NotImplementedError("the benchmark only runs the agent asynchronously")
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None) -> ChatResult:
+        await asyncio.sleep(self.latency_seconds)
+        reply = self.replies[self.calls]
+        self.calls += 1
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))])
+
+
+class SleepingEmbeddings(Embeddings):
+    """Random embeddings that take `latency_seconds` per call (the calls block, like the real ones do)."""
+
+    def __init__(self, latency_seconds: float) -> None:
+        self.latency_seconds = latency_seconds
+        self.rng = np.random.default_rng(0)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency_seconds)
+        return self.rng.random((len(texts), EMBEDDING_SIZE)).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class SleepingTool(BaseTool):
+    """A command that takes `latency_seconds`."""
+
+    name = "search"
+    description = "Search the web. The input should be a search query."
+    latency_seconds: float
+
+    def _run(self, query: str, run_manager: Any = None) -> str:
+        raise NotImplementedError("the benchmark only runs the agent asynchronously")
+
+    async def _arun(self, query: str, run_manager: Any = None) -> str:
+        await asyncio.sleep(self.latency_seconds)
+        return f"results for {query}"
+
+
+class SilentHuman(HumanInputRun):
+    """A human who is never asked anything and lets the agent go on after every turn."""
+
+    bot: Any = None
+    conv_sequence: Any = None
+    latest_inbound_msg: Any = None
+
+    async def _arun(self, query: str, run_manager: Optional[Any] = None) -> str:
+        return ""
+
+    async def send_feedback(self, feedback: str, is_still_typing=True) -> None:
+        pass
+
+
+class InlineMemoryAutoGPT(AutoGPT):
+    """The agent writing its memory (embedding included) right on the event loop, before the next turn."""
+
+    async def _remember(self, memory_to_add: str) -> None:
+        self.memory.add_documents([Document(page_content=memory_to_add)])
+
+
+def script_goal(commands: int, commands_per_turn: int) -> list[str]:
+    """The replies of the LLM for a goal that takes `commands` independent commands."""
+    thoughts = {"text": "searching", "reasoning": "", "plan": "", "criticism": "", "speak": ""}
+    replies = []
+    for first in range(0, commands, commands_per_turn):
+        turn_commands = [
+            {"name": "search", "args": {"query": f"query {i}"}}
+            for i in range(first, min(first + commands_per_turn, commands))
+        ]
+        if commands_per_turn > 1:
+            replies.append(json.dumps({"thoughts": thoughts, "commands": turn_commands}))
+        else:
+            replies.append(json.dumps({"thoughts": thoughts, "command": turn_commands[0]}))
+    finish = {"name": "finish", "args": {"response": "done"}}
+    replies.append(json.dumps({"thoughts": thoughts, "command": finish}))
+    return replies
+
+
+async def run_goal(agent_class: type[AutoGPT], commands_per_turn: int, args: argparse.Namespace) -> tuple[float, int]:
+    """Reach one goal with a fresh agent (returns how long it took and how many LLM calls it made)."""
+    llm = ScriptedChatModel(
+        replies=script_goal(args.commands, commands_per_turn), latency_seconds=args.llm_latency_ms / 1000
+    )
+    human = SilentHuman()
+    agent = agent_class.from_llm_and_tools(
+        ai_name="Benchmark",
+        ai_role="an agent that searches the web",
+        memory=AdaptiveFAISS.empty(
+            SleepingEmbeddings(args.embedding_latency_ms / 1000), dimension=EMBEDDING_SIZE
+        ).as_retriever(),
+        tools=[SleepingTool(latency_seconds=args.tool_latency_ms / 1000), human],
+        llm=llm,
+        feedback_tool=human,
+    )
+    agent.max_commands_per_turn = commands_per_turn
+    started_at = time.perf_counter()
+    await agent.arun(["find out everything"])
+    return time.perf_counter() - started_at, llm.calls
+
+
+def _report(name: str, durations: list[float], llm_calls: int, baseline: float) -> None:
+    mean = statistics.mean(durations)
+    print(f"{name:<45} {mean:7.2f}s per goal  {llm_calls:3} LLM calls  {baseline / mean:5.2f}x")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--goals", type=int, default=3, help="how many goals to reach in every setup")
+    parser.add_argument("--commands", type=int, default=8, help="how many commands a goal takes")
+    parser.add_argument("--commands-per-turn", type=int, default=4, help="the most commands the agent runs at once")
+    parser.add_argument("--llm-latency-ms", type=float, default=500, help="how long an LLM call takes")
+    parser.add_argument("--tool-latency-ms", type=float, default=200, help="how long a command takes")
+    parser.add_argument("--embedding-latency-ms", type=float, default=150, help="how long an embedding call takes")
+    args = parser.parse_args()
+
+    print(
+        f"{args.commands} commands per goal, LLM {args.llm_latency_ms:.0f}ms, command {args.tool_latency_ms:.0f}ms, "
+        f"embedding {args.embedding_latency_ms:.0f}ms"
+    )
+    baseline = None
+    for name, agent_class, commands_per_turn in (
+        ("1 command per turn, memory written in line", InlineMemoryAutoGPT, 1),
+        ("1 command per turn, memory written meanwhile", AutoGPT, 1),
+        (f"{args.commands_per_turn} commands per turn, memory written meanwhile", AutoGPT, args.commands_per_turn),
+    ):
+        results = [await run_goal(agent_class, commands_per_turn, args) for _ in range(args.goals)]
+        durations = [duration for duration, _ in results]
+        baseline = baseline or statistics.mean(durations)
+        _report(name, durations, results[0][1], baseline)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
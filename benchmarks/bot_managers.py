@@ -0,0 +1,151 @@
+"""
+Feeds a stream of messages (1M by default) to `SQLiteBotManager` and to `InMemoryBotManager` and reports how fast the
+messages are taken in and how the memory of the process grows. `--active-conversations` conversations go on at the same
+time, each of them `--conversation-length` messages long (a finished conversation is replaced with a new one and is no
+longer referenced by the benchmark - only the manager may keep it alive).
+
+    python -m benchmarks.bot_managers [--messages 1000000] [--active-conversations 500] [--tracemalloc]
+
+Every manager runs in a process of its own, so that their memory footprints don't mix.
+"""
+import argparse
+import asyncio
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from mergedbots import InMemoryBotManager, MergedMessage, MergedParticipant
+
+from experiments.common.sqlite_bot_manager import SQLiteBotManager
+
+
+def rss_bytes() -> int:
+    """The resident set size of the process."""
+    try:
+        return int(Path("/proc/self/statm").read_text(encoding="ascii").split()[1]) * resource.getpagesize()
+    except OSError:
+        # (the peak one, in KiB on Linux - only used where there is no procfs)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def add_message(
+    manager: InMemoryBotManager, previous_msg: MergedMessage | None, sender: MergedParticipant, content: str
+) -> MergedMessage:
+    """Create a message the way the manager does (`InMemoryBotManager` keeps its objects in `data`)."""
+    msg = MergedMessage(
+        manager=manager,
+        previous_msg=previous_msg,
+        in_fulfillment_of=None,
+        sender=sender,
+        originator=sender,
+        content=content,
+        is_still_typing=False,
+        is_visible_to_bots=True,
+    )
+    manager.data[msg.uuid] = msg
+    return msg
+
+
+def _new_conversation(rng: random.Random, args: argparse.Namespace) -> list:
+    length = rng.randint(1, args.conversation_length * 2)
+    return [None, length, length]
+
+
+async def read_conversations(
+    manager_kind: str, manager: InMemoryBotManager, messages: list[MergedMessage]
+) -> list[tuple[int, float]]:
+    """Read the conversations that end with the messages (returns their lengths and how long each read took)."""
+    reads = []
+    for message in messages:
+        started_at = time.perf_counter()
+        if manager_kind == "sqlite":
+            conversation = await manager.get_full_conversion(message)
+        else:
+            conversation = await message.get_full_conversion()
+        reads.append((len(conversation), time.perf_counter() - started_at))
+    return reads
+
+
+def run_manager(manager_kind: str, args: argparse.Namespace) -> list[str]:
+    """Feed the messages to a manager (returns the lines of the report)."""
+    if args.tracemalloc:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if manager_kind == "sqlite":
+            manager = SQLiteBotManager(db_file=str(Path(tmp_dir) / "messages.sqlite"))
+        else:
+            manager = InMemoryBotManager()
+
+        async def fulfill(bot, message):
+            yield message
+
+        sender = manager.create_bot(handle="BenchmarkBot")(fulfill).bot
+        rng = random.Random(0)
+        # the last message of every active conversation, how many messages are still to come in it and its length
+        active = [_new_conversation(rng, args) for _ in range(args.active_conversations)]
+        content = "x" * args.message_size
+        # the last message of the first conversation of at least average length that finishes
+        oldest_tip = None
+
+        lines = [f"{manager_kind}:"]
+        started_at = interval_started_at = time.perf_counter()
+        for i in range(1, args.messages + 1):
+            conversation = active[rng.randrange(len(active))]
+            conversation[0] = add_message(manager, conversation[0], sender, content)
+            conversation[1] -= 1
+            if not conversation[1]:
+                if oldest_tip is None and conversation[2] >= args.conversation_length:
+                    oldest_tip = conversation[0]
+                conversation[:] = _new_conversation(rng, args)
+
+            if not i % args.report_every:
+                now = time.perf_counter()
+                line = (
+                    f"  {i:9} messages  {args.report_every / (now - interval_started_at):8.0f} msg/s  "
+                    f"RSS {rss_bytes() / 2**20:7.1f} MiB"
+                )
+                if args.tracemalloc:
+                    line += f"  traced {tracemalloc.get_traced_memory()[0] / 2**20:7.1f} MiB"
+                if manager_kind == "sqlite":
+                    # pylint: disable=protected-access
+                    line += f"  {manager._store.pending_writes:6} rows not written yet"
+                lines.append(line)
+                interval_started_at = now
+
+        if manager_kind == "sqlite":
+            # pylint: disable=protected-access
+            manager._store.flush()
+        duration = time.perf_counter() - started_at
+        lines.append(f"  {args.messages / duration:.0f} msg/s overall ({duration:.1f}s, all the writes included)")
+        lines.append(f"  {len(manager.data)} objects in memory")
+
+        reads = asyncio.run(read_conversations(manager_kind, manager, [oldest_tip, active[0][0] or oldest_tip]))
+        for name, (length, seconds) in zip(("the oldest", "an active"), reads):
+            lines.append(f"  {name} conversation ({length} messages) read in {seconds * 1000:.2f}ms")
+        if manager_kind == "sqlite":
+            manager.close()
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000, help="how many messages to feed to every manager")
+    parser.add_argument("--active-conversations", type=int, default=500, help="how many conversations go on at once")
+    parser.add_argument("--conversation-length", type=int, default=20, help="the average length of a conversation")
+    parser.add_argument("--message-size", type=int, default=200, help="the length of a message, in characters")
+    parser.add_argument("--report-every", type=int, default=100_000, help="how often to report (in messages)")
+    parser.add_argument("--managers", nargs="+", default=["sqlite", "memory"], choices=["sqlite", "memory"])
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the memory traced by Python")
+    args = parser.parse_args()
+
+    for manager_kind in args.managers:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            print("\n".join(executor.submit(run_manager, manager_kind, args).result()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# pylint: disable=wrong-import-position
+"""
+Measures how much the file tools (see `experiments/common/repo_access_utils.py`) hold up the event loop while they
+list a large repo (cold, so the whole tree is walked and classified) and read its files: once with the blocking work
+done right on the event loop (which is what `_arun` used to do) and once through `arun`, which offloads it to the
+shared disk I/O pool. A ticker coroutine that wakes up every few milliseconds stands in for the other conversations
+the process serves - how late it wakes up is the event loop lag.
+
+    python -m benchmarks.event_loop_lag [--files 20000] [--max-lag-ms 100]
+
+Exits with an error if the lag with `arun` exceeds `--max-lag-ms`.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# the indexes (and the classifier verdicts that are kept next to them) of the generated repos are not worth keeping
+_cache_dir = tempfile.TemporaryDirectory()
+os.environ["REPO_INDEX_CACHE_DIR"] = _cache_dir.name
+
+from benchmarks.text_files import generate_tree
+from experiments.common.repo_access_utils import ListRepoTool, ReadFileTool
+
+TICK_SECONDS = 0.005
+FILES_TO_READ = 200
+
+
+async def measure_lag(workload) -> tuple[list[float], float]:
+    """Run a workload while a ticker measures the event loop lag (returns the lags and how long the workload took)."""
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker() -> None:
+        while not done.is_set():
+            expected_at = time.perf_counter() + TICK_SECONDS
+            await asyncio.sleep(TICK_SECONDS)
+            lags.append(max(time.perf_counter() - expected_at, 0.0))
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK_SECONDS * 2)
+    started_at = time.perf_counter()
+    await workload()
+    duration = time.perf_counter() - started_at
+    done.set()
+    await ticker_task
+    return lags, duration
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20_000, help="the number of files in the generated repo")
+    parser.add_argument("--max-lag-ms", type=float, default=100, help="the lag `arun` must stay within")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {}
+        for mode in ("blocking", "arun"):
+            # a repo of its own for every mode, so that both list it cold
+            repo_path = Path(tmp_dir) / mode
+            print(f"generating {args.files} files for the {mode} run...")
+            paths = generate_tree(repo_path, args.files)
+            list_tool = ListRepoTool(root_dir=str(repo_path))
+            read_tool = ReadFileTool(root_dir=str(repo_path))
+            files_to_read = [path.relative_to(repo_path).as_posix() for path in paths[:FILES_TO_READ]]
+
+            async def blocking_workload() -> None:
+                list_tool._run()  # pylint: disable=protected-access
+                for file_path in files_to_read:
+                    read_tool._run(file_path)  # pylint: disable=protected-access
+
+            async def arun_workload() -> None:
+                async def read_files() -> None:
+                    # one file after the other, the way an agent reads them
+                    for file_path in files_to_read:
+                        await read_tool.arun({"file_path": file_path})
+
+                await asyncio.gather(list_tool.arun({}), read_files())
+
+            # a full garbage collection stops every thread, the event loop included - without this, the collections
+            # over the objects created by the setup would be the biggest source of lag, which has nothing to do with
+            # the tools
+            gc.collect()
+            gc.freeze()
+            results[mode] = await measure_lag(blocking_workload if mode == "blocking" else arun_workload)
+
+    for mode, (lags, duration) in results.items():
+        lags_ms = sorted(lag * 1000 for lag in lags)
+        p99_ms = lags_ms[min(int(len(lags_ms) * 0.99), len(lags_ms) - 1)]
+        print(
+            f"{mode:<9} workload {duration:6.2f}s, event loop lag: max {lags_ms[-1]:8.1f}ms, p99 {p99_ms:8.1f}ms, "
+            f"median {statistics.median(lags_ms):6.1f}ms ({len(lags_ms)} ticks)"
+        )
+
+    max_lag_ms = max(results["arun"][0]) * 1000
+    if max_lag_ms > args.max_lag_ms:
+        sys.exit(f"the event loop lagged {max_lag_ms:.1f}ms behind with arun (more than {args.max_lag_ms}ms)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
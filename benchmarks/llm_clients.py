@@ -0,0 +1,164 @@
+# pylint: disable=wrong-import-position
+"""
+Compares the shared chat LLM clients of `get_chat_llm()` (one aiohttp connection pool per event loop) with what the
+bots used to do - construct a `PromptLayerChatOpenAI` for every call (and let `openai` open a new aiohttp session, and
+hence a new connection, for every request). The requests go to a local stand-in of the OpenAI API (and of the
+PromptLayer API) that answers after `--latency-ms`, so what is measured is the client-side overhead: construction,
+connection setup and the time on top of the simulated latency. (A connection to the stand-in is plain HTTP over the
+loopback - against the real API every new connection also costs a TLS handshake and network round trips.)
+
+    python -m benchmarks.llm_clients [--requests 500] [--concurrency 20] [--latency-ms 50]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import threading
+import time
+from typing import Awaitable, Callable
+
+from aiohttp import web
+
+# the stand-in listens on a port picked before `openai` and `promptlayer` are imported (they read their URLs then)
+_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+_server_socket.bind(("127.0.0.1", 0))
+_server_url = f"http://127.0.0.1:{_server_socket.getsockname()[1]}"
+os.environ["OPENAI_API_KEY"] = "sk-benchmark"
+os.environ["OPENAI_API_BASE"] = f"{_server_url}/v1"
+os.environ["PROMPTLAYER_API_KEY"] = "pl-benchmark"
+os.environ["URL_API_PROMPTLAYER"] = _server_url
+# the scheduler is not what is measured here
+os.environ["LLM_MAX_CONCURRENCY"] = "1000"
+os.environ["LLM_REQUESTS_PER_MINUTE"] = "1000000000"
+os.environ["LLM_TOKENS_PER_MINUTE"] = "1000000000"
+
+from langchain.chat_models import PromptLayerChatOpenAI
+from langchain.schema import HumanMessage
+
+from experiments.common.bot_manager import FAST_GPT_MODEL
+from experiments.common.llm_clients import close_http_sessions, get_chat_llm, in_llm_request
+
+
+class StandInServer:
+    """A local stand-in of the chat completions endpoint (and of PromptLayer tracking) that counts connections."""
+
+    def __init__(self, latency_seconds: float) -> None:
+        self.latency_seconds = latency_seconds
+        self.connections: set = set()
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+
+    def start(self) -> None:
+        """Serve in a thread of its own (with its own event loop, so it doesn't compete with the clients)."""
+        threading.Thread(target=self._serve, name="stand-in-server", daemon=True).start()
+        self._started.wait()
+
+    def _serve(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        app.router.add_post("/track-request", self._track_request)
+        runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        self._loop.run_until_complete(web.SockSite(runner, _server_socket).start())
+        self._started.set()
+        self._loop.run_forever()
+
+    async def _chat_completions(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport.get_extra_info("peername"))
+        body = await request.json()
+        await asyncio.sleep(self.latency_seconds)
+        return web.json_response(
+            {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": "Hello!"}, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+            }
+        )
+
+    async def _track_request(self, _: web.Request) -> web.Response:
+        return web.json_response({"success": True, "request_id": 1})
+
+
+async def per_call_client(user: str) -> None:
+    """A request the way the bots used to make it."""
+    chat_llm = PromptLayerChatOpenAI(
+        model_name=FAST_GPT_MODEL, temperature=0.0, model_kwargs={"user": user}, pl_tags=["benchmark"]
+    )
+    await chat_llm.agenerate([[HumanMessage(content="Hi!")]])
+
+
+async def shared_client(user: str) -> None:
+    """A request through the shared client."""
+    chat_llm = get_chat_llm(FAST_GPT_MODEL, temperature=0.0)
+    await in_llm_request(chat_llm.agenerate([[HumanMessage(content="Hi!")]]), user=user, pl_tags=["benchmark"])
+
+
+async def run(
+    make_request: Callable[[str], Awaitable[None]], requests: int, concurrency: int
+) -> tuple[list[float], float]:
+    """Make the requests from `concurrency` workers (returns the latencies and how long it all took)."""
+    latencies = []
+    next_request = iter(range(requests))
+
+    async def worker() -> None:
+        for request in next_request:
+            started_at = time.perf_counter()
+            await make_request(f"user{request % 50}")
+            latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started_at
+
+
+def _report(name: str, latencies: list[float], duration: float, connections: int, latency_seconds: float) -> None:
+    latencies = sorted(latencies)
+    overhead_ms = (statistics.mean(latencies) - latency_seconds) * 1000
+    print(
+        f"{name:<10} {len(latencies) / duration:8.1f} req/s  "
+        f"p50 {latencies[len(latencies) // 2] * 1000:7.1f}ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.1f}ms  "
+        f"overhead {overhead_ms:6.1f}ms  {connections:5} connections"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="how many requests to make with each client")
+    parser.add_argument("--concurrency", type=int, default=20, help="how many requests are in flight at a time")
+    parser.add_argument("--latency-ms", type=float, default=50, help="how long the stand-in takes to answer")
+    args = parser.parse_args()
+
+    server = StandInServer(args.latency_ms / 1000)
+    server.start()
+
+    construction_rounds = 1000
+    started_at = time.perf_counter()
+    for _ in range(construction_rounds):
+        PromptLayerChatOpenAI(model_name=FAST_GPT_MODEL, temperature=0.0, model_kwargs={"user": "user"})
+    constructed_ms = (time.perf_counter() - started_at) / construction_rounds * 1000
+    started_at = time.perf_counter()
+    for _ in range(construction_rounds):
+        get_chat_llm(FAST_GPT_MODEL, temperature=0.0)
+    shared_ms = (time.perf_counter() - started_at) / construction_rounds * 1000
+    print(f"getting a client: constructed {constructed_ms:.3f}ms, shared {shared_ms:.4f}ms")
+
+    # a few requests to warm up both the clients and the stand-in
+    await run(per_call_client, args.concurrency, args.concurrency)
+    await run(shared_client, args.concurrency, args.concurrency)
+
+    for name, make_request in (("per call", per_call_client), ("shared", shared_client)):
+        server.connections.clear()
+        latencies, duration = await run(make_request, args.requests, args.concurrency)
+        _report(name, latencies, duration, len(server.connections), args.latency_ms / 1000)
+    await close_http_sessions()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+"""
+Benchmark of the repo walk with nested .gitignore files (see `RepoIndex` in `experiments/common/repo_index.py`)
+against the walk that only read the top-level .gitignore (which is what listing a repo used to do), on a generated
+monorepo whose packages ignore their own `node_modules`, `build` and generated directories.
+
+    python -m benchmarks.nested_gitignore [--packages 40] [--ignored-files 1000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from pathspec import pathspec
+
+from experiments.common.repo_index import REPO_WALK_WORKERS, RepoIndex
+from experiments.common.text_files import TextFileClassifier
+
+SOURCE_FILES_PER_PACKAGE = 30
+
+
+def generate_repo(root: Path, packages: int, ignored_files: int, seed: int = 0) -> None:
+    """
+    A monorepo of `packages` packages, each with its own .gitignore, a few source files and `ignored_files` files in
+    the directories its .gitignore files ignore (some of which are nested deeper in the package).
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents=True)
+    (root / ".gitignore").write_text("*.tmp\n", encoding="utf-8")
+    for i in range(packages):
+        package = root / "packages" / f"package{i}"
+        (package / "src" / "generator").mkdir(parents=True)
+        (package / ".gitignore").write_text("node_modules/\n/build/\n*.log\n", encoding="utf-8")
+        (package / "src" / "generator" / ".gitignore").write_text("generated/\n", encoding="utf-8")
+        for j in range(SOURCE_FILES_PER_PACKAGE):
+            (package / "src" / f"module{j}.py").write_text(f"VALUE = {j}\n", encoding="utf-8")
+        (package / "src" / "generator" / "keep.py").write_text("KEEP = True\n", encoding="utf-8")
+        (package / "README.md").write_text(f"# package {i}\n", encoding="utf-8")
+
+        ignored_dirs = [
+            package / "node_modules",
+            package / "build",
+            package / "src" / "generator" / "generated",
+        ]
+        for k in range(ignored_files):
+            directory = rng.choice(ignored_dirs) / f"dep{k % 50}" / "lib"
+            directory.mkdir(parents=True, exist_ok=True)
+            (directory / f"file{k}.js").write_text("module.exports = {};\n", encoding="utf-8")
+        for k in range(10):
+            (package / f"debug{k}.log").write_text("some log line\n", encoding="utf-8")
+
+
+def walk_with_top_level_gitignore(repo_path: Path, classifier: TextFileClassifier) -> tuple[list[Path], int]:
+    """How the repo used to be listed: only the top-level .gitignore, matched against full relative paths."""
+    gitignore_path = repo_path / ".gitignore"
+    gitignore_content = gitignore_path.read_text(encoding="utf-8") if gitignore_path.is_file() else ""
+    spec = pathspec.PathSpec.from_lines("gitwildmatch", f".*\n{gitignore_content}".splitlines())
+
+    file_list = []
+    visited_entries = 0
+    for root, dirs, files in os.walk(repo_path):
+        root = Path(root)
+        visited_entries += len(dirs) + len(files)
+        dirs[:] = [d for d in dirs if not spec.match_file((root / d).relative_to(repo_path))]
+        for file in files:
+            file_path = root / file
+            rel_file_path = file_path.relative_to(repo_path)
+            if not spec.match_file(rel_file_path) and classifier.is_text_file(file_path):
+                file_list.append(rel_file_path)
+    file_list.sort(key=lambda p: (p.as_posix().lower(), p.as_posix()))
+    return file_list, visited_entries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=40, help="the number of packages in the monorepo")
+    parser.add_argument("--ignored-files", type=int, default=1000, help="the number of ignored files per package")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        repo_path = Path(tmp_dir) / "repo"
+        print(f"generating {args.packages} packages with {args.ignored_files} ignored files each...")
+        generate_repo(repo_path, args.packages, args.ignored_files)
+
+        started_at = time.perf_counter()
+        old_files, old_visited = walk_with_top_level_gitignore(repo_path, TextFileClassifier())
+        _report("top-level .gitignore only", time.perf_counter() - started_at, old_visited, len(old_files))
+
+        for workers in sorted({1, REPO_WALK_WORKERS}):
+            repo_index = RepoIndex(repo_path, cache_dir=None, workers=workers)
+            new_files = repo_index.list_files()
+            stats = repo_index.scan_stats
+            name = f"nested .gitignore, {workers} worker(s)"
+            _report(name, stats["seconds"], stats["visited_entries"], len(new_files))
+
+        excluded_files = len(set(old_files) - set(new_files))
+        print(f"files listed by the old walk that the nested .gitignore files exclude: {excluded_files}")
+        expected_files = args.packages * (SOURCE_FILES_PER_PACKAGE + 2)
+        assert len(new_files) == expected_files, (len(new_files), expected_files)
+
+
+def _report(name: str, seconds: float, visited_entries: int, listed_files: int) -> None:
+    print(f"{name:<32} {seconds:7.2f}s {visited_entries:9} entries visited {listed_files:9} files listed")
+
+
+if __name__ == "__main__":
+    main()
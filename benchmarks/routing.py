@@ -0,0 +1,148 @@
+"""
+Replays a corpus of conversations through the routing of `router_bot` (the local `LexicalRouter` tiers first, the LLM
+only when they are not confident) and reports the routing latency, the LLM call rate and how often the local tiers
+disagreed with the LLM. The LLM is scripted: it answers with the bot the corpus labels the message with (and takes
+`--llm-latency-ms` to do so, which is accounted for, not slept).
+
+    python -m benchmarks.routing [--corpus corpus.jsonl] [--conversations 500]
+
+A corpus is a JSON lines file of {"conversation": ..., "text": ..., "bot": ...} objects in the order the messages
+were sent. Without one, a synthetic corpus is generated.
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter
+
+from experiments.common.lexical_router import LexicalRouter
+
+# the bots `router_bot` routes between and their descriptions (see `plain_gpt` and `active_listener`)
+ROUTES = {
+    "PlainGPT": (
+        "A bot that uses either GPT-4 or ChatGPT to generate responses. Useful when the user seeks information and "
+        "needs factual answers."
+    ),
+    "ActiveListener": "A chatbot that acts as an active listener. Useful when the user needs to vent.",
+}
+
+_QUESTIONS = [
+    "what is the capital of {place}?",
+    "how do I {task} in python?",
+    "can you explain how {thing} works?",
+    "what's the difference between {thing} and {other_thing}?",
+    "how many {unit} are there in a {bigger_unit}?",
+    "give me a summary of the history of {place}",
+    "which is faster, {thing} or {other_thing}?",
+    "what does the error '{error}' mean?",
+]
+_VENTING = [
+    "I'm so tired of {annoyance}, nobody listens to me",
+    "today was awful, {annoyance} again",
+    "I feel like I can't cope with {annoyance} anymore",
+    "honestly I'm just frustrated and exhausted because of {annoyance}",
+    "I need to get this off my chest: {annoyance}",
+    "why does {annoyance} always happen to me?",
+    "I'm anxious about {annoyance} and I can't sleep",
+]
+_FILLERS = {
+    "place": ["France", "Peru", "Kenya", "Japan", "Norway", "Chile"],
+    "task": ["sort a dict", "read a csv file", "reverse a list", "parse json", "merge two lists"],
+    "thing": ["TCP", "a hash map", "garbage collection", "HTTPS", "a B-tree", "DNS"],
+    "other_thing": ["UDP", "a tree map", "reference counting", "HTTP", "an LSM tree", "mDNS"],
+    "unit": ["seconds", "grams", "centimeters", "bytes"],
+    "bigger_unit": ["day", "kilogram", "mile", "gigabyte"],
+    "error": ["KeyError", "segmentation fault", "connection refused", "permission denied"],
+    "annoyance": [
+        "my boss",
+        "my landlord",
+        "the noise next door",
+        "my exams",
+        "being ignored at work",
+        "my family arguing",
+    ],
+}
+# messages that neither tier can tell apart (they go to whichever bot the conversation is with)
+_AMBIGUOUS = ["ok", "thanks", "hmm", "and then?", "yes", "I see", "go on"]
+
+
+def generate_corpus(conversations: int, rng: random.Random) -> list[dict]:
+    """Conversations of 2-10 messages that mostly stay with one bot (and sometimes switch to the other one)."""
+    conversations = [[] for _ in range(conversations)]
+    for conversation, messages in enumerate(conversations):
+        bot = rng.choice(list(ROUTES))
+        for _ in range(rng.randint(2, 10)):
+            if rng.random() < 0.1:
+                bot = "ActiveListener" if bot == "PlainGPT" else "PlainGPT"
+            if rng.random() < 0.25:
+                text = rng.choice(_AMBIGUOUS)
+            else:
+                template = rng.choice(_QUESTIONS if bot == "PlainGPT" else _VENTING)
+                text = template.format(**{name: rng.choice(values) for name, values in _FILLERS.items()})
+            messages.append({"conversation": f"channel{conversation}", "text": text, "bot": bot})
+
+    # the conversations go on at the same time (their messages are interleaved, each conversation keeping its order)
+    corpus = []
+    while conversations:
+        messages = rng.choice(conversations)
+        corpus.append(messages.pop(0))
+        if not messages:
+            conversations.remove(messages)
+    return corpus
+
+
+def replay(corpus: list[dict], router: LexicalRouter, llm_latency_seconds: float) -> Counter:
+    """Route every message the way `router_bot` does and return how many local decisions disagreed with the LLM."""
+    disagreements = Counter()
+    for message in corpus:
+        started_at = time.perf_counter()
+        decision = router.route(message["conversation"], message["text"])
+        bot_handle = decision.bot_handle
+        seconds = time.perf_counter() - started_at
+        if bot_handle is None:
+            # the scripted LLM
+            bot_handle = message["bot"]
+            seconds += llm_latency_seconds
+            router.learn(bot_handle, message["text"])
+        elif bot_handle != message["bot"]:
+            disagreements[decision.tier] += 1
+        if decision.tier != "sticky":
+            router.remember(message["conversation"], bot_handle)
+        router.stats.record(decision.tier, seconds)
+    return disagreements
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="a JSON lines file of messages to replay (a synthetic one by default)")
+    parser.add_argument("--conversations", type=int, default=500, help="the size of the synthetic corpus")
+    parser.add_argument("--llm-latency-ms", type=float, default=500, help="how long a routing LLM call takes")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, "r", encoding="utf-8") as file:
+            corpus = [json.loads(line) for line in file if line.strip()]
+    else:
+        corpus = generate_corpus(args.conversations, random.Random(0))
+
+    router = LexicalRouter()
+    for bot_handle, description in ROUTES.items():
+        router.add_route(bot_handle, description)
+    disagreements = replay(corpus, router, args.llm_latency_ms / 1000)
+
+    stats = router.stats
+    total = sum(stats.decisions.values())
+    print(f"{total} messages in {len({message['conversation'] for message in corpus})} conversations")
+    for tier in ("local", "sticky", "llm"):
+        print(
+            f"{tier:<7} {stats.decisions[tier]:7} messages ({stats.decisions[tier] / total:6.1%}), "
+            f"average latency {stats.average_seconds(tier) * 1000:8.3f}ms, "
+            f"disagreed with the LLM {disagreements[tier]} times"
+        )
+    average_ms = sum(stats.seconds.values()) / total * 1000
+    print(f"LLM call rate {stats.llm_call_rate:.1%}, average routing latency {average_ms:.1f}ms")
+    print(f"(an LLM call for every message: 100% and {args.llm_latency_ms:.1f}ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark of the tiered text file classifier (see `experiments/common/text_files.py`) against calling libmagic for
+every single file (which is what listing a repo used to do), on a generated tree of files with known text, known
+binary and unknown extensions.
+
+    python -m benchmarks.text_files [--files 50000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from experiments.common.text_files import TextFileClassifier, is_text_file_by_libmagic
+
+FILES_PER_DIR = 100
+
+# (file name suffix, content factory) - the contents are small, like most of the files in a real repo
+_FILE_KINDS = [
+    (".py", lambda rng: "".join(f"def f{i}():\n    return {i}\n" for i in range(rng.randint(1, 50))).encode()),
+    (".md", lambda rng: ("# Title\n\nSome text.\n" * rng.randint(1, 30)).encode()),
+    (".json", lambda rng: ('{"key": [%s]}\n' % ", ".join(["1"] * rng.randint(1, 300))).encode()),
+    (".png", lambda rng: b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR" + rng.randbytes(rng.randint(100, 4000))),
+    (".pyc", lambda rng: b"\x42\x0d\x0d\x0a\0\0\0\0" + rng.randbytes(rng.randint(100, 4000))),
+    # unknown extensions: text that the sniffing recognizes, binary with NUL bytes and text in a legacy encoding
+    # (the sniffing is inconclusive about the latter, so it goes to libmagic)
+    ("", lambda rng: b"all:\n\tmake build\n" * rng.randint(1, 20)),
+    (".conf", lambda rng: ("[section]\nkey = été\n" * rng.randint(1, 20)).encode()),
+    (".dat", lambda rng: rng.randbytes(rng.randint(100, 4000)) + b"\0"),
+    (".txt1", lambda rng: "café crème brûlée\n".encode("latin-1") * rng.randint(1, 20)),
+]
+
+
+def generate_tree(root: Path, files: int, seed: int = 0) -> list[Path]:
+    """Generate `files` files under `root` (`FILES_PER_DIR` per directory, directories two levels deep)."""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        directory = root / f"d{i // (FILES_PER_DIR * 10)}" / f"d{i // FILES_PER_DIR}"
+        if i % FILES_PER_DIR == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+        suffix, make_content = rng.choice(_FILE_KINDS)
+        path = directory / f"file{i}{suffix}"
+        path.write_bytes(make_content(rng))
+        paths.append(path)
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=50_000, help="the number of files to generate")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        print(f"generating {args.files} files...")
+        paths = generate_tree(tmp_dir / "repo", args.files)
+
+        # (the files were just written, so all the runs read them from the page cache)
+        started_at = time.perf_counter()
+        libmagic_verdicts = [is_text_file_by_libmagic(path) for path in paths]
+        _report("libmagic for every file", started_at, len(paths))
+
+        cache_file = tmp_dir / "verdicts.json"
+        classifier = TextFileClassifier(cache_file)
+        started_at = time.perf_counter()
+        cold_verdicts = [classifier.is_text_file(path) for path in paths]
+        _report("tiered classifier, empty cache", started_at, len(paths))
+        classifier.save()
+
+        classifier = TextFileClassifier(cache_file)
+        started_at = time.perf_counter()
+        warm_verdicts = [classifier.is_text_file(path) for path in paths]
+        _report("tiered classifier, persisted cache", started_at, len(paths))
+        print(f"(the persisted cache takes {os.path.getsize(cache_file) // 1024} KiB)")
+
+        disagreements = sum(verdict != expected for verdict, expected in zip(cold_verdicts, libmagic_verdicts))
+        assert warm_verdicts == cold_verdicts
+        print(f"disagreements with libmagic: {disagreements} of {len(paths)} files")
+
+
+def _report(name: str, started_at: float, files: int) -> None:
+    seconds = time.perf_counter() - started_at
+    print(f"{name:<40} {seconds:7.2f}s {files / seconds:10.0f} files/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Recall vs latency of the vector index modes (see `experiments/common/vector_indexes.py`) on synthetic embeddings, to
+pick the index settings for long-lived memory shards. For every store size the exact (flat) search provides the
+ground truth, and HNSW and IVF-PQ are measured over a sweep of their search-time parameters (`efSearch` and
+`nprobe` respectively - the build-time parameters come from the environment, see `HNSW_M` & co).
+
+    python -m benchmarks.vector_indexes [--sizes 10000 100000 1000000] [--dimension 1536]
+
+NOTE: the vectors alone take `size * dimension * 4` bytes (almost 6 GiB for a million 1536-dimensional ones).
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from experiments.common.vector_indexes import EMBEDDING_SIZE, create_index
+
+HNSW_EF_SEARCH_SWEEP = (16, 32, 64, 128, 256)
+IVFPQ_NPROBE_SWEEP = (1, 4, 16, 64)
+
+
+class SyntheticEmbeddings:
+    """
+    Unit vectors that are clustered (by "topic") in a low-dimensional latent space, which is projected into the full
+    embedding space with a bit of noise on top - like real text embeddings, and unlike uniformly random vectors (the
+    worst case for any approximate index, since all of them are almost equally far from each other).
+    """
+
+    def __init__(self, dimension: int, intrinsic_dimension: int, clusters: int, rng: np.random.Generator) -> None:
+        self.rng = rng
+        self.centers = rng.standard_normal((clusters, intrinsic_dimension), dtype=np.float32)
+        self.projection = rng.standard_normal((intrinsic_dimension, dimension), dtype=np.float32)
+
+    def sample(self, count: int) -> np.ndarray:
+        """Generate `count` vectors."""
+        vectors = np.empty((count, self.projection.shape[1]), dtype=np.float32)
+        for start in range(0, count, 100_000):
+            end = min(start + 100_000, count)
+            latent = self.centers[self.rng.integers(0, len(self.centers), end - start)]
+            latent += self.rng.standard_normal(latent.shape, dtype=np.float32) * 0.5
+            chunk = latent @ self.projection
+            chunk += self.rng.standard_normal(chunk.shape, dtype=np.float32) * 0.1 * np.sqrt(latent.shape[1])
+            vectors[start:end] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+        return vectors
+
+
+def search(index, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    """Search the queries one by one (the way the stores do) and return the results and the mean latency."""
+    results = np.empty((len(queries), k), dtype=np.int64)
+    started_at = time.perf_counter()
+    for i, query in enumerate(queries):
+        _, results[i] = index.search(query[None, :], k)
+    return results, (time.perf_counter() - started_at) / len(queries)
+
+
+def recall(results: np.ndarray, ground_truth: np.ndarray) -> float:
+    """The share of the true k nearest neighbours that were found (averaged over the queries)."""
+    return float(np.mean([len(set(found) & set(true)) / len(true) for found, true in zip(results, ground_truth)]))
+
+
+def benchmark_size(size: int, embeddings: SyntheticEmbeddings, queries: int, k: int) -> None:
+    """Build an index of every mode with `size` vectors and print the recall and latency of each setting."""
+    vectors = embeddings.sample(size)
+    query_vectors = embeddings.sample(queries)
+    dimension = vectors.shape[1]
+    print(f"\n{size} vectors of {dimension} dimensions")
+
+    flat_index = create_index("flat", dimension)
+    flat_index.add(vectors)
+    ground_truth, flat_latency = search(flat_index, query_vectors, k)
+    _report("flat", "-", 0.0, 1.0, flat_latency)
+    del flat_index
+
+    for mode, parameter_name, sweep in (
+        ("hnsw", "efSearch", HNSW_EF_SEARCH_SWEEP),
+        ("ivfpq", "nprobe", IVFPQ_NPROBE_SWEEP),
+    ):
+        started_at = time.perf_counter()
+        index = create_index(mode, dimension, training_vectors=vectors)
+        index.add(vectors)
+        build_seconds = time.perf_counter() - started_at
+        for value in sweep:
+            if mode == "hnsw":
+                index.hnsw.efSearch = value
+            else:
+                index.nprobe = value
+            results, latency = search(index, query_vectors, k)
+            _report(mode, f"{parameter_name}={value}", build_seconds, recall(results, ground_truth), latency)
+        del index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dimension", type=int, default=EMBEDDING_SIZE)
+    parser.add_argument("--intrinsic-dimension", type=int, default=64, help="the dimension of the latent space")
+    parser.add_argument("--clusters", type=int, default=1000, help="the number of topics in the latent space")
+    parser.add_argument("--queries", type=int, default=200, help="the number of queries to measure with")
+    parser.add_argument("-k", type=int, default=10, help="the number of neighbours to search for")
+    parser.add_argument("--threads", type=int, default=None, help="the number of threads faiss may use")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    embeddings = SyntheticEmbeddings(args.dimension, args.intrinsic_dimension, args.clusters, np.random.default_rng(0))
+    print(f"{'mode':<6} {'setting':<13} {'build':>9} {f'recall@{args.k}':>10} {'latency':>12}")
+    for size in args.sizes:
+        benchmark_size(size, embeddings, args.queries, args.k)
+
+
+def _report(mode: str, setting: str, build_seconds: float, recall_at_k: float, latency: float) -> None:
+    print(f"{mode:<6} {setting:<13} {build_seconds:8.1f}s {recall_at_k:10.3f} {latency * 1000:10.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,13 @@
 from typing import AsyncGenerator
 
 from langchain import LLMChain
-from langchain.chat_models import PromptLayerChatOpenAI
 from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from mergedbots import MergedMessage, MergedBot
 
 from experiments.common.bot_manager import SLOW_GPT_MODEL, bot_manager
+from experiments.common.bot_steps import BotSteps
+from experiments.common.llm_clients import get_chat_llm, in_llm_request
+from experiments.common.transcripts import TranscriptFormat, transcript_cache
 from experiments.memory_bots import recall_bot, memory_bot
 
 ACTIVE_LISTENER_PROMPT = ChatPromptTemplate.from_messages(
@@ -31,6 +33,10 @@ AI THERAPIST:"""
 
 PATIENT = "PATIENT"
 AI_THERAPIST = "AI THERAPIST"
+CONVERSATION_FORMAT = TranscriptFormat(
+    "active_listener_conversation",
+    lambda msg: f"{PATIENT if msg.is_sent_by_originator else AI_THERAPIST}: {msg.content}",
+)
 
 
 @bot_manager.create_bot(
@@ -43,34 +49,34 @@ async def active_listener(bot: MergedBot, message: MergedMessage) -> AsyncGenera
         yield await message.service_followup_as_final_response(bot, "```\nCONVERSATION RESTARTED\n```")
         return
 
-    async for msg in recall_bot.bot.fulfill(message):
-        yield msg
-
     model_name = SLOW_GPT_MODEL
-    yield await message.service_followup_for_user(bot, f"`{model_name} ({bot.handle})`")
 
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=model_name,
-        model_kwargs={
-            "stop": [f"\n\n{PATIENT}:", f"\n\n{AI_THERAPIST}:"],
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["mb_active_listener"],
-    )
-    llm_chain = LLMChain(
-        llm=chat_llm,
-        prompt=ACTIVE_LISTENER_PROMPT,
-    )
+    async def generate() -> AsyncGenerator[MergedMessage, None]:
+        yield await message.service_followup_for_user(bot, f"`{model_name} ({bot.handle})`")
 
-    conversation = await message.get_full_conversion()
-    formatted_conv_parts = [
-        f"{PATIENT if msg.is_sent_by_originator else AI_THERAPIST}: {msg.content}" for msg in conversation
-    ]
-    result = await llm_chain.arun(conversation="\n\n".join(formatted_conv_parts))
-    response = await message.final_bot_response(bot, result)
-    yield response
+        llm_chain = LLMChain(
+            llm=get_chat_llm(model_name, stop=[f"\n\n{PATIENT}:", f"\n\n{AI_THERAPIST}:"]),
+            prompt=ACTIVE_LISTENER_PROMPT,
+        )
 
-    async for msg in memory_bot.bot.fulfill(message):
-        yield msg
-    async for msg in memory_bot.bot.fulfill(response):
+        formatted_conv_parts = (await transcript_cache.aget(message)).formatted(CONVERSATION_FORMAT)
+        result = await in_llm_request(
+            llm_chain.arun(conversation="\n\n".join(formatted_conv_parts)),
+            user=str(message.originator.uuid),
+            pl_tags=["mb_active_listener"],
+        )
+        yield await message.final_bot_response(bot, result)
+
+    # the recalled memories are not used by the generation, so the LLM call does not wait for them; the inbound message
+    # is memorized only after the recall, so that the recall does not find the message itself
+    steps = BotSteps()
+    steps.add("recall", lambda: recall_bot.bot.fulfill(message))
+    steps.add("generation", generate)
+    steps.add("memorize_inbound", lambda: memory_bot.bot.fulfill(message), after=["recall"])
+    steps.add(
+        "memorize_response",
+        lambda: memory_bot.bot.fulfill(steps.outputs["generation"][-1]),
+        after=["generation", "memorize_inbound"],
+    )
+    async for msg in steps.run():
         yield msg
@@ -0,0 +1,127 @@
+"""Async-native operations on sharded memories that keep the blocking work off the event loop."""
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+from langchain.schema import Document
+
+from experiments.common.executors import BoundedExecutor, memory_executor
+from experiments.common.memory_shards import MemoryShardManager
+
+# how many times a queued memory is tried to be added before it is given up on (see `AsyncShardedMemory.failed_writes`)
+MEMORY_WRITE_ATTEMPTS = int(os.environ.get("MEMORY_WRITE_ATTEMPTS", 3))
+MEMORY_WRITE_RETRY_DELAY_SECONDS = float(os.environ.get("MEMORY_WRITE_RETRY_DELAY_SECONDS", 1))
+
+
+class AsyncShardedMemory:
+    """
+    Runs the (blocking) operations of `DeferredReflectionMemory` shards on a dedicated thread pool. Operations on the
+    same shard are serialized with the shard lock (which is not held during the LLM and embedding calls of a write),
+    operations on different shards run concurrently.
+
+    Writes can also be queued in the background (`add_memory_in_background`): they are applied in the order they were
+    queued (per shard) and `flush()` waits for all of them to be applied. A queued memory that fails to be added is
+    retried `write_attempts` times and then dropped (the dropped memories are counted in `failed_writes`).
+    """
+
+    def __init__(
+        self,
+        shards: MemoryShardManager,
+        executor: BoundedExecutor = memory_executor,
+        write_attempts: int = MEMORY_WRITE_ATTEMPTS,
+        retry_delay_seconds: float = MEMORY_WRITE_RETRY_DELAY_SECONDS,
+    ) -> None:
+        self.shards = shards
+        self.executor = executor
+        self.write_attempts = max(write_attempts, 1)
+        self.retry_delay_seconds = retry_delay_seconds
+        # the queued memories that could not be added (and the error that prevented it the last time)
+        self.failed_writes = 0
+        self.last_write_error: Exception | None = None
+        self._write_queues: dict[str, deque[str]] = {}
+        self._pending_writes = 0
+        self._condition = threading.Condition()
+
+    async def add_memory(self, shard_id: str, memory_content: str) -> list[str]:
+        """Add a memory to a shard (importance scoring, embedding and, possibly, reflection happen in a worker)."""
+        return await self.executor.run(self._add_memory, shard_id, memory_content)
+
+    async def fetch_memories(self, shard_id: str, observation: str) -> list[Document]:
+        """Fetch the memories of a shard that are relevant to an observation."""
+        return await self.executor.run(self._fetch_memories, shard_id, observation)
+
+    def add_memory_in_background(self, shard_id: str, memory_content: str) -> None:
+        """Queue a memory to be added to a shard without waiting for it."""
+        with self._condition:
+            write_queue = self._write_queues.setdefault(shard_id, deque())
+            write_queue.append(memory_content)
+            self._pending_writes += 1
+            # a queue that was not empty is already being drained
+            start_draining = len(write_queue) == 1
+        if start_draining:
+            self.executor.submit(self._drain_write_queue, shard_id)
+
+    @property
+    def pending_writes(self) -> int:
+        """The number of queued memories that were not added yet."""
+        return self._pending_writes
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait for the queued memories to be added (returns False if the timeout expired before that)."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending_writes, timeout)
+
+    def close(self) -> None:
+        """Flush the queued memories and spill all the shards to disk."""
+        self.flush()
+        self.shards.close()
+
+    def _add_memory(self, shard_id: str, memory_content: str) -> list[str]:
+        # the shard is pinned (so that it is not spilled) rather than locked while the LLM scores the importance of the
+        # memory and the memory is embedded - the lock is only held while the memory is written
+        with self.shards.pinned(shard_id) as memory:
+            importance_score, embedding = memory.score_memory(memory_content)
+            with self.shards.lock(shard_id):
+                return memory.add_scored_memory(memory_content, importance_score, embedding)
+
+    def _fetch_memories(self, shard_id: str, observation: str) -> list[Document]:
+        with self.shards.lock(shard_id):
+            return self.shards.get(shard_id).fetch_memories(observation)
+
+    def _drain_write_queue(self, shard_id: str) -> None:
+        while True:
+            with self._condition:
+                write_queue = self._write_queues[shard_id]
+                if not write_queue:
+                    del self._write_queues[shard_id]
+                    return
+                memory_content = write_queue[0]
+
+            self._add_queued_memory(shard_id, memory_content)
+
+            with self._condition:
+                write_queue.popleft()
+                self._pending_writes -= 1
+                self._condition.notify_all()
+
+    def _add_queued_memory(self, shard_id: str, memory_content: str) -> None:
+        for attempt in range(1, self.write_attempts + 1):
+            try:
+                self._add_memory(shard_id, memory_content)
+                return
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # the write was acknowledged long ago, so there is no one to raise the error to
+                self.last_write_error = exc
+                if attempt < self.write_attempts:
+                    print(
+                        f"MEMORY: adding a memory to {shard_id} failed ({exc}), "
+                        f"attempt {attempt} of {self.write_attempts}"
+                    )
+                    time.sleep(self.retry_delay_seconds * attempt)
+                else:
+                    with self._condition:
+                        self.failed_writes += 1
+                    print(f"MEMORY: giving up on a memory of {shard_id}, {self.failed_writes} memories failed so far")
+                    traceback.print_exc()
@@ -0,0 +1,113 @@
+"""Memoizing the results of sub-bots within a tool session, so that composed bots don't redo the same upstream work."""
+import asyncio
+import contextlib
+import contextvars
+from typing import Any, Callable, NamedTuple
+
+from mergedbots import MergedBot, MergedMessage
+
+
+class BotCallCache:
+    """
+    The final responses of sub-bots keyed by the channel, the handle of the bot and the content of the request (or a
+    custom key, for bots whose response does not depend on the request). Concurrent calls with the same key share one
+    call of the bot. Failed calls are not cached.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._responses: dict[tuple[str, str, Any], asyncio.Future] = {}
+
+    async def get_final_response(
+        self,
+        bot: MergedBot,
+        message: MergedMessage,
+        channel_id: str,
+        key: Any = None,
+        is_valid: Callable[[MergedMessage], bool] | None = None,
+    ) -> MergedMessage:
+        """
+        The memoized final response of the bot to the message. `is_valid` (if given) decides whether a cached response
+        can still be used.
+        """
+        cache_key = (channel_id, bot.handle, message.content if key is None else key)
+        future = self._responses.get(cache_key)
+        # only successful calls stay in the cache, so a future that is done has a result
+        if future is not None and (not future.done() or is_valid is None or is_valid(future.result())):
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._responses[cache_key] = future
+        try:
+            response = await bot.get_final_response(message)
+        except asyncio.CancelledError:
+            self._forget(cache_key, future)
+            future.cancel()
+            raise
+        except Exception as exc:
+            self._forget(cache_key, future)
+            future.set_exception(exc)
+            # mark the exception as retrieved - it is re-raised below and, possibly, by the concurrent callers
+            future.exception()
+            raise
+        future.set_result(response)
+        return response
+
+    def _forget(self, cache_key: tuple, future: asyncio.Future) -> None:
+        if self._responses.get(cache_key) is future:
+            del self._responses[cache_key]
+
+
+class _BotCallSession(NamedTuple):
+    cache: BotCallCache
+    channel_id: str
+    final_responses_only: bool
+
+
+_bot_call_session: contextvars.ContextVar[_BotCallSession | None] = contextvars.ContextVar(
+    "bot_call_session", default=None
+)
+
+
+@contextlib.contextmanager
+def bot_call_session(cache: BotCallCache, channel_id: str, final_responses_only: bool = False):
+    """
+    Memoize the sub-bot calls made within the block (see `memoized_final_response()`) in `cache`, under `channel_id`.
+    With `final_responses_only` the bots called within the block skip the interim messages that only serve to show
+    progress (the caller only needs the content of the final response).
+    """
+    token = _bot_call_session.set(_BotCallSession(cache, channel_id, final_responses_only))
+    try:
+        yield
+    finally:
+        _bot_call_session.reset(token)
+
+
+def final_responses_only() -> bool:
+    """Whether the caller only needs the final responses of the bots (see `bot_call_session()`)."""
+    session = _bot_call_session.get()
+    return session is not None and session.final_responses_only
+
+
+def in_bot_call_session() -> bool:
+    """Whether the sub-bot calls are memoized at the moment."""
+    return _bot_call_session.get() is not None
+
+
+async def memoized_final_response(
+    bot: MergedBot,
+    message: MergedMessage,
+    key: Any = None,
+    is_valid: Callable[[MergedMessage], bool] | None = None,
+) -> MergedMessage:
+    """
+    The final response of a sub-bot: memoized within a `bot_call_session()` (see `BotCallCache.get_final_response()`
+    for `key` and `is_valid`), fetched from the bot every time outside of it.
+    """
+    session = _bot_call_session.get()
+    if session is None:
+        return await bot.get_final_response(message)
+    return await session.cache.get_final_response(bot, message, session.channel_id, key=key, is_valid=is_valid)
@@ -1,7 +1,19 @@
 """This module contains the bot manager."""
+import atexit
+import os
+
 from mergedbots import InMemoryBotManager
 
+from experiments.common.sqlite_bot_manager import SQLiteBotManager
+
 FAST_GPT_MODEL = "gpt-3.5-turbo"
 SLOW_GPT_MODEL = "gpt-4"
 
-bot_manager = InMemoryBotManager()
+# set to the path of an SQLite database to keep the messages there instead of keeping all of them in memory
+BOT_MANAGER_DB = os.environ.get("BOT_MANAGER_DB", "")
+
+if BOT_MANAGER_DB:
+    bot_manager = SQLiteBotManager(db_file=BOT_MANAGER_DB)
+    atexit.register(bot_manager.close)
+else:
+    bot_manager = InMemoryBotManager()
@@ -0,0 +1,86 @@
+"""Running the steps of composed bots concurrently without changing the order of their messages."""
+import asyncio
+import os
+from typing import AsyncGenerator, AsyncIterator, Callable, Iterable, NamedTuple
+
+from mergedbots import MergedMessage
+
+COMPOSED_BOTS_CONCURRENCY = os.environ.get("COMPOSED_BOTS_CONCURRENCY", "true").lower() in ("1", "true", "yes")
+
+_STEP_DONE = object()
+
+
+class _Step(NamedTuple):
+    name: str
+    start: Callable[[], AsyncIterator[MergedMessage]]
+    after: tuple[str, ...]
+
+
+class BotSteps:
+    """
+    A composed bot's response as a set of steps (async generators of messages) with dependencies between them. Every
+    step starts as soon as the steps it depends on are finished, so independent steps run concurrently, but the
+    messages are yielded exactly in the order in which they would be yielded if the steps ran one after another in the
+    order of declaration. The messages of a step are available to the steps that depend on it via `outputs`.
+
+    With `concurrent=False` the steps do run one after another.
+    """
+
+    def __init__(self, concurrent: bool = COMPOSED_BOTS_CONCURRENCY) -> None:
+        self.concurrent = concurrent
+        self.outputs: dict[str, list[MergedMessage]] = {}
+        self._steps: list[_Step] = []
+
+    def add(
+        self, name: str, start: Callable[[], AsyncIterator[MergedMessage]], after: Iterable[str] = ()
+    ) -> "BotSteps":
+        """
+        Add a step. `start` is called (with no arguments) to get the async generator of the step once all the steps
+        listed in `after` (which must be declared earlier) are finished.
+        """
+        after = tuple(after)
+        declared = {step.name for step in self._steps}
+        if name in declared:
+            raise ValueError(f"step {name!r} is already declared")
+        if not declared.issuperset(after):
+            raise ValueError(f"step {name!r} depends on steps that are not declared before it: {after}")
+        self._steps.append(_Step(name, start, after))
+        return self
+
+    async def run(self) -> AsyncGenerator[MergedMessage, None]:
+        """Run the steps and yield their messages."""
+        if not self.concurrent:
+            for step in self._steps:
+                self.outputs[step.name] = []
+                async for msg in step.start():
+                    self.outputs[step.name].append(msg)
+                    yield msg
+            return
+
+        done = {step.name: asyncio.Event() for step in self._steps}
+        queues = {step.name: asyncio.Queue() for step in self._steps}
+
+        async def run_step(step: _Step) -> None:
+            try:
+                for dependency in step.after:
+                    await done[dependency].wait()
+                self.outputs[step.name] = []
+                async for msg in step.start():
+                    self.outputs[step.name].append(msg)
+                    queues[step.name].put_nowait(msg)
+                done[step.name].set()
+                queues[step.name].put_nowait(_STEP_DONE)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # the exception is re-raised by `run()` when it reaches the messages of this step
+                queues[step.name].put_nowait(exc)
+
+        tasks = [asyncio.create_task(run_step(step)) for step in self._steps]
+        try:
+            for step in self._steps:
+                while (item := await queues[step.name].get()) is not _STEP_DONE:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
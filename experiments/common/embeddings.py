@@ -0,0 +1,239 @@
+"""An embedding layer that batches, deduplicates and caches embedding requests."""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+
+from experiments.common.vector_indexes import EMBEDDING_SIZE
+
+# "openai" or "fake" (deterministic embeddings derived from text hashes - no API calls, for local testing)
+EMBEDDINGS_BACKEND = os.environ.get("EMBEDDINGS_BACKEND", "openai")
+EMBEDDING_CACHE_FILE = Path(
+    os.environ.get("EMBEDDING_CACHE_FILE", Path.home() / ".cache" / "mergedbots-experiments" / "embeddings.sqlite")
+)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10_000))
+EMBEDDING_BATCH_WINDOW = float(os.environ.get("EMBEDDING_BATCH_WINDOW", 0.02))
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 100))
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic unit-norm pseudo-embeddings seeded by the hash of the text (no semantics whatsoever)."""
+
+    def __init__(self, size: int = EMBEDDING_SIZE) -> None:
+        self.size = size
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class EmbeddingCache:
+    """An in-memory LRU of embeddings in front of an (optional) SQLite store, keyed by content hashes."""
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE, cache_file: str | Path | None = None) -> None:
+        self.max_size = max_size
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if cache_file:
+            Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(cache_file, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Look the keys up (first in RAM, then on disk); the keys that are not cached are omitted from the result."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    found[key] = vector
+
+            missing = [key for key in keys if key not in found]
+            if missing and self._db:
+                placeholders = ",".join("?" * len(missing))
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", missing
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    self._put_in_lru(key, found[key])
+        return found
+
+    def put_many(self, vectors: dict[str, list[float]]) -> None:
+        """Cache embeddings both in RAM and on disk."""
+        with self._lock:
+            for key, vector in vectors.items():
+                self._put_in_lru(key, vector)
+            if self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()],
+                )
+                self._db.commit()
+
+    def _put_in_lru(self, key: str, vector: list[float]) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+
+class EmbeddingService(Embeddings):
+    """
+    Wraps an embedding model so that:
+
+    - identical texts are embedded only once (the embeddings are cached by the hash of the model name and the text);
+    - texts that are requested concurrently (from different threads) within `batch_window` seconds are sent to the
+      model as a single batch (of no more than `max_batch_size` texts) - unless only one caller is waiting, then its
+      texts are sent right away (as are the texts that pile up while a batch is being embedded);
+    - a text that is already being embedded is not requested again, the second caller waits for the first request.
+
+    It is thread-safe and can be used anywhere an `Embeddings` object (or its `embed_query` function) is expected. On
+    the event loop use `aembed_query()`/`aembed_documents()`, which don't block it.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: EmbeddingCache | None = None,
+        batch_window: float = EMBEDDING_BATCH_WINDOW,
+        max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+    ) -> None:
+        self.embeddings = embeddings
+        self.cache = cache or EmbeddingCache()
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.model_name = getattr(embeddings, "model", type(embeddings).__name__)
+        self.texts_requested = 0
+        self.texts_embedded = 0
+        self.batches_sent = 0
+        self._condition = threading.Condition()
+        self._queue: deque[tuple[str, str, Future]] = deque()
+        self._in_flight: dict[str, Future] = {}
+        # how many callers have texts in the queue (the batch window is only worth waiting for if there are several)
+        self._queued_callers = 0
+        self._worker: threading.Thread | None = None
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, futures = self._request(texts)
+        for key, future in futures.items():
+            vectors[key] = future.result()
+        return [vectors[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """`embed_query()` that waits for the embedding without blocking the event loop."""
+        return (await self.aembed_documents([text]))[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """`embed_documents()` that waits for the embeddings without blocking the event loop."""
+        keys, vectors, futures = self._request(texts)
+        for key, future in futures.items():
+            vectors[key] = await asyncio.wrap_future(future)
+        return [vectors[key] for key in keys]
+
+    def _request(self, texts: list[str]) -> tuple[list[str], dict[str, list[float]], dict[str, Future]]:
+        """Look the texts up in the cache and queue the missing ones (returns their keys, vectors and futures)."""
+        keys = [self._cache_key(text) for text in texts]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+
+        futures = {}
+        with self._condition:
+            self.texts_requested += len(texts)
+            queued = False
+            for key, text in zip(keys, texts):
+                if key in vectors or key in futures:
+                    continue
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = Future()
+                    self._in_flight[key] = future
+                    self._queue.append((key, text, future))
+                    queued = True
+                futures[key] = future
+            if queued:
+                self._queued_callers += 1
+            if self._queue:
+                self._ensure_worker()
+                self._condition.notify()
+        return keys, vectors, futures
+
+    def _cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._work, name="embedding-batcher", daemon=True)
+            self._worker.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                # give concurrent callers a chance to join the batch (a lone caller is not kept waiting for them)
+                deadline = time.monotonic() + self.batch_window
+                while (
+                    self._queued_callers > 1
+                    and len(self._queue) < self.max_batch_size
+                    and (timeout := deadline - time.monotonic()) > 0
+                ):
+                    self._condition.wait(timeout)
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+                if not self._queue:
+                    self._queued_callers = 0
+
+            try:
+                batch_vectors = self.embeddings.embed_documents([text for _, text, _ in batch])
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                with self._condition:
+                    for key, _, future in batch:
+                        self._in_flight.pop(key, None)
+                for _, _, future in batch:
+                    future.set_exception(exc)
+                continue
+
+            self.cache.put_many({key: vector for (key, _, _), vector in zip(batch, batch_vectors)})
+            with self._condition:
+                self.texts_embedded += len(batch)
+                self.batches_sent += 1
+                for key, _, _ in batch:
+                    self._in_flight.pop(key, None)
+            for (_, _, future), vector in zip(batch, batch_vectors):
+                future.set_result(vector)
+
+
+_embedding_service: EmbeddingService | None = None
+_embedding_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """The process-wide embedding service (created on first use, the backend is chosen by EMBEDDINGS_BACKEND)."""
+    global _embedding_service  # pylint: disable=global-statement
+    with _embedding_service_lock:
+        if _embedding_service is None:
+            if EMBEDDINGS_BACKEND == "fake":
+                _embedding_service = EmbeddingService(HashEmbeddings(), EmbeddingCache())
+            else:
+                _embedding_service = EmbeddingService(
+                    OpenAIEmbeddings(), EmbeddingCache(cache_file=EMBEDDING_CACHE_FILE)
+                )
+        return _embedding_service
@@ -0,0 +1,49 @@
+"""Thread pools for blocking work that needs to be awaited without blocking the event loop."""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+DISK_IO_WORKERS = int(os.environ.get("DISK_IO_WORKERS", min(16, (os.cpu_count() or 1) + 4)))
+# memory operations mostly wait for LLM and embedding API calls, hence the pool does not depend on the number of CPUs
+MEMORY_WORKERS = int(os.environ.get("MEMORY_WORKERS", 8))
+
+
+class BoundedExecutor:
+    """
+    A thread pool with backpressure: no more than `max_pending` jobs are allowed to be running or queued at the same
+    time, the rest of the callers wait (asynchronously) for their turn before their jobs are even submitted. Context
+    variables of the caller are propagated to the worker thread.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int | None = None, thread_name_prefix: str = "") -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending or max_workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._semaphore: asyncio.Semaphore | None = None
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run a blocking function in the pool and wait for the result."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        context = contextvars.copy_context()
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(context.run, func, *args, **kwargs)
+            )
+
+    def submit(self, func: Callable[..., T], *args: Any, **kwargs: Any):
+        """Submit a blocking function to the pool without waiting for a slot (for callers outside the event loop)."""
+        return self._executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Shut the pool down (by default waits for the jobs that were already submitted)."""
+        self._executor.shutdown(wait=wait)
+
+
+disk_io_executor = BoundedExecutor(max_workers=DISK_IO_WORKERS, thread_name_prefix="disk-io")
+memory_executor = BoundedExecutor(max_workers=MEMORY_WORKERS, thread_name_prefix="memory")
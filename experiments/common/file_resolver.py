@@ -0,0 +1,125 @@
+"""Resolving file paths mentioned in free-form requests without asking an LLM."""
+import difflib
+import re
+import threading
+from collections import defaultdict
+from typing import Iterable
+
+# anything that looks like a file name or a path (has an extension or at least one slash, or is a dotfile)
+PATH_TOKEN_REGEX = re.compile(r"(?:[\w\-.~/\\]*[\w\-](?:[/\\]|\.[\w\-]+)|(?<![\w.])\.[\w\-]+)[\w\-.~/\\]*")
+FUZZY_CUTOFF = 0.85
+
+
+class FilePathResolver:
+    """
+    Finds the file a request refers to among the files of a repo. The resolver tries exact path matches first, then
+    path suffix matches (e.g. `common/bot_manager.py`) and only then fuzzy matches of the file name. The lookups go
+    through an index of file names, so their cost does not depend on the size of the repo (except for the fuzzy
+    fallback).
+    """
+
+    def __init__(self, file_list: Iterable[str]) -> None:
+        self.file_set = set(file_list)
+        self._by_basename: dict[str, list[str]] = defaultdict(list)
+        for file_path in self.file_set:
+            self._by_basename[file_path.rpartition("/")[2].lower()].append(file_path)
+
+    def resolve(self, request: str) -> tuple[str | None, list[str]]:
+        """
+        Returns the path of the file if the request unambiguously refers to one (None otherwise) along with the list
+        of candidates that were considered.
+        """
+        tokens = [_normalize_token(token) for token in PATH_TOKEN_REGEX.findall(request)]
+        tokens = [token for token in tokens if token]
+
+        exact_matches = {token for token in tokens if token in self.file_set}
+        if len(exact_matches) == 1:
+            return exact_matches.pop(), []
+        if exact_matches:
+            return None, sorted(exact_matches)
+
+        suffix_matches = set()
+        for token in tokens:
+            suffix_matches.update(self._match_suffix(token))
+        if len(suffix_matches) == 1:
+            return suffix_matches.pop(), []
+        if suffix_matches:
+            return None, sorted(suffix_matches)
+
+        fuzzy_matches = set()
+        for token in tokens:
+            basename = token.rpartition("/")[2].lower()
+            for close_basename in difflib.get_close_matches(basename, self._by_basename, n=3, cutoff=FUZZY_CUTOFF):
+                fuzzy_matches.update(self._by_basename[close_basename])
+        if len(fuzzy_matches) == 1:
+            return fuzzy_matches.pop(), []
+        return None, sorted(fuzzy_matches)
+
+    def _match_suffix(self, token: str) -> list[str]:
+        token_lower = token.lower()
+        return [
+            file_path
+            for file_path in self._by_basename.get(token_lower.rpartition("/")[2], ())
+            if file_path.lower() == token_lower or file_path.lower().endswith(f"/{token_lower}")
+        ]
+
+
+class FileResolutionStats:
+    """Hit rate of the resolver and the time it saved by not calling the LLM."""
+
+    def __init__(self) -> None:
+        self.resolver_hits = 0
+        self.llm_fallbacks = 0
+        self.resolver_seconds = 0.0
+        self.llm_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_hit(self, seconds: float) -> None:
+        """Record a request that the resolver managed to resolve on its own."""
+        with self._lock:
+            self.resolver_hits += 1
+            self.resolver_seconds += seconds
+
+    def record_llm_fallback(self, resolver_seconds: float, llm_seconds: float) -> None:
+        """Record a request that had to be resolved by the LLM."""
+        with self._lock:
+            self.llm_fallbacks += 1
+            self.resolver_seconds += resolver_seconds
+            self.llm_seconds += llm_seconds
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of requests that were resolved without the LLM."""
+        total = self.resolver_hits + self.llm_fallbacks
+        return self.resolver_hits / total if total else 0.0
+
+    @property
+    def estimated_seconds_saved(self) -> float:
+        """Resolver hits times the average latency of the LLM calls that did happen, minus the time spent resolving."""
+        if not self.llm_fallbacks:
+            return 0.0
+        return self.resolver_hits * self.llm_seconds / self.llm_fallbacks - self.resolver_seconds
+
+
+file_resolution_stats = FileResolutionStats()
+
+_resolvers: dict[str, tuple[int, FilePathResolver]] = {}
+_resolvers_lock = threading.Lock()
+
+
+def get_file_path_resolver(repo_dir: str, index_version: int, file_list: Iterable[str]) -> FilePathResolver:
+    """Get a resolver for a repo (a new one is only built when the version of the repo index changes)."""
+    with _resolvers_lock:
+        cached = _resolvers.get(repo_dir)
+        if cached and cached[0] == index_version:
+            return cached[1]
+    resolver = FilePathResolver(file_list)
+    with _resolvers_lock:
+        _resolvers[repo_dir] = (index_version, resolver)
+    return resolver
+
+
+def _normalize_token(token: str) -> str:
+    # `./path/to/file.py.` (e.g. at the end of a sentence) -> `path/to/file.py` (only a leading `./` or `/` is dropped,
+    # the leading dot of a dotfile - `.env`, `.github/workflows/ci.yml` - is part of its name)
+    return token.replace("\\", "/").removeprefix("./").lstrip("/").rstrip("./")
@@ -0,0 +1,102 @@
+"""Keeping the message history of a conversation within a token budget."""
+import bisect
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Sequence
+
+from langchain.schema import BaseMessage
+
+PLAIN_GPT_HISTORY_TOKEN_BUDGET = int(os.environ.get("PLAIN_GPT_HISTORY_TOKEN_BUDGET", 6000))
+AUTOGPT_HISTORY_TOKEN_BUDGET = int(os.environ.get("AUTOGPT_HISTORY_TOKEN_BUDGET", 3000))
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", 4096))
+
+
+def window_start(cumulative_tokens: Sequence[int], token_budget: int, end: int | None = None) -> int:
+    """
+    Find where the window of the most recent messages that fits the token budget starts. `cumulative_tokens[i]` is
+    the number of tokens in the first `i` messages (hence `cumulative_tokens[0] == 0`). The last message is always in
+    the window, even if it alone exceeds the budget.
+    """
+    if end is None:
+        end = len(cumulative_tokens) - 1
+    if not end:
+        return 0
+    start = bisect.bisect_left(cumulative_tokens, cumulative_tokens[end] - token_budget, 0, end)
+    return min(start, end - 1)
+
+
+class CachedTokenCounter:
+    """A token counter that remembers the counts of the texts it has already seen (in an LRU cache)."""
+
+    def __init__(self, token_counter: Callable[[str], int], max_size: int = TOKEN_COUNT_CACHE_SIZE) -> None:
+        self.token_counter = token_counter
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                self.hits += 1
+                return count
+        count = self.token_counter(text)
+        with self._lock:
+            self.misses += 1
+            self._counts[text] = count
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return count
+
+
+class TokenBudgetedHistory:
+    """
+    A message history that hands out only the most recent messages that fit into `token_budget`. The tokens of every
+    message are counted once, when the message is appended, and the messages that can no longer get into the window
+    are eventually dropped, so the history does not grow forever. If `omitted_placeholder` is given, the window is
+    prefixed with the message it returns for the number of omitted messages.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        token_counter: Callable[[str], int],
+        omitted_placeholder: Callable[[int], BaseMessage] | None = None,
+    ) -> None:
+        self.token_budget = token_budget
+        self.token_counter = token_counter
+        self.omitted_placeholder = omitted_placeholder
+        self._messages: list[BaseMessage] = []
+        self._cumulative_tokens = [0]
+        # the number of messages that were dropped from the beginning of the history
+        self._dropped = 0
+
+    def __len__(self) -> int:
+        return self._dropped + len(self._messages)
+
+    def append(self, message: BaseMessage) -> None:
+        """Append a message to the history."""
+        self._messages.append(message)
+        self._cumulative_tokens.append(self._cumulative_tokens[-1] + self.token_counter(message.content))
+
+        # the window never starts earlier than it does now, so the messages before it can be dropped (which is done
+        # once they are the majority, to keep the cost of appending amortized O(1))
+        start = window_start(self._cumulative_tokens, self.token_budget)
+        if start > len(self._messages) // 2:
+            del self._messages[:start]
+            offset = self._cumulative_tokens[start]
+            self._cumulative_tokens = [count - offset for count in self._cumulative_tokens[start:]]
+            self._dropped += start
+
+    def messages(self) -> list[BaseMessage]:
+        """The most recent messages that fit into the token budget."""
+        start = window_start(self._cumulative_tokens, self.token_budget)
+        window = self._messages[start:]
+        omitted = self._dropped + start
+        if omitted and self.omitted_placeholder:
+            window.insert(0, self.omitted_placeholder(omitted))
+        return window
@@ -0,0 +1,154 @@
+"""A cheap local router that picks a bot for a message before (or instead of) asking an LLM."""
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import NamedTuple
+
+ROUTER_CONFIDENCE_THRESHOLD = float(os.environ.get("ROUTER_CONFIDENCE_THRESHOLD", 0.15))
+ROUTER_MIN_SIMILARITY = float(os.environ.get("ROUTER_MIN_SIMILARITY", 0.2))
+ROUTER_STICKINESS_SECONDS = float(os.environ.get("ROUTER_STICKINESS_SECONDS", 10 * 60))
+
+WORD_REGEX = re.compile(r"[a-z0-9']+")
+STOP_WORDS = frozenset(
+    (
+        "a an and are as at be but by can do for from has have i if in is it its me my of on or so that the this to "
+        "was we what when which who will with you your"
+    ).split()
+)
+
+
+def text_features(text: str) -> dict[str, float]:
+    """Unit-norm bag of words and word bigrams of a text."""
+    words = [word for word in WORD_REGEX.findall(text.lower()) if word not in STOP_WORDS]
+    features = Counter(words)
+    features.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+    norm = math.sqrt(sum(count * count for count in features.values()))
+    return {feature: count / norm for feature, count in features.items()} if norm else {}
+
+
+class RoutingDecision(NamedTuple):
+    """The chosen bot (None if the router is not confident enough) and how the choice was made."""
+
+    bot_handle: str | None
+    tier: str
+    confidence: float = 0.0
+
+
+class RoutingStats:
+    """How many messages were routed by each tier and how long routing took."""
+
+    def __init__(self) -> None:
+        self.decisions: Counter[str] = Counter()
+        self.seconds: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, tier: str, seconds: float) -> None:
+        """Record a routing decision."""
+        with self._lock:
+            self.decisions[tier] += 1
+            self.seconds[tier] += seconds
+
+    @property
+    def llm_call_rate(self) -> float:
+        """The share of messages that needed an LLM call to be routed."""
+        total = sum(self.decisions.values())
+        return self.decisions["llm"] / total if total else 0.0
+
+    def average_seconds(self, tier: str) -> float:
+        """The average routing latency of a tier."""
+        return self.seconds[tier] / self.decisions[tier] if self.decisions[tier] else 0.0
+
+
+class LexicalRouter:
+    """
+    Routes messages by comparing their lexical features to the centroids of the bots. A centroid starts as the
+    features of the bot description and absorbs the messages that were routed to the bot by the LLM (see `learn()`),
+    so the router gets more confident over time. A decision is made locally only if the best bot is more similar than
+    the runner-up by at least `confidence_threshold`.
+
+    The last decision in a conversation sticks for `stickiness_seconds`: it is reused, unless the classifier is
+    confident that the message belongs to a different bot. Expired decisions are forgotten, so only the conversations
+    of the last `stickiness_seconds` are remembered.
+    """
+
+    def __init__(
+        self,
+        confidence_threshold: float = ROUTER_CONFIDENCE_THRESHOLD,
+        min_similarity: float = ROUTER_MIN_SIMILARITY,
+        stickiness_seconds: float = ROUTER_STICKINESS_SECONDS,
+    ) -> None:
+        self.confidence_threshold = confidence_threshold
+        self.min_similarity = min_similarity
+        self.stickiness_seconds = stickiness_seconds
+        self.stats = RoutingStats()
+        self._centroids: dict[str, Counter[str]] = {}
+        self._centroid_norms: dict[str, float] = {}
+        # conversation key -> (bot handle, when the decision was made), from the oldest to the newest decision
+        self._sticky: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_route(self, bot_handle: str, description: str) -> None:
+        """Make a bot routable (its description seeds its centroid)."""
+        with self._lock:
+            self._centroids[bot_handle] = Counter()
+        self.learn(bot_handle, description)
+
+    def learn(self, bot_handle: str, text: str) -> None:
+        """Pull the centroid of a bot towards a text that is known to belong to it."""
+        with self._lock:
+            centroid = self._centroids.get(bot_handle)
+            if centroid is None:
+                return
+            centroid.update(text_features(text))
+            self._centroid_norms[bot_handle] = math.sqrt(sum(value * value for value in centroid.values()))
+
+    def classify(self, text: str) -> tuple[str | None, float]:
+        """The most similar bot (None if the classifier is not confident) and the confidence (similarity margin)."""
+        features = text_features(text)
+        with self._lock:
+            similarities = sorted(
+                (
+                    (sum(value * centroid.get(feature, 0.0) for feature, value in features.items()) / norm, handle)
+                    for handle, centroid in self._centroids.items()
+                    if (norm := self._centroid_norms.get(handle))
+                ),
+                reverse=True,
+            )
+        if not similarities:
+            return None, 0.0
+        best_similarity, best_handle = similarities[0]
+        confidence = best_similarity - (similarities[1][0] if len(similarities) > 1 else 0.0)
+        if best_similarity < self.min_similarity or confidence < self.confidence_threshold:
+            return None, confidence
+        return best_handle, confidence
+
+    def route(self, conversation_key: str, text: str) -> RoutingDecision:
+        """Route a message locally (the returned bot handle is None if the LLM needs to be consulted)."""
+        bot_handle, confidence = self.classify(text)
+        if bot_handle:
+            return RoutingDecision(bot_handle, "local", confidence)
+
+        with self._lock:
+            self._forget_expired()
+            sticky = self._sticky.get(conversation_key)
+        if sticky:
+            return RoutingDecision(sticky[0], "sticky", confidence)
+        return RoutingDecision(None, "llm", confidence)
+
+    def remember(self, conversation_key: str, bot_handle: str) -> None:
+        """Remember the decision made for a conversation (it will stick for `stickiness_seconds`)."""
+        with self._lock:
+            if bot_handle not in self._centroids:
+                return
+            self._sticky[conversation_key] = (bot_handle, time.monotonic())
+            self._sticky.move_to_end(conversation_key)
+            self._forget_expired()
+
+    def _forget_expired(self) -> None:
+        """Drop the decisions that no longer stick (the caller holds the lock)."""
+        expired_before = time.monotonic() - self.stickiness_seconds
+        while self._sticky and next(iter(self._sticky.values()))[1] <= expired_before:
+            self._sticky.popitem(last=False)
@@ -0,0 +1,161 @@
+"""An exact-match cache of the responses to deterministic (temperature 0) LLM requests."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Any, NamedTuple
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# set to an empty string to keep the cache in RAM only
+LLM_CACHE_FILE = os.environ.get(
+    "LLM_CACHE_FILE", str(Path.home() / ".cache" / "mergedbots-experiments" / "llm-responses.sqlite")
+)
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", 2048))
+LLM_CACHE_TTL_SECONDS = float(os.environ.get("LLM_CACHE_TTL_SECONDS", 24 * 60 * 60))
+
+
+class CachePolicy(NamedTuple):
+    """
+    Opts the LLM requests of a bot into the response cache (see `llm_request()`). `label` is what the hits and misses
+    are counted under. The responses cached under a `scope` (e.g. a repo) are dropped once a request comes with a newer
+    `scope_version` (e.g. the version of the file index of the repo).
+    """
+
+    label: str
+    scope: str = ""
+    scope_version: int = 0
+
+
+class _CachedResponse(NamedTuple):
+    content: str
+    scope: str
+    scope_version: int
+    created_at: float
+
+
+class ResponseCache:
+    """
+    LLM responses keyed by the hash of everything that determines them (the model, the rendered prompt, the stop
+    sequences and `max_tokens`): an in-memory LRU in front of an (optional) SQLite store. Responses expire after
+    `ttl_seconds`. Scope versions (e.g. the versions of repo indexes) only mean something within the process, hence
+    the responses that belong to a scope are kept in RAM only.
+    """
+
+    def __init__(
+        self,
+        max_size: int = LLM_CACHE_SIZE,
+        cache_file: str | Path | None = None,
+        ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+        self._lru: OrderedDict[str, _CachedResponse] = OrderedDict()
+        # scope -> the latest version of the scope seen so far
+        self._scope_versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if cache_file:
+            Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(cache_file, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(model: str, message_dicts: list[dict[str, Any]], stop: list[str] | None, max_tokens: int | None) -> str:
+        """The cache key of a request."""
+        request = json.dumps([model, message_dicts, stop, max_tokens], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, policy: CachePolicy) -> str | None:
+        """Look a response up (first in RAM, then on disk) and count the hit or the miss under the label."""
+        with self._lock:
+            self._see_scope_version(policy)
+            response = self._lru.get(key)
+            if response is None and self._db and not policy.scope:
+                row = self._db.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row:
+                    response = _CachedResponse(row[0], "", 0, row[1])
+                    self._put_in_lru(key, response)
+
+            if response is not None and not self._is_fresh(response):
+                self._delete(key)
+                response = None
+            if response is None:
+                self.misses[policy.label] += 1
+                return None
+            self._lru.move_to_end(key)
+            self.hits[policy.label] += 1
+            return response.content
+
+    def put(self, key: str, content: str, policy: CachePolicy) -> None:
+        """Cache a response (unless it was produced for a scope version that is already outdated)."""
+        with self._lock:
+            self._see_scope_version(policy)
+            if policy.scope_version < self._scope_versions.get(policy.scope, 0):
+                return
+            response = _CachedResponse(content, policy.scope, policy.scope_version, time.time())
+            self._put_in_lru(key, response)
+            if self._db and not policy.scope:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response.content, response.created_at)
+                )
+                self._db.commit()
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Hits, misses and hit rate per label."""
+        with self._lock:
+            return {
+                label: {
+                    "hits": self.hits[label],
+                    "misses": self.misses[label],
+                    "hit_rate": self.hits[label] / (self.hits[label] + self.misses[label]),
+                }
+                for label in sorted(set(self.hits) | set(self.misses))
+            }
+
+    def _is_fresh(self, response: _CachedResponse) -> bool:
+        return (
+            time.time() - response.created_at < self.ttl_seconds
+            and response.scope_version >= self._scope_versions.get(response.scope, 0)
+        )
+
+    def _see_scope_version(self, policy: CachePolicy) -> None:
+        """Drop the responses of the scope if the policy comes with a newer version of it."""
+        if not policy.scope or policy.scope_version <= self._scope_versions.get(policy.scope, 0):
+            return
+        self._scope_versions[policy.scope] = policy.scope_version
+        for key in [key for key, response in self._lru.items() if not self._is_fresh(response)]:
+            del self._lru[key]
+
+    def _delete(self, key: str) -> None:
+        self._lru.pop(key, None)
+        if self._db:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _put_in_lru(self, key: str, response: _CachedResponse) -> None:
+        self._lru[key] = response
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+
+_response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """The process-wide LLM response cache (created on first use)."""
+    global _response_cache  # pylint: disable=global-statement
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(cache_file=LLM_CACHE_FILE or None)
+        return _response_cache
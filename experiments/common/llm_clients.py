@@ -0,0 +1,304 @@
+"""
+A process-wide registry of chat LLM clients. The clients are shared by all the bots and all the conversations, hence
+per-call data (the end user and the PromptLayer tags) is not stored in them - it is passed with `llm_request()`.
+"""
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import os
+import threading
+from typing import Any, Awaitable, NamedTuple, TypeVar
+
+import aiohttp
+import openai
+from langchain.chat_models import ChatOpenAI, PromptLayerChatOpenAI
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from experiments.common.llm_cache import LLM_CACHE_ENABLED, CachePolicy, get_response_cache
+from experiments.common.llm_scheduler import LLMPriority, llm_scheduler
+from experiments.common.transcripts import count_tokens
+
+T = TypeVar("T")
+
+LLM_HTTP_POOL_SIZE = int(os.environ.get("LLM_HTTP_POOL_SIZE", 100))
+LLM_HTTP_KEEPALIVE_SECONDS = float(os.environ.get("LLM_HTTP_KEEPALIVE_SECONDS", 60))
+# how many completion tokens to reserve for a request that has no `max_tokens`
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.environ.get("LLM_COMPLETION_TOKENS_ESTIMATE", 500))
+
+
+class LLMRequestContext(NamedTuple):
+    """Per-call data of LLM requests."""
+
+    user: str | None = None
+    pl_tags: tuple[str, ...] = ()
+    priority: LLMPriority = LLMPriority.USER_FACING
+    cache: CachePolicy | None = None
+
+
+_llm_request_context: contextvars.ContextVar[LLMRequestContext] = contextvars.ContextVar(
+    "llm_request_context", default=LLMRequestContext()
+)
+
+
+@contextlib.contextmanager
+def llm_request(
+    user: str | None = None,
+    pl_tags: list[str] | None = None,
+    priority: LLMPriority | None = None,
+    cache: CachePolicy | None = None,
+):
+    """
+    Set the end user, the PromptLayer tags, the scheduling priority and the response cache policy of the LLM requests
+    made within the block (including the ones made by the worker threads of a `BoundedExecutor` and the asyncio tasks
+    that are started within the block). The tags are added to the tags of the enclosing block, the rest overrides the
+    enclosing settings. Only the requests with a cache policy are cached (and only if they are deterministic).
+    """
+    enclosing = _llm_request_context.get()
+    token = _llm_request_context.set(
+        LLMRequestContext(
+            user or enclosing.user,
+            enclosing.pl_tags + tuple(pl_tags or ()),
+            enclosing.priority if priority is None else priority,
+            cache or enclosing.cache,
+        )
+    )
+    try:
+        yield
+    finally:
+        _llm_request_context.reset(token)
+
+
+async def in_llm_request(
+    awaitable: Awaitable[T],
+    user: str | None = None,
+    pl_tags: list[str] | None = None,
+    priority: LLMPriority | None = None,
+    cache: CachePolicy | None = None,
+) -> T:
+    """
+    Await something within `llm_request()`. Unlike a `with` block in an async generator, the context does not leak
+    into the consumer of the generator at `yield`.
+    """
+    with llm_request(user=user, pl_tags=pl_tags, priority=priority, cache=cache):
+        return await awaitable
+
+
+# one connection pool per event loop (aiohttp sessions can't be shared between loops)
+_http_sessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+
+def _use_shared_http_session() -> None:
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        for other_loop in [other_loop for other_loop in _http_sessions if other_loop.is_closed()]:
+            del _http_sessions[other_loop]
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=LLM_HTTP_POOL_SIZE, keepalive_timeout=LLM_HTTP_KEEPALIVE_SECONDS)
+        )
+        _http_sessions[loop] = session
+    # `openai.aiosession` is a context variable, so this only affects the current task
+    openai.aiosession.set(session)
+
+
+async def close_http_sessions() -> None:
+    """Close the connection pool of the current event loop."""
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class _StreamWatch:
+    """A run manager wrapper that notices when the first token of a streamed response arrives."""
+
+    def __init__(self, run_manager: Any) -> None:
+        self.run_manager = run_manager
+        self.started = False
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        self.started = True
+        return self.run_manager.on_llm_new_token(token, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.run_manager, name)
+
+
+def _used_tokens(result: ChatResult) -> int | None:
+    return ((result.llm_output or {}).get("token_usage") or {}).get("total_tokens")
+
+
+class SharedChatOpenAI(PromptLayerChatOpenAI):
+    """
+    A `PromptLayerChatOpenAI` that takes the end user and the PromptLayer tags from `llm_request()` (in addition to
+    its own `pl_tags`) and sends its async requests through a connection pool that is shared by all the clients
+    (synchronous requests are already pooled by `openai` - per thread).
+
+    The requests go out when `llm_scheduler` allows it (with the priority from `llm_request()`), and it is the
+    scheduler that retries them. A streamed response is only retried if it failed before its first token. The time a
+    request spent in the queue ends up in the `generation_info` of its generations (`queue_wait_seconds`).
+
+    Deterministic requests (temperature 0, no streaming, a single completion) are answered from the response cache if
+    `llm_request()` gives them a cache policy. Cached responses are marked with `cached` in their `generation_info`.
+    """
+
+    @property
+    def _default_params(self) -> dict[str, Any]:
+        params = super()._default_params
+        user = _llm_request_context.get().user
+        if user:
+            params["user"] = user
+        return params
+
+    def _generate(
+        self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager: Any = None
+    ) -> ChatResult:
+        # pylint: disable=import-outside-toplevel
+        from promptlayer.utils import get_api_key, promptlayer_api_request
+
+        context = _llm_request_context.get()
+        cache_key = self._response_cache_key(messages, stop, context.cache)
+        if cache_key and (content := get_response_cache().get(cache_key, context.cache)) is not None:
+            return self._cached_result(content)
+
+        stream_watch = _StreamWatch(run_manager) if run_manager else None
+        request_start_time = datetime.datetime.now().timestamp()
+        result, queue_wait_seconds = llm_scheduler.run_sync(
+            self.model_name,
+            lambda: ChatOpenAI._generate(self, messages, stop, stream_watch),  # pylint: disable=protected-access
+            tokens=self._estimate_tokens(messages),
+            priority=context.priority,
+            originator=context.user or "",
+            used_tokens=_used_tokens,
+            should_retry=lambda _: not (stream_watch and stream_watch.started),
+        )
+        request_end_time = datetime.datetime.now().timestamp()
+        self._set_queue_wait(result, queue_wait_seconds)
+        if cache_key:
+            get_response_cache().put(cache_key, result.generations[0].message.content, context.cache)
+        for generation, request_args in self._promptlayer_requests(messages, stop, result):
+            self._set_pl_request_id(
+                generation,
+                promptlayer_api_request(
+                    "langchain.PromptLayerChatOpenAI",
+                    *request_args,
+                    request_start_time,
+                    request_end_time,
+                    get_api_key(),
+                    return_pl_id=self.return_pl_id,
+                ),
+            )
+        return result
+
+    async def _agenerate(
+        self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager: Any = None
+    ) -> ChatResult:
+        # pylint: disable=import-outside-toplevel
+        from promptlayer.utils import get_api_key, promptlayer_api_request_async
+
+        context = _llm_request_context.get()
+        cache_key = self._response_cache_key(messages, stop, context.cache)
+        if cache_key and (content := get_response_cache().get(cache_key, context.cache)) is not None:
+            return self._cached_result(content)
+
+        _use_shared_http_session()
+        stream_watch = _StreamWatch(run_manager) if run_manager else None
+        request_start_time = datetime.datetime.now().timestamp()
+        result, queue_wait_seconds = await llm_scheduler.run(
+            self.model_name,
+            lambda: ChatOpenAI._agenerate(self, messages, stop, stream_watch),  # pylint: disable=protected-access
+            tokens=self._estimate_tokens(messages),
+            priority=context.priority,
+            originator=context.user or "",
+            used_tokens=_used_tokens,
+            should_retry=lambda _: not (stream_watch and stream_watch.started),
+        )
+        request_end_time = datetime.datetime.now().timestamp()
+        self._set_queue_wait(result, queue_wait_seconds)
+        if cache_key:
+            get_response_cache().put(cache_key, result.generations[0].message.content, context.cache)
+        for generation, request_args in self._promptlayer_requests(messages, stop, result):
+            self._set_pl_request_id(
+                generation,
+                await promptlayer_api_request_async(
+                    "langchain.PromptLayerChatOpenAI.async",
+                    *request_args,
+                    request_start_time,
+                    request_end_time,
+                    get_api_key(),
+                    return_pl_id=self.return_pl_id,
+                ),
+            )
+        return result
+
+    def _estimate_tokens(self, messages: list[BaseMessage]) -> int:
+        """The number of tokens a request is going to use (for the token budget of the scheduler)."""
+        prompt_tokens = sum(count_tokens(message.content) for message in messages)
+        return prompt_tokens + (self.max_tokens or LLM_COMPLETION_TOKENS_ESTIMATE)
+
+    def _response_cache_key(
+        self, messages: list[BaseMessage], stop: list[str] | None, policy: CachePolicy | None
+    ) -> str | None:
+        """The response cache key of a request (None if the request is not to be cached)."""
+        if policy is None or not LLM_CACHE_ENABLED or self.temperature != 0 or self.streaming or self.n != 1:
+            return None
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        return get_response_cache().key(self.model_name, message_dicts, params.get("stop"), self.max_tokens)
+
+    def _cached_result(self, content: str) -> ChatResult:
+        generation = ChatGeneration(message=AIMessage(content=content), generation_info={"cached": True})
+        return ChatResult(generations=[generation], llm_output={"token_usage": {}, "model_name": self.model_name})
+
+    @staticmethod
+    def _set_queue_wait(result: ChatResult, queue_wait_seconds: float) -> None:
+        for generation in result.generations:
+            if not isinstance(generation.generation_info, dict):
+                generation.generation_info = {}
+            generation.generation_info["queue_wait_seconds"] = queue_wait_seconds
+
+    def _promptlayer_requests(self, messages: list[BaseMessage], stop: list[str] | None, result: ChatResult):
+        """The generations along with the arguments PromptLayer needs to log them (the same ones it gets upstream)."""
+        pl_tags = [*(self.pl_tags or ()), *_llm_request_context.get().pl_tags]
+        message_dicts, _ = self._create_message_dicts(messages, stop)
+        for generation in result.generations:
+            response_dict, params = self._create_message_dicts([generation.message], stop)
+            yield generation, ("langchain", message_dicts, params, pl_tags, response_dict)
+
+    def _set_pl_request_id(self, generation: Any, pl_request_id: Any) -> None:
+        if self.return_pl_id:
+            if not isinstance(generation.generation_info, dict):
+                generation.generation_info = {}
+            generation.generation_info["pl_request_id"] = pl_request_id
+
+
+_chat_llms: dict[tuple, SharedChatOpenAI] = {}
+_chat_llms_lock = threading.Lock()
+
+
+def get_chat_llm(
+    model_name: str,
+    temperature: float = 0.7,
+    stop: list[str] | None = None,
+    streaming: bool = False,
+    max_tokens: int | None = None,
+) -> SharedChatOpenAI:
+    """
+    Get the shared chat LLM client with the given settings (it is created on first use). The user and the PromptLayer
+    tags go to `llm_request()`, callbacks (e.g. for streaming) go to the calls (`agenerate(..., callbacks=...)`,
+    `LLMChain.arun(..., callbacks=...)`) - neither is stored in the client.
+    """
+    key = (model_name, temperature, tuple(stop or ()), streaming, max_tokens)
+    with _chat_llms_lock:
+        chat_llm = _chat_llms.get(key)
+        if chat_llm is None:
+            chat_llm = SharedChatOpenAI(
+                model_name=model_name,
+                temperature=temperature,
+                streaming=streaming,
+                max_tokens=max_tokens,
+                # the retries are done by the scheduler
+                max_retries=1,
+                model_kwargs={"stop": list(stop)} if stop else {},
+            )
+            _chat_llms[key] = chat_llm
+        return chat_llm
@@ -0,0 +1,395 @@
+"""Coordinating the LLM requests of all the bots: per-model budgets, priorities, fairness and retries."""
+import asyncio
+import enum
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Awaitable, Callable, NamedTuple, TypeVar
+
+import openai
+
+from experiments.common.bot_manager import FAST_GPT_MODEL, SLOW_GPT_MODEL
+
+T = TypeVar("T")
+
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 5))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get("LLM_RETRY_BASE_SECONDS", 1))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get("LLM_RETRY_MAX_SECONDS", 60))
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+)
+
+
+class LLMPriority(enum.IntEnum):
+    """Priority classes of LLM requests (a lower value is served first)."""
+
+    USER_FACING = 0
+    AGENT_STEP = 1
+    BACKGROUND = 2
+
+
+class ModelLimits(NamedTuple):
+    """How many requests to a model may run at the same time and how many requests and tokens per minute it takes."""
+
+    max_concurrency: int
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+DEFAULT_MODEL_LIMITS = {
+    FAST_GPT_MODEL: ModelLimits(max_concurrency=32, requests_per_minute=3500, tokens_per_minute=90_000),
+    SLOW_GPT_MODEL: ModelLimits(max_concurrency=8, requests_per_minute=200, tokens_per_minute=40_000),
+}
+FALLBACK_MODEL_LIMITS = ModelLimits(max_concurrency=8, requests_per_minute=200, tokens_per_minute=40_000)
+
+
+def model_limits(model: str) -> ModelLimits:
+    """
+    The limits of a model. Every limit can be overridden with an environment variable, either for all the models (e.g.
+    `LLM_TOKENS_PER_MINUTE`) or for one of them (e.g. `LLM_TOKENS_PER_MINUTE_GPT_4`).
+    """
+    defaults = DEFAULT_MODEL_LIMITS.get(model, FALLBACK_MODEL_LIMITS)
+    suffix = re.sub(r"\W", "_", model).upper()
+
+    def limit(name: str, default: float) -> float:
+        return float(os.environ.get(f"{name}_{suffix}", os.environ.get(name, default)))
+
+    return ModelLimits(
+        max_concurrency=int(limit("LLM_MAX_CONCURRENCY", defaults.max_concurrency)),
+        requests_per_minute=limit("LLM_REQUESTS_PER_MINUTE", defaults.requests_per_minute),
+        tokens_per_minute=limit("LLM_TOKENS_PER_MINUTE", defaults.tokens_per_minute),
+    )
+
+
+class _RateBudget:
+    """A token bucket that refills at `per_minute` units per minute and holds no more than that."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = per_minute
+        self.level = per_minute
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.per_minute, self.level + (now - self._updated_at) * self.per_minute / 60)
+        self._updated_at = now
+
+    def seconds_until(self, amount: float, now: float) -> float:
+        """How long to wait until `amount` can be taken (amounts larger than the bucket wait for a full bucket)."""
+        self._refill(now)
+        amount = min(amount, self.per_minute)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.per_minute
+
+    def take(self, amount: float, now: float) -> None:
+        """Take from the bucket (the level may go below zero, the debt is then paid off by the refill)."""
+        self._refill(now)
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        """Return what was taken but not used (or take more, if `amount` is negative)."""
+        self.level = min(self.per_minute, self.level + amount)
+
+    def drain(self, now: float) -> None:
+        """Empty the bucket (to slow everybody down)."""
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+class LLMTicket:
+    """A request waiting for (or holding) a slot to call a model."""
+
+    def __init__(
+        self, model: str, tokens: int, priority: LLMPriority, originator: str, wake: Callable[[], None]
+    ) -> None:
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.originator = originator
+        self.enqueued_at = time.monotonic()
+        self.granted_at: float | None = None
+        self._wake = wake
+
+    @property
+    def wait_seconds(self) -> float:
+        """For how long the request waited in the queue (or has been waiting so far)."""
+        return (self.granted_at or time.monotonic()) - self.enqueued_at
+
+
+class _ModelState:
+    def __init__(self, limits: ModelLimits) -> None:
+        self.limits = limits
+        self.running = 0
+        self.requests = _RateBudget(limits.requests_per_minute)
+        self.tokens = _RateBudget(limits.tokens_per_minute)
+        # priority -> originator -> tickets (originators are served round-robin within a priority)
+        self.queues: dict[LLMPriority, OrderedDict[str, deque[LLMTicket]]] = {
+            priority: OrderedDict() for priority in LLMPriority
+        }
+
+    def next_queue(self) -> tuple[OrderedDict[str, deque[LLMTicket]], str] | tuple[None, None]:
+        """The queue of the highest priority that has waiting tickets and the originator whose turn it is."""
+        for queue in self.queues.values():
+            if queue:
+                return queue, next(iter(queue))
+        return None, None
+
+
+class LLMScheduler:
+    """
+    Decides when the LLM requests of the whole process go out:
+
+    - every model has a limit of concurrent requests and budgets of requests and tokens per minute (see
+      `model_limits()`); a rate limit error empties the token budget of the model, which slows all its requests down;
+    - waiting requests are served strictly by priority (`LLMPriority`) and, within a priority, round-robin by
+      originator, so one busy conversation can't starve the others;
+    - `run()` retries failed requests with exponential backoff and jitter;
+    - the time every request spent in the queue is measured (see `stats()`).
+
+    The scheduler is thread-safe and can be used both from the event loop (`acquire()`, `run()`) and from worker
+    threads (`acquire_sync()`, `run_sync()`).
+    """
+
+    def __init__(
+        self,
+        get_limits: Callable[[str], ModelLimits] = model_limits,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_base_seconds: float = LLM_RETRY_BASE_SECONDS,
+        retry_max_seconds: float = LLM_RETRY_MAX_SECONDS,
+    ) -> None:
+        self.get_limits = get_limits
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.granted: Counter[tuple[str, LLMPriority]] = Counter()
+        self.wait_seconds: Counter[tuple[str, LLMPriority]] = Counter()
+        self.max_wait_seconds: Counter[tuple[str, LLMPriority]] = Counter()
+        self.retries: Counter[str] = Counter()
+        self._models: dict[str, _ModelState] = {}
+        self._condition = threading.Condition()
+        self._dispatcher: threading.Thread | None = None
+
+    async def acquire(
+        self, model: str, tokens: int, priority: LLMPriority = LLMPriority.USER_FACING, originator: str = ""
+    ) -> LLMTicket:
+        """Wait for a slot to call a model (the ticket must be passed to `release()` once the call is done)."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(model, tokens, priority, originator, wake)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            self._cancel(ticket)
+            raise
+        return ticket
+
+    def acquire_sync(
+        self, model: str, tokens: int, priority: LLMPriority = LLMPriority.USER_FACING, originator: str = ""
+    ) -> LLMTicket:
+        """The blocking version of `acquire()` (for worker threads)."""
+        granted = threading.Event()
+        ticket = self._enqueue(model, tokens, priority, originator, granted.set)
+        granted.wait()
+        return ticket
+
+    def release(self, ticket: LLMTicket, used_tokens: int | None = None) -> None:
+        """Give the slot back (and correct the token budget, if the number of actually used tokens is known)."""
+        with self._condition:
+            state = self._models[ticket.model]
+            state.running -= 1
+            if used_tokens is not None:
+                state.tokens.give_back(ticket.tokens - used_tokens)
+            self._condition.notify_all()
+
+    def rate_limited(self, model: str) -> None:
+        """Let the scheduler know that the API said that the model is being called too often."""
+        with self._condition:
+            self._get_state(model).tokens.drain(time.monotonic())
+
+    async def run(
+        self,
+        model: str,
+        call: Callable[[], Awaitable[T]],
+        tokens: int,
+        priority: LLMPriority = LLMPriority.USER_FACING,
+        originator: str = "",
+        used_tokens: Callable[[T], int | None] | None = None,
+        should_retry: Callable[[Exception], bool] | None = None,
+    ) -> tuple[T, float]:
+        """
+        Call a model when the scheduler allows it, retrying on errors that are worth retrying (and that pass
+        `should_retry`, if it is given). Returns the result and the total time spent in the queue.
+        """
+        queue_wait_seconds = 0.0
+        for attempt in itertools.count():
+            ticket = await self.acquire(model, tokens, priority, originator)
+            queue_wait_seconds += ticket.wait_seconds
+            try:
+                result = await call()
+            except RETRYABLE_ERRORS as exc:
+                self.release(ticket)
+                if not self._should_retry(model, exc, attempt, should_retry):
+                    raise
+                await asyncio.sleep(self._backoff_seconds(attempt))
+                continue
+            except BaseException:
+                self.release(ticket)
+                raise
+            self.release(ticket, used_tokens(result) if used_tokens else None)
+            return result, queue_wait_seconds
+        raise AssertionError("unreachable")
+
+    def run_sync(
+        self,
+        model: str,
+        call: Callable[[], T],
+        tokens: int,
+        priority: LLMPriority = LLMPriority.USER_FACING,
+        originator: str = "",
+        used_tokens: Callable[[T], int | None] | None = None,
+        should_retry: Callable[[Exception], bool] | None = None,
+    ) -> tuple[T, float]:
+        """The blocking version of `run()` (for worker threads)."""
+        queue_wait_seconds = 0.0
+        for attempt in itertools.count():
+            ticket = self.acquire_sync(model, tokens, priority, originator)
+            queue_wait_seconds += ticket.wait_seconds
+            try:
+                result = call()
+            except RETRYABLE_ERRORS as exc:
+                self.release(ticket)
+                if not self._should_retry(model, exc, attempt, should_retry):
+                    raise
+                time.sleep(self._backoff_seconds(attempt))
+                continue
+            except BaseException:
+                self.release(ticket)
+                raise
+            self.release(ticket, used_tokens(result) if used_tokens else None)
+            return result, queue_wait_seconds
+        raise AssertionError("unreachable")
+
+    def stats(self) -> dict[str, dict]:
+        """Per model: running and queued requests, retries and queue wait times by priority."""
+        with self._condition:
+            return {
+                model: {
+                    "running": state.running,
+                    "queued": {
+                        priority.name: sum(len(tickets) for tickets in queue.values())
+                        for priority, queue in state.queues.items()
+                    },
+                    "retries": self.retries[model],
+                    "average_wait_seconds": {
+                        priority.name: self.wait_seconds[model, priority] / self.granted[model, priority]
+                        for priority in LLMPriority
+                        if self.granted[model, priority]
+                    },
+                    "max_wait_seconds": {
+                        priority.name: self.max_wait_seconds[model, priority]
+                        for priority in LLMPriority
+                        if self.granted[model, priority]
+                    },
+                }
+                for model, state in self._models.items()
+            }
+
+    def _get_state(self, model: str) -> _ModelState:
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = _ModelState(self.get_limits(model))
+        return state
+
+    def _enqueue(
+        self, model: str, tokens: int, priority: LLMPriority, originator: str, wake: Callable[[], None]
+    ) -> LLMTicket:
+        ticket = LLMTicket(model, tokens, priority, originator, wake)
+        with self._condition:
+            self._get_state(model).queues[priority].setdefault(originator, deque()).append(ticket)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="llm-scheduler", daemon=True)
+                self._dispatcher.start()
+            self._condition.notify_all()
+        return ticket
+
+    def _cancel(self, ticket: LLMTicket) -> None:
+        with self._condition:
+            if ticket.granted_at is None:
+                queue = self._models[ticket.model].queues[ticket.priority]
+                queue[ticket.originator].remove(ticket)
+                if not queue[ticket.originator]:
+                    del queue[ticket.originator]
+                return
+        # the slot was granted right before the cancellation
+        self.release(ticket)
+
+    def _should_retry(
+        self, model: str, exc: Exception, attempt: int, should_retry: Callable[[Exception], bool] | None
+    ) -> bool:
+        if isinstance(exc, openai.error.RateLimitError):
+            self.rate_limited(model)
+        if attempt >= self.max_retries or (should_retry and not should_retry(exc)):
+            return False
+        with self._condition:
+            self.retries[model] += 1
+        return True
+
+    def _backoff_seconds(self, attempt: int) -> float:
+        # "equal jitter": at least half of the exponential delay, so that the retries don't come back too early
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _dispatch(self) -> None:
+        with self._condition:
+            while True:
+                wait_seconds = None
+                for model, state in self._models.items():
+                    model_wait_seconds = self._grant(model, state)
+                    if model_wait_seconds is not None:
+                        wait_seconds = min(wait_seconds or model_wait_seconds, model_wait_seconds)
+                self._condition.wait(wait_seconds)
+
+    def _grant(self, model: str, state: _ModelState) -> float | None:
+        """Grant slots to as many waiting tickets as the limits allow (returns how long to wait if budgets ran out)."""
+        while state.running < state.limits.max_concurrency:
+            queue, originator = state.next_queue()
+            if queue is None:
+                return None
+            ticket = queue[originator][0]
+
+            now = time.monotonic()
+            wait_seconds = max(state.requests.seconds_until(1, now), state.tokens.seconds_until(ticket.tokens, now))
+            if wait_seconds > 0:
+                return wait_seconds
+
+            queue[originator].popleft()
+            if queue[originator]:
+                queue.move_to_end(originator)
+            else:
+                del queue[originator]
+            state.requests.take(1, now)
+            state.tokens.take(ticket.tokens, now)
+            state.running += 1
+            ticket.granted_at = now
+            self.granted[model, ticket.priority] += 1
+            self.wait_seconds[model, ticket.priority] += ticket.wait_seconds
+            self.max_wait_seconds[model, ticket.priority] = max(
+                self.max_wait_seconds[model, ticket.priority], ticket.wait_seconds
+            )
+            # pylint: disable=protected-access
+            ticket._wake()
+        return None
+
+
+llm_scheduler = LLMScheduler()
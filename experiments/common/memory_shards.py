@@ -0,0 +1,200 @@
+"""Keeping one memory per user while limiting how many of them are loaded at the same time."""
+import contextlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Generic, Iterator, NamedTuple, TypeVar
+
+from experiments.common.memory_store import PersistentFAISS
+
+T = TypeVar("T")
+
+MEMORY_MAX_RESIDENT_SHARDS = int(os.environ.get("MEMORY_MAX_RESIDENT_SHARDS", 32))
+MEMORY_MAX_RESIDENT_BYTES = int(os.environ.get("MEMORY_MAX_RESIDENT_BYTES", 512 * 1024 * 1024))
+MEMORY_SHARD_IDLE_SECONDS = float(os.environ.get("MEMORY_SHARD_IDLE_SECONDS", 15 * 60))
+
+
+class ShardLock:
+    """
+    A `threading.Lock` that can be referenced weakly, so that the locks of the shards no one is using go away on their
+    own instead of piling up (one per user who ever talked to the bots).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.acquire = self._lock.acquire
+        self.release = self._lock.release
+        self.locked = self._lock.locked
+
+    def __enter__(self) -> bool:
+        return self._lock.__enter__()
+
+    def __exit__(self, *exc_info) -> None:
+        self._lock.__exit__(*exc_info)
+
+
+class _ResidentShard(NamedTuple):
+    shard: object
+    store: PersistentFAISS
+    last_used: float
+
+
+class MemoryShardManager(Generic[T]):
+    """
+    Memory shards (e.g. one per user) that are loaded lazily on first access. Shards are kept in LRU order and are
+    spilled to disk (snapshotted and dropped from RAM) when any of the limits is exceeded:
+
+    - more than `max_resident` shards are loaded;
+    - the loaded shards are estimated to take more than `max_resident_bytes`;
+    - a shard was not used for `idle_seconds`.
+
+    The shard that was just requested is never spilled, even if it alone exceeds the byte budget, and neither are the
+    shards whose locks (see `lock()`) are currently held or that are pinned (see `pinned()`).
+
+    Shards are loaded and saved outside of the manager-wide lock, so a slow disk only holds up the users of the shard
+    in question. A shard that is requested while it is still being saved is taken back as it is, not reloaded.
+    """
+
+    def __init__(
+        self,
+        create_shard: Callable[[str], T],
+        get_store: Callable[[T], PersistentFAISS],
+        max_resident: int = MEMORY_MAX_RESIDENT_SHARDS,
+        max_resident_bytes: int = MEMORY_MAX_RESIDENT_BYTES,
+        idle_seconds: float = MEMORY_SHARD_IDLE_SECONDS,
+    ) -> None:
+        self.create_shard = create_shard
+        self.get_store = get_store
+        self.max_resident = max_resident
+        self.max_resident_bytes = max_resident_bytes
+        self.idle_seconds = idle_seconds
+        self._shards: OrderedDict[str, _ResidentShard] = OrderedDict()
+        # (a lock is only kept while someone holds a reference to it - a shard whose lock is gone is not in use)
+        self._shard_locks: weakref.WeakValueDictionary[str, ShardLock] = weakref.WeakValueDictionary()
+        # the shards that were dropped from RAM but are still being saved
+        self._spilling: dict[str, _ResidentShard] = {}
+        # only one thread loads a given shard from disk at a time (the lock goes away once the loads are over)
+        self._load_locks: weakref.WeakValueDictionary[str, ShardLock] = weakref.WeakValueDictionary()
+        # shard id -> how many `pinned()` blocks keep the shard in RAM
+        self._pins: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, shard_id: str) -> T:
+        """Get a shard, loading it from disk if it is not resident."""
+        shard = self._touch(shard_id)
+        if shard is None:
+            with self._lock:
+                load_lock = self._load_locks.setdefault(shard_id, ShardLock())
+            with load_lock:
+                # another thread might have loaded the shard in the meantime
+                shard = self._touch(shard_id)
+                if shard is None:
+                    shard = self.create_shard(shard_id)
+                    store = self.get_store(shard)
+                    with self._lock:
+                        self._shards[shard_id] = _ResidentShard(shard, store, time.monotonic())
+                        spilled = self._enforce_limits()
+                    self._save(spilled)
+        return shard
+
+    @contextlib.contextmanager
+    def pinned(self, shard_id: str) -> Iterator[T]:
+        """
+        Get a shard and keep it in RAM until the block is left, whether its lock is held or not (e.g. for the whole
+        reflection, LLM calls included) - a shard that is spilled while in use would be loaded again as a second copy.
+        """
+        with self._lock:
+            self._pins[shard_id] = self._pins.get(shard_id, 0) + 1
+        try:
+            yield self.get(shard_id)
+        finally:
+            with self._lock:
+                self._pins[shard_id] -= 1
+                if not self._pins[shard_id]:
+                    del self._pins[shard_id]
+
+    def lock(self, shard_id: str) -> ShardLock:
+        """
+        The lock that serializes operations on a shard (shards are not thread-safe). A shard is not spilled while its
+        lock is held.
+        """
+        with self._lock:
+            return self._shard_locks.setdefault(shard_id, ShardLock())
+
+    def resident_shard_ids(self) -> list[str]:
+        """Ids of the shards that are currently loaded, from the least to the most recently used."""
+        with self._lock:
+            return list(self._shards)
+
+    def resident_bytes(self) -> int:
+        """Estimated amount of memory taken by the loaded shards."""
+        with self._lock:
+            return sum(resident.store.estimated_size_bytes() for resident in self._shards.values())
+
+    def spill(self, shard_id: str) -> None:
+        """Snapshot a shard to disk and drop it from RAM."""
+        with self._lock:
+            resident = self._shards.pop(shard_id, None)
+            spilled = [(shard_id, resident)] if resident else []
+            self._spilling.update(spilled)
+        self._save(spilled)
+
+    def close(self) -> None:
+        """Spill all the shards."""
+        for shard_id in self.resident_shard_ids():
+            self.spill(shard_id)
+
+    def _touch(self, shard_id: str) -> T | None:
+        """Mark a resident (or still being saved) shard as the most recently used one and return it."""
+        with self._lock:
+            resident = self._shards.pop(shard_id, None) or self._spilling.get(shard_id)
+            if resident is None:
+                return None
+            self._shards[shard_id] = resident._replace(last_used=time.monotonic())
+            spilled = self._enforce_limits()
+        self._save(spilled)
+        return resident.shard
+
+    def _enforce_limits(self) -> list[tuple[str, _ResidentShard]]:
+        """Drop the shards that exceed the limits from RAM (the caller saves them, outside of the manager lock)."""
+        now = time.monotonic()
+        # the most recently used shard (the last one) is never spilled
+        candidates = [shard_id for shard_id in list(self._shards)[:-1] if self._is_idle_now(shard_id)]
+        spilled = [
+            (shard_id, self._shards.pop(shard_id))
+            for shard_id in candidates
+            if now - self._shards[shard_id].last_used >= self.idle_seconds
+        ]
+
+        candidates = [shard_id for shard_id in candidates if shard_id in self._shards]
+        total_bytes = sum(resident.store.estimated_size_bytes() for resident in self._shards.values())
+        while candidates and (len(self._shards) > self.max_resident or total_bytes > self.max_resident_bytes):
+            shard_id = candidates.pop(0)
+            resident = self._shards.pop(shard_id)
+            total_bytes -= resident.store.estimated_size_bytes()
+            spilled.append((shard_id, resident))
+
+        self._spilling.update(spilled)
+        return spilled
+
+    def _save(self, spilled: list[tuple[str, _ResidentShard]]) -> None:
+        for shard_id, resident in spilled:
+            try:
+                resident.store.save()
+            finally:
+                with self._lock:
+                    if self._spilling.get(shard_id) is resident:
+                        del self._spilling[shard_id]
+
+    def _is_idle_now(self, shard_id: str) -> bool:
+        if shard_id in self._pins:
+            return False
+        shard_lock = self._shard_locks.get(shard_id)
+        if shard_lock is None:
+            return True
+        if not shard_lock.acquire(blocking=False):
+            return False
+        shard_lock.release()
+        return True
@@ -0,0 +1,294 @@
+"""A FAISS vector store that persists itself to disk, so memories survive restarts without being re-embedded."""
+import base64
+import datetime
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import faiss
+import numpy as np
+from langchain import InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+
+from experiments.common.vector_indexes import EMBEDDING_SIZE, AdaptiveFAISS, create_index
+
+MEMORY_DIR = Path(os.environ.get("MEMORY_DIR", Path.home() / ".cache" / "mergedbots-experiments" / "memory"))
+
+# the log the stores that have no snapshot yet write to (later segments are named after the snapshot they follow)
+_LOG_FILE = "memories.jsonl"
+_SNAPSHOT_META_FILE = "snapshot.json"
+
+
+class PersistentFAISS(AdaptiveFAISS):
+    """
+    A FAISS vector store (migrating to an approximate index as it grows, see `AdaptiveFAISS`) backed by a directory
+    on disk:
+
+    - every added text is appended to an append-only log (`memories.jsonl`) together with its embedding and its
+      metadata (created_at, last_accessed_at, importance etc.), the log is fsync-ed, so an addition is never lost;
+    - every `snapshot_every` additions (and on `save()`) the FAISS index and the docstore are snapshotted - the files
+      are written under temporary names, fsync-ed and atomically renamed, the snapshot metadata file being the commit
+      point; every snapshot starts a new log segment and the segment it covers is deleted, so the log only holds the
+      additions since the latest snapshot;
+    - on `load()` the latest snapshot is read and only the log segment that was written after it is replayed, using
+      the stored embeddings (nothing is ever re-embedded).
+
+    NOTE: Changes of the metadata of existing documents (e.g. `last_accessed_at`) are persisted by snapshots only.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable,
+        index: Any,
+        docstore: InMemoryDocstore,
+        index_to_docstore_id: dict[int, str],
+        store_dir: str | Path,
+        snapshot_every: int = 50,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(embedding_function, index, docstore, index_to_docstore_id, **kwargs)
+        self.store_dir = Path(store_dir)
+        self.snapshot_every = snapshot_every
+        self._lock = threading.RLock()
+        self._additions_since_snapshot = 0
+        self._snapshot_generation = 0
+        self._log_file = _LOG_FILE
+        self._text_bytes = 0
+
+    @classmethod
+    def load(
+        cls,
+        store_dir: str | Path,
+        embeddings: Embeddings,
+        embedding_size: int = EMBEDDING_SIZE,
+        **kwargs: Any,
+    ) -> "PersistentFAISS":
+        """Load the store from a directory (an empty store is created if the directory does not exist yet)."""
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+
+        snapshot_meta = None
+        if (store_dir / _SNAPSHOT_META_FILE).is_file():
+            snapshot_meta = json.loads((store_dir / _SNAPSHOT_META_FILE).read_text(encoding="utf-8"))
+
+        if snapshot_meta:
+            index = faiss.read_index(str(store_dir / snapshot_meta["index_file"]))
+            docstore = InMemoryDocstore(
+                {
+                    doc_id: Document(page_content=doc["text"], metadata=_metadata_from_json(doc["metadata"]))
+                    for doc_id, doc in snapshot_meta["documents"].items()
+                }
+            )
+            index_to_docstore_id = dict(enumerate(snapshot_meta["ids"]))
+        else:
+            index = create_index("flat", embedding_size)
+            docstore = InMemoryDocstore({})
+            index_to_docstore_id = {}
+
+        store = cls(
+            embeddings.embed_query,
+            index,
+            docstore,
+            index_to_docstore_id,
+            store_dir,
+            embed_documents=embeddings.embed_documents,
+            aembed_query=getattr(embeddings, "aembed_query", None),
+            **kwargs,
+        )
+        if snapshot_meta:
+            store._snapshot_generation = snapshot_meta["generation"]
+            # (the snapshots that were taken before the log was segmented point into the one log there was)
+            store._log_file = snapshot_meta.get("log_file", _LOG_FILE)
+        store._replay_log(snapshot_meta["log_offset"] if snapshot_meta else 0)
+        store.maybe_migrate()
+        return store
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[tuple[str, list[float]]],
+        metadatas: list[dict] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        text_embeddings = list(text_embeddings)
+        metadatas = metadatas or [{} for _ in text_embeddings]
+        records = [
+            {"id": str(uuid.uuid4()), "text": text, "embedding": embedding, "metadata": metadata}
+            for (text, embedding), metadata in zip(text_embeddings, metadatas)
+        ]
+        with self._lock:
+            self._append_to_log(records)
+            self._add_records(records)
+            self._additions_since_snapshot += len(records)
+            self.maybe_migrate()
+            if self._additions_since_snapshot >= self.snapshot_every:
+                self.save()
+        return [record["id"] for record in records]
+
+    def save(self) -> None:
+        """Take a snapshot of the index and the docstore (cheap to call when nothing has changed)."""
+        with self._lock:
+            if not self._additions_since_snapshot and self._snapshot_generation:
+                return
+            generation = self._snapshot_generation + 1
+            index_file = f"index-{generation}.faiss"
+            # the additions that come after the snapshot go to a new segment of the log
+            log_file = f"memories-{generation}.jsonl"
+
+            _write_index_atomically(self.index, self.store_dir / index_file)
+
+            ids = [self.index_to_docstore_id[i] for i in range(len(self.index_to_docstore_id))]
+            snapshot_meta = {
+                "generation": generation,
+                "index_file": index_file,
+                "log_file": log_file,
+                "log_offset": 0,
+                "ids": ids,
+                "documents": {
+                    doc_id: {"text": doc.page_content, "metadata": _metadata_to_json(doc.metadata)}
+                    for doc_id, doc in zip(ids, self.documents())
+                },
+            }
+            _write_atomically(self.store_dir / _SNAPSHOT_META_FILE, json.dumps(snapshot_meta))
+
+            # what the previous snapshot and its log segment held is in the new snapshot now
+            if self._snapshot_generation:
+                (self.store_dir / f"index-{self._snapshot_generation}.faiss").unlink(missing_ok=True)
+            (self.store_dir / self._log_file).unlink(missing_ok=True)
+            self._log_file = log_file
+            self._snapshot_generation = generation
+            self._additions_since_snapshot = 0
+
+    def estimated_size_bytes(self) -> int:
+        """A rough estimate of the memory the store occupies (vectors plus texts)."""
+        return self.index.ntotal * self.index.d * 4 + self._text_bytes
+
+    def documents(self) -> list[Document]:
+        """All the documents of the store in the order they were added."""
+        with self._lock:
+            return [self.docstore.search(self.index_to_docstore_id[i]) for i in range(len(self.index_to_docstore_id))]
+
+    def _add_records(self, records: list[dict]) -> None:
+        if not records:
+            return
+        self.index.add(np.array([record["embedding"] for record in records], dtype=np.float32))
+        self.docstore.add(
+            {record["id"]: Document(page_content=record["text"], metadata=record["metadata"]) for record in records}
+        )
+        starting_len = len(self.index_to_docstore_id)
+        for i, record in enumerate(records):
+            self.index_to_docstore_id[starting_len + i] = record["id"]
+            self._text_bytes += len(record["text"])
+
+    def _append_to_log(self, records: list[dict]) -> None:
+        lines = []
+        for record in records:
+            metadata = record["metadata"]
+            lines.append(
+                json.dumps(
+                    {
+                        "id": record["id"],
+                        "text": record["text"],
+                        "embedding": _encode_embedding(record["embedding"]),
+                        "created_at": _to_json_value(metadata.get("created_at")),
+                        "last_accessed_at": _to_json_value(metadata.get("last_accessed_at")),
+                        "importance": metadata.get("importance"),
+                        "metadata": _metadata_to_json(metadata),
+                    }
+                )
+            )
+        with open(self.store_dir / self._log_file, "a", encoding="utf-8") as file:
+            file.write("".join(f"{line}\n" for line in lines))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _replay_log(self, log_offset: int) -> None:
+        log_path = self.store_dir / self._log_file
+        if not log_path.exists():
+            return
+        records = []
+        with open(log_path, "rb+") as file:
+            file.seek(log_offset)
+            complete_end = log_offset
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # a torn write (the process crashed in the middle of appending) - the addition never happened, and
+                    # the partial line is cut off so that the next append doesn't get glued onto it
+                    file.truncate(complete_end)
+                    break
+                complete_end += len(line)
+                try:
+                    log_record = json.loads(line)
+                except ValueError:
+                    print(f"MEMORY STORE: skipping a corrupted line of {log_path}")
+                    continue
+                records.append(
+                    {
+                        "id": log_record["id"],
+                        "text": log_record["text"],
+                        "embedding": _decode_embedding(log_record["embedding"]),
+                        "metadata": _metadata_from_json(log_record["metadata"]),
+                    }
+                )
+        self._add_records(records)
+        self._additions_since_snapshot = len(records)
+
+
+def _encode_embedding(embedding: list[float]) -> str:
+    return base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def _decode_embedding(encoded: str) -> list[float]:
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32).tolist()
+
+
+def _to_json_value(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    return value
+
+
+def _metadata_to_json(metadata: dict) -> dict:
+    return {key: _to_json_value(value) for key, value in metadata.items()}
+
+
+def _metadata_from_json(metadata: dict) -> dict:
+    return {
+        key: datetime.datetime.fromisoformat(value["__datetime__"])
+        if isinstance(value, dict) and "__datetime__" in value
+        else value
+        for key, value in metadata.items()
+    }
+
+
+def _write_atomically(path: Path, content: str) -> None:
+    tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path.parent)
+
+
+def _write_index_atomically(index: Any, path: Path) -> None:
+    tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+    faiss.write_index(index, str(tmp_path))
+    with open(tmp_path, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path.parent)
+
+
+def _fsync_dir(path: Path) -> None:
+    """Make the renames in a directory durable (not supported on Windows, where it is not needed)."""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,142 @@
+"""Keeping large tool outputs out of agent prompts: they are stored as blobs and only their head and tail are shown."""
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional, Type
+
+from langchain.callbacks.manager import AsyncCallbackManagerForToolRun, CallbackManagerForToolRun
+from langchain.tools.base import BaseTool
+from pydantic import BaseModel, Field
+
+from experiments.common.executors import disk_io_executor
+
+BLOB_STORE_DIR = Path(
+    os.environ.get("BLOB_STORE_DIR", Path.home() / ".cache" / "mergedbots-experiments" / "blobs")
+)
+# observations longer than this (in tokens) are compacted (0 disables the compaction)
+OBSERVATION_MAX_TOKENS = int(os.environ.get("OBSERVATION_MAX_TOKENS", 500))
+OBSERVATION_HEAD_CHARS = int(os.environ.get("OBSERVATION_HEAD_CHARS", 800))
+OBSERVATION_TAIL_CHARS = int(os.environ.get("OBSERVATION_TAIL_CHARS", 400))
+BLOB_READ_MAX_CHARS = int(os.environ.get("BLOB_READ_MAX_CHARS", 1500))
+BLOB_HANDLE_LENGTH = 12
+
+
+class BlobStore:
+    """Texts stored on disk under handles derived from their content (storing the same text twice is a no-op)."""
+
+    def __init__(self, blob_dir: str | Path = BLOB_STORE_DIR) -> None:
+        self.blob_dir = Path(blob_dir)
+
+    def put(self, text: str) -> str:
+        """Store a text and return its handle."""
+        handle = hashlib.sha256(text.encode("utf-8")).hexdigest()[:BLOB_HANDLE_LENGTH]
+        path = self._path(handle)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, delete=False) as file:
+                file.write(text)
+            os.replace(file.name, path)
+        return handle
+
+    def read(self, handle: str, offset: int = 0, length: int | None = None) -> tuple[str, int]:
+        """Read a range of characters of a blob; returns the range and the length of the whole blob."""
+        text = self._path(handle).read_text(encoding="utf-8")
+        offset = max(offset, 0)
+        end = len(text) if length is None else offset + max(length, 0)
+        return text[offset:end], len(text)
+
+    def _path(self, handle: str) -> Path:
+        handle = handle.strip().strip("`").lower()
+        if len(handle) != BLOB_HANDLE_LENGTH or any(char not in "0123456789abcdef" for char in handle):
+            raise ValueError(f"invalid blob handle: {handle!r}")
+        return self.blob_dir / handle[:2] / handle
+
+
+class ObservationCompactor:
+    """
+    Replaces observations that are longer than `max_tokens` with their head, their tail and the handle of the blob the
+    whole observation is stored in (see `ReadBlobTool`). Counts how many tokens it saved.
+    """
+
+    def __init__(
+        self,
+        blob_store: BlobStore,
+        token_counter: Callable[[str], int],
+        max_tokens: int = OBSERVATION_MAX_TOKENS,
+        head_chars: int = OBSERVATION_HEAD_CHARS,
+        tail_chars: int = OBSERVATION_TAIL_CHARS,
+    ) -> None:
+        self.blob_store = blob_store
+        self.token_counter = token_counter
+        self.max_tokens = max_tokens
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.compacted_observations = 0
+        self.tokens_saved = 0
+
+    async def compact(self, observation: str) -> str:
+        """The observation itself if it is short enough, its compacted version otherwise."""
+        if not self.max_tokens or len(observation) <= self.head_chars + self.tail_chars:
+            return observation
+        tokens = self.token_counter(observation)
+        if tokens <= self.max_tokens:
+            return observation
+
+        handle = await disk_io_executor.run(self.blob_store.put, observation)
+        omitted = len(observation) - self.head_chars - self.tail_chars
+        compacted = (
+            f"{observation[:self.head_chars]}\n"
+            f"[... {omitted} characters omitted - the whole output ({len(observation)} characters) is stored as blob "
+            f"`{handle}`, use the `{ReadBlobTool.name}` command to read any part of it ...]\n"
+            f"{observation[-self.tail_chars:]}"
+        )
+        self.compacted_observations += 1
+        self.tokens_saved += tokens - self.token_counter(compacted)
+        return compacted
+
+
+class ReadBlobInput(BaseModel):
+    """Input for ReadBlobTool."""
+
+    handle: str = Field(..., description="handle of the blob")
+    offset: int = Field(0, description="character offset to start reading from")
+    length: int = Field(BLOB_READ_MAX_CHARS, description=f"number of characters to read (max {BLOB_READ_MAX_CHARS})")
+
+
+class ReadBlobTool(BaseTool):
+    """Tool that reads a range of a blob that a large output was stored in."""
+
+    name: str = "read_blob"
+    description: str = "Read a part of a large command output that was stored as a blob"
+    args_schema: Type[BaseModel] = ReadBlobInput
+    blob_store: BlobStore
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _run(
+        self,
+        handle: str,
+        offset: int = 0,
+        length: int = BLOB_READ_MAX_CHARS,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        try:
+            text, total = self.blob_store.read(handle, offset, min(length, BLOB_READ_MAX_CHARS))
+        except (OSError, ValueError) as e:
+            return f"Error: {e}"
+        end = offset + len(text)
+        footer = f"[characters {offset}-{end} of {total} of blob `{handle}`"
+        if end < total:
+            footer += f", read again with offset={end} to continue"
+        return f"{text}\n{footer}]"
+
+    async def _arun(
+        self,
+        handle: str,
+        offset: int = 0,
+        length: int = BLOB_READ_MAX_CHARS,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        return await disk_io_executor.run(self._run, handle, offset, length)
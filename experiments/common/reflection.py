@@ -0,0 +1,241 @@
+"""Taking reflection of generative agent memories off the request path."""
+import contextlib
+import datetime
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Optional
+
+from langchain.experimental import GenerativeAgentMemory
+from langchain.schema import Document
+
+from experiments.common.executors import BoundedExecutor
+
+REFLECTION_WORKERS = int(os.environ.get("REFLECTION_WORKERS", 2))
+# reflection waits until there was no user-facing memory activity for this long...
+REFLECTION_IDLE_SECONDS = float(os.environ.get("REFLECTION_IDLE_SECONDS", 2))
+# ...but no longer than this
+REFLECTION_MAX_DELAY_SECONDS = float(os.environ.get("REFLECTION_MAX_DELAY_SECONDS", 5 * 60))
+
+_reflection_context = threading.local()
+
+
+class DeferredReflectionMemory(GenerativeAgentMemory):
+    """
+    A `GenerativeAgentMemory` that does not reflect in the middle of `add_memory` - once the reflection threshold is
+    crossed it asks `reflection_scheduler` to reflect on the `shard_id` shard later (see `reflect()`). Without a
+    scheduler `add_memory` behaves exactly like the one of `GenerativeAgentMemory` (and `add_scored_memory` never
+    leads to reflection).
+    """
+
+    shard_id: str = ""
+    reflection_scheduler: Any = None
+
+    def add_memory(self, memory_content: str, now: Optional[datetime.datetime] = None) -> list[str]:
+        if self.reflection_scheduler is None:
+            return super().add_memory(memory_content, now=now)
+
+        # (during reflection the memory is not locked while the importance is scored and the memory is embedded)
+        importance_score, embedding = self.score_memory(memory_content)
+        with _reflection_lock():
+            return self.add_scored_memory(memory_content, importance_score, embedding, now=now)
+
+    def score_memory(self, memory_content: str) -> tuple[float, list[float]]:
+        """
+        Score the importance of a memory and embed it (an LLM call and an embedding call). The memory doesn't need to
+        be locked meanwhile - the result is to be passed to `add_scored_memory()`.
+        """
+        importance_score = self._score_memory_importance(memory_content)
+        return importance_score, self.memory_retriever.vectorstore.embed_texts([memory_content])[0]
+
+    def add_scored_memory(
+        self,
+        memory_content: str,
+        importance_score: float,
+        embedding: list[float],
+        now: Optional[datetime.datetime] = None,
+    ) -> list[str]:
+        """Add a memory that was scored with `score_memory()` (the memory is only written to here)."""
+        if not _is_reflecting_thread():
+            # the insights of reflection do not count towards the next reflection
+            self.aggregate_importance += importance_score
+        document = Document(page_content=memory_content, metadata={"importance": importance_score})
+        result = self.memory_retriever.add_documents([document], current_time=now, embeddings=[embedding])
+        self._request_reflection_if_needed()
+        return result
+
+    def fetch_memories(self, observation: str, now: Optional[datetime.datetime] = None) -> list[Document]:
+        with _reflection_lock():
+            return super().fetch_memories(observation, now=now)
+
+    def reflect(self, lock: threading.Lock) -> list[str]:
+        """
+        Reflect on the recent memories. `lock` (the lock that guards the memory from concurrent use) is only held while
+        the memory is read or written, not while the LLM is thinking, so the memory stays usable during reflection. The
+        caller has to keep the memory from being spilled in the meantime (see `MemoryShardManager.pinned()`).
+        """
+        with lock:
+            # only the importance accumulated so far is reflected on - what is added in the meantime is kept
+            consumed_importance = self.aggregate_importance
+            self.reflecting = True
+        _reflection_context.lock = lock
+        try:
+            return self.pause_to_reflect()
+        finally:
+            del _reflection_context.lock
+            with lock:
+                self.aggregate_importance = max(self.aggregate_importance - consumed_importance, 0.0)
+                self.reflecting = False
+                self._request_reflection_if_needed()
+
+    def _request_reflection_if_needed(self) -> None:
+        if (
+            self.reflection_scheduler is not None
+            and self.reflection_threshold is not None
+            and self.aggregate_importance > self.reflection_threshold
+            and not self.reflecting
+        ):
+            self.reflection_scheduler.request(self.shard_id)
+
+
+def _is_reflecting_thread() -> bool:
+    return getattr(_reflection_context, "lock", None) is not None
+
+
+def _reflection_lock():
+    lock = getattr(_reflection_context, "lock", None)
+    return lock if lock is not None else contextlib.nullcontext()
+
+
+class ReflectionScheduler:
+    """
+    Collects reflection requests per memory shard and runs them in the background:
+
+    - repeated requests for a shard that is still waiting are coalesced into one reflection;
+    - reflections start only when there was no user-facing activity (see `note_activity()`) for `idle_seconds`, or
+      when a request has been waiting for longer than `max_delay_seconds`;
+    - no more than `max_concurrency` reflections run at the same time (and never two for the same shard).
+    """
+
+    def __init__(
+        self,
+        reflect: Callable[[str], Any],
+        max_concurrency: int = REFLECTION_WORKERS,
+        idle_seconds: float = REFLECTION_IDLE_SECONDS,
+        max_delay_seconds: float = REFLECTION_MAX_DELAY_SECONDS,
+    ) -> None:
+        self.reflect = reflect
+        self.max_concurrency = max_concurrency
+        self.idle_seconds = idle_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.requests_received = 0
+        self.requests_coalesced = 0
+        self.reflections_completed = 0
+        self.reflections_failed = 0
+        self.last_lag_seconds = 0.0
+        self._executor = BoundedExecutor(max_workers=max_concurrency, thread_name_prefix="reflection")
+        self._condition = threading.Condition()
+        # shard id -> when the (first not yet served) reflection was requested
+        self._pending: dict[str, float] = {}
+        self._running: set[str] = set()
+        self._last_activity = 0.0
+        self._closed = False
+        self._dispatcher: threading.Thread | None = None
+
+    def request(self, shard_id: str) -> None:
+        """Ask for a shard to be reflected on."""
+        with self._condition:
+            self.requests_received += 1
+            if shard_id in self._pending:
+                self.requests_coalesced += 1
+                return
+            self._pending[shard_id] = time.monotonic()
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="reflection-dispatcher", daemon=True)
+                self._dispatcher.start()
+            self._condition.notify_all()
+
+    def note_activity(self) -> None:
+        """Let the scheduler know that the system is busy serving users."""
+        self._last_activity = time.monotonic()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of shards waiting for reflection."""
+        return len(self._pending)
+
+    def max_lag_seconds(self) -> float:
+        """For how long the oldest waiting request has been waiting."""
+        with self._condition:
+            if not self._pending:
+                return 0.0
+            return time.monotonic() - min(self._pending.values())
+
+    def stats(self) -> dict[str, Any]:
+        """Queue depth, lag and counters of the scheduler."""
+        return {
+            "queue_depth": self.queue_depth,
+            "running": len(self._running),
+            "max_lag_seconds": self.max_lag_seconds(),
+            "last_lag_seconds": self.last_lag_seconds,
+            "requests_received": self.requests_received,
+            "requests_coalesced": self.requests_coalesced,
+            "reflections_completed": self.reflections_completed,
+            "reflections_failed": self.reflections_failed,
+        }
+
+    def close(self) -> None:
+        """Stop starting new reflections (the ones that are waiting are dropped, the running ones are finished)."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown()
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    shard_id, wait_seconds = self._next_ready()
+                    if shard_id is not None:
+                        break
+                    self._condition.wait(wait_seconds)
+
+                requested_at = self._pending.pop(shard_id)
+                self._running.add(shard_id)
+                self.last_lag_seconds = time.monotonic() - requested_at
+            self._executor.submit(self._reflect, shard_id)
+
+    def _next_ready(self) -> tuple[str | None, float | None]:
+        """The shard to reflect on now (if any) and, if there is none, for how long to wait before checking again."""
+        if len(self._running) >= self.max_concurrency:
+            return None, None
+        waiting = [(requested_at, shard_id) for shard_id, requested_at in self._pending.items()]
+        waiting = [(requested_at, shard_id) for requested_at, shard_id in waiting if shard_id not in self._running]
+        if not waiting:
+            return None, None
+
+        now = time.monotonic()
+        oldest_requested_at, oldest_shard_id = min(waiting)
+        idle_in = self._last_activity + self.idle_seconds - now
+        overdue_in = oldest_requested_at + self.max_delay_seconds - now
+        if idle_in <= 0 or overdue_in <= 0:
+            return oldest_shard_id, None
+        return None, min(idle_in, overdue_in)
+
+    def _reflect(self, shard_id: str) -> None:
+        try:
+            self.reflect(shard_id)
+            failed = False
+        except Exception:  # pylint: disable=broad-exception-caught
+            traceback.print_exc()
+            failed = True
+        with self._condition:
+            self._running.discard(shard_id)
+            if failed:
+                self.reflections_failed += 1
+            else:
+                self.reflections_completed += 1
+            self._condition.notify_all()
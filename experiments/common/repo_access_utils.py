@@ -1,50 +1,126 @@
 """Utility functions for accessing a repository."""
+import mmap
 import os
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional, Type
 
-import magic
 from langchain import tools as lc_tools
 from langchain.callbacks.manager import CallbackManagerForToolRun, AsyncCallbackManagerForToolRun
-from langchain.tools.file_management.utils import BaseFileToolMixin
-from pathspec import pathspec
-
-
-def list_files_in_repo(repo_path: str | Path, additional_gitignore_content: str = "") -> list[Path]:
-    """List all files in a repository, excluding files and directories that are ignored by git."""
-    gitignore_content = f".*\n{additional_gitignore_content}\n{_read_gitignore(repo_path)}"
-    spec = pathspec.PathSpec.from_lines("gitwildmatch", gitignore_content.splitlines())
-
-    file_list = []
-    for root, dirs, files in os.walk(repo_path):
-        root = Path(root)
-        # Remove excluded directories from the list to prevent os.walk from processing them
-        dirs[:] = [d for d in dirs if not spec.match_file((root / d).relative_to(repo_path))]
-
-        for file in files:
-            file_path = root / file
-            rel_file_path = file_path.relative_to(repo_path)
-            if not spec.match_file(rel_file_path) and _is_text_file(file_path):
-                file_list.append(rel_file_path)
-
-    file_list.sort(key=lambda p: (p.as_posix().lower(), p.as_posix()))
-    return file_list
-
-
-def _read_gitignore(repo_path: str | Path) -> str:
-    gitignore_path = Path(repo_path) / ".gitignore"
-    if not gitignore_path.is_file():
-        return ""
-
-    with open(gitignore_path, "r", encoding="utf-8") as file:
-        gitignore_content = file.read()
-    return gitignore_content
-
-
-def _is_text_file(file_path: str | Path):
-    file_mime = magic.from_file(file_path, mime=True)
-    # TODO is this the exhaustive list of mime types that we want to index ?
-    return file_mime.startswith("text/") or file_mime.startswith("application/json")
+from langchain.tools.file_management.utils import INVALID_PATH_TEMPLATE, BaseFileToolMixin, FileValidationError
+from pydantic import BaseModel, Field
+
+from experiments.common.executors import disk_io_executor
+from experiments.common.repo_index import get_repo_index
+
+
+def list_files_in_repo(
+    repo_path: str | Path, additional_gitignore_content: str = "", workers: int | None = None
+) -> list[Path]:
+    """
+    List all files in a repository, excluding files and directories that are ignored by git. The list is served from
+    a persistent index of the repo which is refreshed incrementally (see `RepoIndex` for details). `workers` is the
+    number of threads to scan the repo with (the default is `REPO_WALK_WORKERS`, 1 means a serial scan).
+    """
+    return get_repo_index(repo_path, additional_gitignore_content).list_files(workers=workers)
+
+
+async def alist_files_in_repo(
+    repo_path: str | Path, additional_gitignore_content: str = "", workers: int | None = None
+) -> list[Path]:
+    """An async version of `list_files_in_repo` that does the work in the shared disk I/O thread pool."""
+    return await disk_io_executor.run(list_files_in_repo, repo_path, additional_gitignore_content, workers=workers)
+
+
+READ_CHUNK_SIZE = 16 * 1024
+MMAP_THRESHOLD = 1024 * 1024
+
+
+class FileChunk(NamedTuple):
+    """A chunk of a text file. `next_offset` is the cursor to continue reading from (None if EOF was reached)."""
+
+    content: str
+    offset: int
+    next_offset: int | None
+    file_size: int
+
+
+def read_file_chunk(
+    file_path: str | Path,
+    offset: int = 0,
+    max_bytes: int = READ_CHUNK_SIZE,
+    max_lines: int | None = None,
+    start_line: int | None = None,
+    whole_lines: bool = False,
+) -> FileChunk:
+    """
+    Read up to `max_bytes` bytes (and, optionally, up to `max_lines` lines) of a UTF-8 file starting either at a byte
+    `offset` or at a (zero-based) `start_line`. Files larger than `MMAP_THRESHOLD` are memory-mapped instead of being
+    read whole. The chunk never ends in the middle of a character and, if `whole_lines` is set, it ends at a line
+    break (unless a single line does not fit into `max_bytes`).
+    """
+    with open(file_path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        if file_size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return _read_chunk_from_buffer(buffer, offset, max_bytes, max_lines, start_line, whole_lines)
+        return _read_chunk_from_buffer(file.read(), offset, max_bytes, max_lines, start_line, whole_lines)
+
+
+def _read_chunk_from_buffer(
+    buffer: bytes | mmap.mmap,
+    offset: int,
+    max_bytes: int,
+    max_lines: int | None,
+    start_line: int | None,
+    whole_lines: bool,
+) -> FileChunk:
+    file_size = len(buffer)
+    if start_line is not None:
+        offset = _skip_lines(buffer, 0, file_size, start_line)
+    start = min(max(offset, 0), file_size)
+    end = min(start + max(max_bytes, 1), file_size)
+
+    if max_lines is not None:
+        end = min(end, _skip_lines(buffer, start, end, max_lines))
+    if whole_lines and end < file_size:
+        last_newline = buffer.rfind(b"\n", start, end)
+        if last_newline != -1:
+            end = last_newline + 1
+    # don't cut a multibyte character in half (UTF-8 continuation bytes look like 0b10xxxxxx)
+    unaligned_end = end
+    while start < end < file_size and buffer[end] & 0xC0 == 0x80:
+        end -= 1
+    if end == start:
+        end = unaligned_end
+
+    return FileChunk(
+        content=bytes(buffer[start:end]).decode("utf-8", errors="replace"),
+        offset=start,
+        next_offset=end if end < file_size else None,
+        file_size=file_size,
+    )
+
+
+def _skip_lines(buffer: bytes | mmap.mmap, start: int, stop: int, lines: int) -> int:
+    """Return the offset right after the `lines`-th line break (or `stop` if there are not that many lines)."""
+    pos = start
+    for _ in range(lines):
+        newline = buffer.find(b"\n", pos, stop)
+        if newline == -1:
+            return stop
+        pos = newline + 1
+    return pos
+
+
+def format_file_chunk(chunk: FileChunk, file_path: str) -> str:
+    """Format a file chunk for an LLM, so it knows how to continue reading the file."""
+    if chunk.offset == 0 and chunk.next_offset is None:
+        return chunk.content
+    end = chunk.file_size if chunk.next_offset is None else chunk.next_offset
+    footer = f"[bytes {chunk.offset}-{end} of {chunk.file_size} of `{file_path}`"
+    if chunk.next_offset is not None:
+        footer += f", read again with offset={chunk.next_offset} to continue"
+    return f"{chunk.content}\n{footer}]"
 
 
 class ListRepoTool(BaseFileToolMixin, lc_tools.BaseTool):
@@ -53,6 +129,7 @@ class ListRepoTool(BaseFileToolMixin, lc_tools.BaseTool):
     name: str = "list_repo"
     description: str = "List all the files in `%s` repo"
     repo_name: str = None
+    workers: Optional[int] = None
 
     def __init__(self, **data) -> None:
         super().__init__(**data)
@@ -61,7 +138,7 @@ class ListRepoTool(BaseFileToolMixin, lc_tools.BaseTool):
         self.description = self.description % self.repo_name
 
     def _run(self, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
-        file_list: list[Path] = list_files_in_repo(self.root_dir)
+        file_list: list[Path] = list_files_in_repo(self.root_dir, workers=self.workers)
 
         file_list_str = "\n".join([file.as_posix() for file in file_list])
         result = f"Here is the complete list of files that can be found in `{self.repo_name}` repo:\n{file_list_str}"
@@ -71,16 +148,49 @@ class ListRepoTool(BaseFileToolMixin, lc_tools.BaseTool):
         self,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
-        return self._run()
+        return await disk_io_executor.run(self._run)
+
+
+class ReadFileRangeInput(BaseModel):
+    """Input for ReadFileTool."""
+
+    file_path: str = Field(..., description="name of file")
+    offset: int = Field(0, description="byte offset to start reading from (to continue reading a large file)")
+    max_bytes: int = Field(READ_CHUNK_SIZE, description="maximum number of bytes to read")
 
 
 class ReadFileTool(lc_tools.ReadFileTool):
+    """Tool that reads a file page by page (large files are not read in full)."""
+
+    args_schema: Type[BaseModel] = ReadFileRangeInput
+    description: str = "Read file from disk (large files are read in chunks, pass `offset` to continue reading)"
+
+    def _run(
+        self,
+        file_path: str,
+        offset: int = 0,
+        max_bytes: int = READ_CHUNK_SIZE,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        try:
+            read_path = self.get_relative_path(file_path)
+        except FileValidationError:
+            return INVALID_PATH_TEMPLATE.format(arg_name="file_path", value=file_path)
+        if not read_path.exists():
+            return f"Error: no such file or directory: {file_path}"
+        try:
+            return format_file_chunk(read_file_chunk(read_path, offset, max_bytes), file_path)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            return "Error: " + str(e)
+
     async def _arun(
         self,
         file_path: str,
+        offset: int = 0,
+        max_bytes: int = READ_CHUNK_SIZE,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
-        return self.run(file_path, run_manager=run_manager)
+        return await disk_io_executor.run(self._run, file_path, offset, max_bytes)
 
 
 class WriteFileTool(lc_tools.WriteFileTool):
@@ -91,4 +201,4 @@ class WriteFileTool(lc_tools.WriteFileTool):
         append: bool = False,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
-        return self.run(file_path, text=text, append=append, run_manager=run_manager)
+        return await disk_io_executor.run(self._run, file_path, text, append=append)
@@ -0,0 +1,570 @@
+"""A persistent, incrementally refreshed index of the text files in a repository."""
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+from pathspec import pathspec
+
+from experiments.common.text_files import TextFileClassifier
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional - without it the index falls back to polling directory mtimes
+    FileSystemEventHandler = object
+    Observer = None
+
+REPO_INDEX_CACHE_DIR = Path(
+    os.environ.get("REPO_INDEX_CACHE_DIR", Path.home() / ".cache" / "mergedbots-experiments" / "repo-index")
+)
+REPO_WALK_WORKERS = int(os.environ.get("REPO_WALK_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+# changes found by refreshes are saved to disk at most this often (the whole index is rewritten on every save)
+REPO_INDEX_SAVE_DELAY_SECONDS = float(os.environ.get("REPO_INDEX_SAVE_DELAY_SECONDS", 30))
+_INDEX_FORMAT_VERSION = 3
+
+# a tuple of (dir, compiled rules of the .gitignore in that dir) for every dir from the repo root down to a given dir
+# that has a .gitignore (the repo root always has an entry - the implicit rules are attached to it)
+MatcherChain = tuple[tuple[str, tuple[tuple[bool, re.Pattern], ...]], ...]
+
+
+class _DirScan(NamedTuple):
+    mtime_ns: int
+    subdirs: list[str]
+    files: list[str]
+    file_entries: list[list]
+    gitignore_key: list[int] | None
+    gitignore_content: str | None
+    matcher_chain: MatcherChain
+    visited_entries: int
+
+
+class RepoIndex:
+    """
+    An index of all the text files in a repository that are not ignored by git.
+
+    Every file is keyed by (path, mtime, size, inode). The index is refreshed incrementally: only the directories
+    whose mtime has changed since the last refresh are rescanned (or, if a watcher is running, only the directories
+    the watcher reported as changed), so a refresh costs time proportional to the number of changes rather than to
+    the size of the repo. The index is persisted to disk, so it survives restarts (the changes found by refreshes are
+    saved at most once per `save_delay_seconds` and when the process exits, since every save rewrites the whole
+    index). Cold scans (as well as scans of newly appeared subtrees) are parallelized with `workers` threads (set it
+    to 1 to scan serially).
+
+    Nested .gitignore files are respected: the .gitignore of every directory is compiled once and an entry is only
+    checked against the rules of the .gitignore files of its ancestors (later, deeper rules take precedence, so
+    negations work across levels). Ignored directories are pruned before they are scanned.
+
+    The text file verdicts are memoized in a cache of the index's own, next to the index (see `TextFileClassifier`).
+
+    NOTE: Modifying a file in place does not change the mtime of its directory, so such a modification goes unnoticed
+    by polling. This only matters if it turns a text file into a binary one (or vice versa).
+    """
+
+    def __init__(
+        self,
+        repo_path: str | Path,
+        additional_gitignore_content: str = "",
+        cache_dir: str | Path | None = REPO_INDEX_CACHE_DIR,
+        workers: int = REPO_WALK_WORKERS,
+        save_delay_seconds: float = REPO_INDEX_SAVE_DELAY_SECONDS,
+    ) -> None:
+        self.repo_path = Path(repo_path).resolve()
+        self.additional_gitignore_content = additional_gitignore_content
+        self.workers = workers
+        self.save_delay_seconds = save_delay_seconds
+        self.cache_file = None
+        verdicts_file = None
+        if cache_dir:
+            cache_key = hashlib.sha1(f"{self.repo_path}\n{additional_gitignore_content}".encode("utf-8")).hexdigest()
+            self.cache_file = Path(cache_dir) / f"{cache_key}.json"
+            verdicts_file = Path(cache_dir) / f"{cache_key}.verdicts.json"
+        self.text_files = TextFileClassifier(verdicts_file)
+        # incremented every time the index changes, so derived data (e.g. caches) can tell when it went stale
+        self.version = 0
+        # statistics of the scans performed by the latest `list_files` call
+        self.scan_stats = {"scanned_dirs": 0, "visited_entries": 0, "seconds": 0.0}
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._scan_workers = workers
+        # rel dir -> [mtime_ns, subdirs, files, gitignore key (mtime_ns, size) or None, gitignore content or None]
+        self._dirs: dict[str, list] = {}
+        self._matcher_chains: dict[str, MatcherChain] = {}
+        # rel file -> [mtime_ns, size, inode, is_text]
+        self._files: dict[str, list] = {}
+        self._sort_keys: list[tuple[str, str]] = []
+        self._sorted_files: list[Path] = []
+
+        self._observer = None
+        self._dirty_dirs: set[str] = set()
+        self._dirty_lock = threading.Lock()
+        self._save_timer: threading.Timer | None = None
+
+    def list_files(self, workers: int | None = None) -> list[Path]:
+        """
+        Refresh the index and return a sorted list of text files (paths are relative to the repo). Pass `workers` to
+        override the number of threads the index scans the repo with.
+        """
+        with self._lock:
+            self._refresh_index(workers)
+            return list(self._sorted_files)
+
+    def refresh(self, workers: int | None = None) -> int:
+        """Refresh the index (the same way `list_files` does) and return its version."""
+        with self._lock:
+            self._refresh_index(workers)
+            return self.version
+
+    def start_watching(self) -> bool:
+        """
+        Start watching the repo for changes (requires the optional `watchdog` package, which uses inotify on Linux).
+        While the watcher is running, refreshes skip polling directory mtimes altogether. Returns False if `watchdog`
+        is not installed.
+        """
+        if Observer is None:
+            return False
+        with self._lock:
+            if self._observer is None:
+                self._observer = Observer()
+                self._observer.schedule(_DirtyDirsHandler(self), str(self.repo_path), recursive=True)
+                self._observer.start()
+                # the index might have gone stale before the watcher started - the next refresh will have to poll
+                self._loaded = False
+        return True
+
+    def stop_watching(self) -> None:
+        """Stop the watcher (if any). Refreshes will go back to polling directory mtimes."""
+        with self._lock:
+            if self._observer is not None:
+                self._observer.stop()
+                self._observer.join()
+                self._observer = None
+
+    def mark_dirty(self, abs_path: str | Path) -> None:
+        """Mark the directory that contains `abs_path` (as well as `abs_path` itself) as in need of a rescan."""
+        try:
+            rel_path = Path(abs_path).resolve().relative_to(self.repo_path).as_posix()
+        except ValueError:
+            return
+        rel_path = "" if rel_path == "." else rel_path
+        with self._dirty_lock:
+            self._dirty_dirs.add(rel_path)
+            if rel_path:
+                self._dirty_dirs.add(_parent_dir(rel_path))
+
+    def _refresh_index(self, workers: int | None) -> None:
+        self._scan_workers = self.workers if workers is None else workers
+        self.scan_stats = {"scanned_dirs": 0, "visited_entries": 0, "seconds": 0.0}
+        start_time = time.perf_counter()
+        if not self._loaded:
+            self._load()
+            self.version += 1
+        elif self._refresh():
+            self._schedule_save()
+            self.version += 1
+        self.scan_stats["seconds"] = time.perf_counter() - start_time
+
+    def save(self) -> None:
+        """Save the changes that are waiting for the save delay to pass (e.g. before the process exits)."""
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            self._save()
+
+    def _schedule_save(self) -> None:
+        """Save the index once `save_delay_seconds` pass (the changes that come in the meantime are saved with it)."""
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay_seconds, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _load(self) -> None:
+        cached = self._read_cache()
+        if cached:
+            self._dirs = cached["dirs"]
+            self._files = cached["files"]
+            self._rebuild_matcher_chains()
+            self._rebuild_sorted_files()
+            self._poll_dirs()
+        else:
+            self._dirs = {}
+            self._matcher_chains = {}
+            self._files = {}
+            self._scan_tree("", (), {}, keep_sorted=False)
+            self._rebuild_sorted_files()
+        with self._dirty_lock:
+            self._dirty_dirs.clear()
+        # the whole repo was just seen, so the verdicts of the files that are not in it any more can go
+        self.text_files.retain(self.repo_path / rel_file for rel_file in self._files)
+        self._loaded = True
+        self._save()
+
+    def _refresh(self) -> bool:
+        with self._dirty_lock:
+            dirty_dirs = self._dirty_dirs
+            self._dirty_dirs = set()
+        # without a watcher the dirs are polled, but files that were marked dirty (e.g. edited in place, which polling
+        # does not notice) still need to be refreshed one by one
+        changed = self._poll_dirs() if self._observer is None else False
+        for rel_path in sorted(dirty_dirs):
+            if rel_path in self._files:
+                changed = self._refresh_file(rel_path) or changed
+            elif self._observer is not None:
+                changed = self._refresh_dir(rel_path) or changed
+        return changed
+
+    def _poll_dirs(self) -> bool:
+        changed = False
+        for rel_dir in list(self._dirs):
+            changed = self._refresh_dir(rel_dir) or changed
+        return changed
+
+    def _refresh_dir(self, rel_dir: str) -> bool:
+        dir_state = self._dirs.get(rel_dir)
+        if dir_state is None:
+            # either the dir is not indexed (ignored, a symlink etc.) or it was dropped along with its parent
+            return False
+        abs_dir = self.repo_path / rel_dir
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            self._drop_dir(rel_dir)
+            return True
+        # creation or removal of a .gitignore changes the mtime of the dir, but editing it in place does not
+        gitignore_key = _stat_gitignore(abs_dir) if dir_state[3] else None
+        if mtime_ns == dir_state[0] and gitignore_key == dir_state[3]:
+            return False
+
+        parent_chain = self._matcher_chains[_parent_dir(rel_dir)] if rel_dir else ()
+        try:
+            dir_scan = self._scan_dir(rel_dir, parent_chain, self._files)
+        except (FileNotFoundError, NotADirectoryError):
+            self._drop_dir(rel_dir)
+            return True
+
+        if dir_scan.gitignore_content != dir_state[4]:
+            # the ignore rules have changed - the whole subtree needs to be reconsidered
+            known_files = dict(self._files)
+            self._drop_dir(rel_dir)
+            self._scan_tree(rel_dir, parent_chain, known_files)
+            return True
+
+        old_subdirs = set(dir_state[1])
+        old_files = set(dir_state[2])
+        self._apply_dir_scan(rel_dir, dir_scan, keep_sorted=True)
+        new_subdirs = set(dir_scan.subdirs)
+        new_files = set(dir_scan.files)
+
+        for subdir in old_subdirs - new_subdirs:
+            self._drop_dir(subdir)
+        for rel_file in old_files - new_files:
+            self._remove_file(rel_file)
+        for subdir in new_subdirs - old_subdirs:
+            self._scan_tree(subdir, dir_scan.matcher_chain, self._files)
+        return True
+
+    def _refresh_file(self, rel_file: str) -> bool:
+        try:
+            stat = os.stat(self.repo_path / rel_file)
+        except (FileNotFoundError, NotADirectoryError):
+            # the removal will be picked up when the parent dir is refreshed
+            return False
+        old_entry = self._files[rel_file]
+        new_entry = self._classify_file(rel_file, stat, old_entry)
+        self._set_file(rel_file, new_entry)
+        return new_entry != old_entry
+
+    def _scan_tree(
+        self, rel_root: str, parent_chain: MatcherChain, known_files: dict[str, list], keep_sorted: bool = True
+    ) -> None:
+        """
+        Scan a whole directory tree. With more than one worker the subdirectories (as well as the classification of
+        their files) are fanned out to a thread pool, while the results are applied to the index in this thread.
+        """
+        if self._scan_workers <= 1:
+            pending_dirs = [(rel_root, parent_chain)]
+            while pending_dirs:
+                rel_dir, dir_parent_chain = pending_dirs.pop()
+                try:
+                    dir_scan = self._scan_dir(rel_dir, dir_parent_chain, known_files)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                self._apply_dir_scan(rel_dir, dir_scan, keep_sorted)
+                pending_dirs.extend((subdir, dir_scan.matcher_chain) for subdir in dir_scan.subdirs)
+            return
+
+        with ThreadPoolExecutor(max_workers=self._scan_workers, thread_name_prefix="repo-index") as executor:
+            pending_futures = {executor.submit(self._scan_dir, rel_root, parent_chain, known_files): rel_root}
+            while pending_futures:
+                done_futures, _ = wait(pending_futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    rel_dir = pending_futures.pop(future)
+                    try:
+                        dir_scan = future.result()
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+                    self._apply_dir_scan(rel_dir, dir_scan, keep_sorted)
+                    for subdir in dir_scan.subdirs:
+                        subdir_future = executor.submit(self._scan_dir, subdir, dir_scan.matcher_chain, known_files)
+                        pending_futures[subdir_future] = subdir
+
+    def _scan_dir(self, rel_dir: str, parent_chain: MatcherChain, known_files: dict[str, list]) -> _DirScan:
+        """
+        Scan a single directory and (re)classify the files that are new or changed. Does not modify the index, so it
+        is safe to call it from worker threads.
+        """
+        abs_dir = self.repo_path / rel_dir
+        # take the mtime before listing the dir so that concurrent changes are picked up by the next refresh
+        mtime_ns = os.stat(abs_dir).st_mtime_ns
+
+        subdirs = []
+        files = []
+        file_entries = []
+        visited_entries = 0
+        try:
+            gitignore_key = _stat_gitignore(abs_dir)
+            gitignore_content = None
+            if gitignore_key:
+                # (git reads .gitignore as bytes - a stray non-UTF-8 byte should not stop the whole scan)
+                with open(abs_dir / ".gitignore", "r", encoding="utf-8", errors="replace") as file:
+                    gitignore_content = file.read()
+            matcher_chain = self._extend_matcher_chain(rel_dir, parent_chain, gitignore_content)
+
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    visited_entries += 1
+                    if entry.is_symlink():
+                        # `os.walk` does not descend into symlinked dirs and libmagic does not consider symlinks text
+                        continue
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    if entry.is_dir():
+                        if not _is_ignored(rel_path, True, matcher_chain):
+                            subdirs.append(rel_path)
+                    elif entry.is_file() and not _is_ignored(rel_path, False, matcher_chain):
+                        try:
+                            file_entry = self._classify_file(rel_path, entry.stat(), known_files.get(rel_path))
+                        except FileNotFoundError:
+                            # the file was removed in the middle of the scan (which changes the mtime of the dir,
+                            # so the next refresh rescans the dir anyway)
+                            continue
+                        files.append(rel_path)
+                        file_entries.append(file_entry)
+        except PermissionError:
+            # `os.walk` skips the dirs it can't read - so does the index, but it does not record the mtime of such a
+            # dir, so that it is retried on every refresh (regaining access does not change the mtime)
+            return _DirScan(
+                mtime_ns=-1,
+                subdirs=[],
+                files=[],
+                file_entries=[],
+                gitignore_key=None,
+                gitignore_content=None,
+                matcher_chain=self._extend_matcher_chain(rel_dir, parent_chain, None),
+                visited_entries=visited_entries,
+            )
+        return _DirScan(
+            mtime_ns=mtime_ns,
+            subdirs=subdirs,
+            files=files,
+            file_entries=file_entries,
+            gitignore_key=gitignore_key,
+            gitignore_content=gitignore_content,
+            matcher_chain=matcher_chain,
+            visited_entries=visited_entries,
+        )
+
+    def _extend_matcher_chain(
+        self, rel_dir: str, parent_chain: MatcherChain, gitignore_content: str | None
+    ) -> MatcherChain:
+        if not rel_dir:
+            # hidden files and dirs as well as the additional rules are treated as part of the root .gitignore
+            root_gitignore_content = f".*\n{self.additional_gitignore_content}\n{gitignore_content or ''}"
+            return (("", _compile_gitignore(root_gitignore_content)),)
+        if gitignore_content:
+            return parent_chain + ((rel_dir, _compile_gitignore(gitignore_content)),)
+        return parent_chain
+
+    def _classify_file(self, rel_file: str, stat: os.stat_result, known_entry: list | None) -> list:
+        file_key = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+        if known_entry and known_entry[:3] == file_key:
+            return known_entry
+        return file_key + [self.text_files.is_text_file(self.repo_path / rel_file, stat)]
+
+    def _apply_dir_scan(self, rel_dir: str, dir_scan: _DirScan, keep_sorted: bool) -> None:
+        self._dirs[rel_dir] = [
+            dir_scan.mtime_ns,
+            dir_scan.subdirs,
+            dir_scan.files,
+            dir_scan.gitignore_key,
+            dir_scan.gitignore_content,
+        ]
+        self._matcher_chains[rel_dir] = dir_scan.matcher_chain
+        for rel_file, file_entry in zip(dir_scan.files, dir_scan.file_entries):
+            self._set_file(rel_file, file_entry, keep_sorted)
+        self.scan_stats["scanned_dirs"] += 1
+        self.scan_stats["visited_entries"] += dir_scan.visited_entries
+
+    def _set_file(self, rel_file: str, file_entry: list, keep_sorted: bool = True) -> None:
+        old_entry = self._files.get(rel_file)
+        self._files[rel_file] = file_entry
+        if not keep_sorted:
+            return
+        was_text = bool(old_entry and old_entry[3])
+        if was_text and not file_entry[3]:
+            self._remove_sorted(rel_file)
+        elif file_entry[3] and not was_text:
+            self._insert_sorted(rel_file)
+
+    def _remove_file(self, rel_file: str) -> None:
+        entry = self._files.pop(rel_file, None)
+        if entry and entry[3]:
+            self._remove_sorted(rel_file)
+        self.text_files.forget(self.repo_path / rel_file)
+
+    def _drop_dir(self, rel_dir: str) -> None:
+        dir_state = self._dirs.pop(rel_dir, None)
+        self._matcher_chains.pop(rel_dir, None)
+        if dir_state is None:
+            return
+        for rel_file in dir_state[2]:
+            self._remove_file(rel_file)
+        for subdir in dir_state[1]:
+            self._drop_dir(subdir)
+
+    def _insert_sorted(self, rel_file: str) -> None:
+        sort_key = _sort_key(rel_file)
+        idx = bisect_left(self._sort_keys, sort_key)
+        self._sort_keys.insert(idx, sort_key)
+        self._sorted_files.insert(idx, Path(rel_file))
+
+    def _remove_sorted(self, rel_file: str) -> None:
+        sort_key = _sort_key(rel_file)
+        idx = bisect_left(self._sort_keys, sort_key)
+        if idx < len(self._sort_keys) and self._sort_keys[idx] == sort_key:
+            del self._sort_keys[idx]
+            del self._sorted_files[idx]
+
+    def _rebuild_sorted_files(self) -> None:
+        self._sort_keys = sorted(_sort_key(rel_file) for rel_file, entry in self._files.items() if entry[3])
+        self._sorted_files = [Path(sort_key[1]) for sort_key in self._sort_keys]
+
+    def _rebuild_matcher_chains(self) -> None:
+        self._matcher_chains = {}
+        pending_dirs = [("", ())]
+        while pending_dirs:
+            rel_dir, parent_chain = pending_dirs.pop()
+            dir_state = self._dirs[rel_dir]
+            matcher_chain = self._extend_matcher_chain(rel_dir, parent_chain, dir_state[4])
+            self._matcher_chains[rel_dir] = matcher_chain
+            pending_dirs.extend((subdir, matcher_chain) for subdir in dir_state[1])
+
+    def _read_cache(self) -> dict | None:
+        if not self.cache_file or not self.cache_file.is_file():
+            return None
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if cached.get("format_version") != _INDEX_FORMAT_VERSION or cached.get("repo_path") != str(self.repo_path):
+            return None
+        return cached
+
+    def _save(self) -> None:
+        self.text_files.save()
+        if not self.cache_file:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "format_version": _INDEX_FORMAT_VERSION,
+                    "repo_path": str(self.repo_path),
+                    "dirs": self._dirs,
+                    "files": self._files,
+                },
+                file,
+            )
+        os.replace(tmp_file, self.cache_file)
+
+
+class _DirtyDirsHandler(FileSystemEventHandler):
+    def __init__(self, repo_index: RepoIndex) -> None:
+        super().__init__()
+        self.repo_index = repo_index
+
+    def on_any_event(self, event) -> None:
+        self.repo_index.mark_dirty(event.src_path)
+        if getattr(event, "dest_path", None):
+            self.repo_index.mark_dirty(event.dest_path)
+
+
+_repo_indexes: dict[tuple[Path, str], RepoIndex] = {}
+_repo_indexes_lock = threading.Lock()
+
+
+def get_repo_index(repo_path: str | Path, additional_gitignore_content: str = "") -> RepoIndex:
+    """Get the process-wide index of a repo (the index is created upon first request)."""
+    key = (Path(repo_path).resolve(), additional_gitignore_content)
+    with _repo_indexes_lock:
+        repo_index = _repo_indexes.get(key)
+        if repo_index is None:
+            repo_index = RepoIndex(*key)
+            _repo_indexes[key] = repo_index
+        return repo_index
+
+
+@atexit.register
+def _save_repo_indexes() -> None:
+    with _repo_indexes_lock:
+        repo_indexes = list(_repo_indexes.values())
+    for repo_index in repo_indexes:
+        repo_index.save()
+
+
+@lru_cache(maxsize=None)
+def _compile_gitignore(gitignore_content: str) -> tuple[tuple[bool, re.Pattern], ...]:
+    spec = pathspec.PathSpec.from_lines("gitwildmatch", gitignore_content.splitlines())
+    return tuple((pattern.include, pattern.regex) for pattern in spec.patterns if pattern.include is not None)
+
+
+def _is_ignored(rel_path: str, is_dir: bool, matcher_chain: MatcherChain) -> bool:
+    """The last rule that matches wins - the same way it works in git (the rules of deeper .gitignore files last)."""
+    ignored = False
+    for base_dir, rules in matcher_chain:
+        path = rel_path[len(base_dir) + 1 :] if base_dir else rel_path
+        if is_dir:
+            # this way patterns that only match dirs (e.g. `node_modules/`) prune the dirs and not just their files
+            path += "/"
+        for include, regex in rules:
+            if regex.match(path):
+                ignored = include
+    return ignored
+
+
+def _stat_gitignore(abs_dir: Path) -> list[int] | None:
+    try:
+        stat = os.stat(abs_dir / ".gitignore")
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _sort_key(rel_file: str) -> tuple[str, str]:
+    return rel_file.lower(), rel_file
+
+
+def _parent_dir(rel_path: str) -> str:
+    return rel_path.rpartition("/")[0]
@@ -0,0 +1,498 @@
+"""
+A bot manager that keeps the messages in SQLite, with only the recently active conversations in memory.
+
+It is built on top of `InMemoryBotManager` and assumes the following about mergedbots internals:
+- `InMemoryBotManager` keeps every object it creates (bots, users, messages) in its `data` dict, keyed by the uuid of
+  the object, and never replaces an object that is already there;
+- messages have `previous_msg`, `in_fulfillment_of`, `sender`, `originator`, `content`, `is_still_typing`,
+  `is_visible_to_bots` and `custom_fields`, and they do not change once they are created;
+- the classes of the objects are exported by `mergedbots` under their own names (so that the objects can be
+  recreated from the database).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import mergedbots
+from mergedbots import InMemoryBotManager, MergedMessage, MergedParticipant
+from pydantic import PrivateAttr
+
+from experiments.common.executors import disk_io_executor
+
+# the number of conversations whose messages are kept in memory
+BOT_MANAGER_HOT_CONVERSATIONS = int(os.environ.get("BOT_MANAGER_HOT_CONVERSATIONS", 1000))
+# the number of evicted conversations that can be continued without a database lookup (~300 bytes per conversation)
+BOT_MANAGER_EVICTED_TIPS = int(os.environ.get("BOT_MANAGER_EVICTED_TIPS", 100_000))
+BOT_MANAGER_WRITE_BATCH_SIZE = int(os.environ.get("BOT_MANAGER_WRITE_BATCH_SIZE", 500))
+BOT_MANAGER_WRITE_INTERVAL_SECONDS = float(os.environ.get("BOT_MANAGER_WRITE_INTERVAL_SECONDS", 0.2))
+# how many times a batch is tried to be written before it is given up on (see `MessageStore.failed_writes`)
+BOT_MANAGER_WRITE_ATTEMPTS = int(os.environ.get("BOT_MANAGER_WRITE_ATTEMPTS", 3))
+
+# the message attributes that have columns of their own (the rest of the attributes go to `extra`)
+_MESSAGE_COLUMNS = {
+    "manager",
+    "uuid",
+    "previous_msg",
+    "in_fulfillment_of",
+    "sender",
+    "originator",
+    "content",
+    "is_still_typing",
+    "is_visible_to_bots",
+    "custom_fields",
+}
+_PARTICIPANT_SKIPPED_ATTRIBUTES = {"manager", "uuid", "fulfillment_func"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (uuid TEXT PRIMARY KEY, kind TEXT NOT NULL, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (id INTEGER PRIMARY KEY, parent_id INTEGER, parent_seq INTEGER);
+CREATE TABLE IF NOT EXISTS messages (
+    uuid TEXT PRIMARY KEY,
+    conversation_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    previous_uuid TEXT,
+    in_fulfillment_of_uuid TEXT,
+    sender_uuid TEXT NOT NULL,
+    originator_uuid TEXT NOT NULL,
+    content TEXT NOT NULL,
+    is_still_typing INTEGER NOT NULL,
+    is_visible_to_bots INTEGER NOT NULL,
+    custom_fields TEXT NOT NULL,
+    extra TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation_id, seq);
+"""
+
+# the messages of a conversation (up to `seq`) preceded by the messages of the conversations it branched off from
+_CONVERSATION_QUERY = """
+WITH RECURSIVE chain(id, upto) AS (
+    SELECT ?, ?
+    UNION ALL
+    SELECT conversations.parent_id, conversations.parent_seq
+    FROM conversations JOIN chain ON conversations.id = chain.id
+    WHERE conversations.parent_id IS NOT NULL
+)
+SELECT messages.* FROM chain JOIN messages ON messages.conversation_id = chain.id AND messages.seq <= chain.upto
+ORDER BY messages.conversation_id, messages.seq
+"""
+
+
+def _json_fields(fields: dict[str, Any]) -> str:
+    """The fields that can be serialized to JSON (the rest are skipped), serialized."""
+    serializable = {}
+    for name, value in fields.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        serializable[name] = value
+    return json.dumps(serializable, ensure_ascii=False)
+
+
+class MessageStore:
+    """
+    SQLite (WAL) storage of conversations. Writes are queued and applied in batches by a background thread, `flush()`
+    waits for the queued writes to be applied. A batch that fails is retried `write_attempts` times and then dropped
+    (the dropped rows are counted in `failed_writes`).
+
+    A conversation is stored as segments: a message is appended to the segment of the message it follows, unless that
+    message is not the last one in its segment (the conversation branches) or is not in memory any more - then a new
+    segment is started, which points at the position it branched off from. Hence the whole conversation that ends
+    with a message is a single indexed range query (see `load_conversation()`).
+    """
+
+    def __init__(
+        self,
+        db_file: str | Path,
+        batch_size: int = BOT_MANAGER_WRITE_BATCH_SIZE,
+        write_interval_seconds: float = BOT_MANAGER_WRITE_INTERVAL_SECONDS,
+        write_attempts: int = BOT_MANAGER_WRITE_ATTEMPTS,
+    ) -> None:
+        self.db_file = Path(db_file)
+        self.batch_size = batch_size
+        self.write_interval_seconds = write_interval_seconds
+        self.write_attempts = max(write_attempts, 1)
+        # the rows that could not be written (and the error that prevented it the last time)
+        self.failed_writes = 0
+        self.last_write_error: Exception | None = None
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self._reader = self._connect()
+        self._reader.executescript(_SCHEMA)
+        self._reader_lock = threading.Lock()
+
+        # (table, row) pairs that were not written yet
+        self._pending: deque[tuple[str, tuple]] = deque()
+        self._pending_writes = 0
+        # message uuid -> (conversation segment id, position in the conversation), for the messages not written yet
+        self._pending_positions: dict[str, tuple[int, int]] = {}
+        self._flushing = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer: threading.Thread | None = None
+
+    def last_conversation_id(self) -> int:
+        """The biggest conversation segment id in the database."""
+        with self._reader_lock:
+            return self._reader.execute("SELECT coalesce(max(id), 0) FROM conversations").fetchone()[0]
+
+    def put_conversation(self, conversation_id: int, parent_id: int | None, parent_seq: int | None) -> None:
+        """Queue a new conversation segment to be written."""
+        self._put("conversations", (conversation_id, parent_id, parent_seq))
+
+    def put_message(self, row: tuple) -> None:
+        """Queue a message to be written."""
+        self._put("messages", row, position=(row[1], row[2]))
+
+    def put_participant(self, row: tuple) -> None:
+        """Queue a participant (a bot or a user) to be written."""
+        self._put("participants", row)
+
+    def position(self, msg_uuid: str) -> tuple[int, int] | None:
+        """
+        The conversation segment of a message and its position in the conversation (the message does not need to be
+        written yet - this does not wait for the writer).
+        """
+        with self._condition:
+            position = self._pending_positions.get(msg_uuid)
+        if position is not None:
+            return position
+        with self._reader_lock:
+            row = self._reader.execute(
+                "SELECT conversation_id, seq FROM messages WHERE uuid = ?", (msg_uuid,)
+            ).fetchone()
+        return (row["conversation_id"], row["seq"]) if row else None
+
+    def load_conversation(self, conversation_id: int, upto_seq: int) -> list[sqlite3.Row]:
+        """The (written) messages of a conversation up to a position, in order."""
+        with self._reader_lock:
+            return self._reader.execute(_CONVERSATION_QUERY, (conversation_id, upto_seq)).fetchall()
+
+    def load_participant(self, participant_uuid: str) -> sqlite3.Row | None:
+        """A (written) participant."""
+        with self._reader_lock:
+            return self._reader.execute("SELECT * FROM participants WHERE uuid = ?", (participant_uuid,)).fetchone()
+
+    @property
+    def pending_writes(self) -> int:
+        """The number of queued rows that were not written yet."""
+        return self._pending_writes
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait for the queued rows to be written (returns False if the timeout expired before that)."""
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(lambda: not self._pending_writes, timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self) -> None:
+        """Write the queued rows and stop the writer."""
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _put(self, table: str, row: tuple, position: tuple[int, int] | None = None) -> None:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("the message store is closed")
+            self._pending.append((table, row))
+            self._pending_writes += 1
+            if position is not None:
+                self._pending_positions[row[0]] = position
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="message-store-writer", daemon=True)
+                self._writer.start()
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def _write(self) -> None:
+        connection = self._connect()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    connection.close()
+                    return
+                # let the batch fill up unless someone is waiting for it
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= self.batch_size or self._flushing or self._closed,
+                    self.write_interval_seconds,
+                )
+                batch = list(self._pending)
+                self._pending.clear()
+
+            rows_by_table: dict[str, list[tuple]] = {}
+            for table, row in batch:
+                rows_by_table.setdefault(table, []).append(row)
+            self._write_batch(connection, rows_by_table)
+
+            with self._condition:
+                self._pending_writes -= len(batch)
+                # the positions are only forgotten once the messages can be found in the database (or never will be)
+                for table, row in batch:
+                    if table == "messages":
+                        self._pending_positions.pop(row[0], None)
+                self._condition.notify_all()
+
+    def _write_batch(self, connection: sqlite3.Connection, rows_by_table: dict[str, list[tuple]]) -> None:
+        for attempt in range(1, self.write_attempts + 1):
+            try:
+                with connection:
+                    for table, rows in rows_by_table.items():
+                        placeholders = ", ".join("?" * len(rows[0]))
+                        # participants may change (e.g. their custom fields), messages and conversations do not
+                        verb = "INSERT OR REPLACE" if table == "participants" else "INSERT OR IGNORE"
+                        connection.executemany(f"{verb} INTO {table} VALUES ({placeholders})", rows)
+                return
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # the writes were acknowledged long ago, so there is no one to raise the error to
+                self.last_write_error = exc
+                if attempt < self.write_attempts:
+                    print(f"MESSAGE STORE: writing a batch failed ({exc}), attempt {attempt} of {self.write_attempts}")
+                    # (the transaction was rolled back, so the whole batch is simply written again)
+                    time.sleep(self.write_interval_seconds * attempt)
+                else:
+                    self.failed_writes += sum(len(rows) for rows in rows_by_table.values())
+                    print(
+                        f"MESSAGE STORE: giving up on a batch, {self.failed_writes} rows failed to be written so far"
+                    )
+                    traceback.print_exc()
+
+
+class _HotConversation(NamedTuple):
+    """A conversation segment in memory (always complete - from its first message to its last one)."""
+
+    parent_id: int | None
+    parent_seq: int | None
+    first_seq: int
+    messages: list[MergedMessage]
+
+
+class _ObservedData(dict):
+    """The `data` of the manager, which tells the manager about every new object that is put into it."""
+
+    def __init__(self, manager: "SQLiteBotManager", *args: Any) -> None:
+        super().__init__(*args)
+        self.manager = manager
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        is_new = key not in self
+        super().__setitem__(key, value)
+        if is_new and key == getattr(value, "uuid", None):
+            self.manager.on_new_object(value)
+
+
+class SQLiteBotManager(InMemoryBotManager):
+    """
+    An `InMemoryBotManager` that writes every message (and every participant) to a `MessageStore` and only keeps the
+    messages of the `hot_conversations` most recently active conversations in its `data`. `get_full_conversion()`
+    serves the conversations that are in memory from memory and the rest with one query.
+
+    The position of the last message of each of the `evicted_tips` most recently evicted conversations is kept, so
+    that continuing one of them does not touch the database. Messages are added synchronously, on the event loop, so
+    only a message that continues a conversation evicted longer ago than that (or that branches off from the middle of
+    an evicted conversation) falls back to looking the position of its previous message up in the database (an
+    indexed query that does not wait for the writer, but blocks the event loop while it runs).
+
+    NOTE: the messages of the conversations that were evicted from memory are only released if nothing else (e.g. a
+    newer message, through `previous_msg`) references them.
+    """
+
+    db_file: str
+    hot_conversations: int = BOT_MANAGER_HOT_CONVERSATIONS
+    evicted_tips: int = BOT_MANAGER_EVICTED_TIPS
+
+    _store: MessageStore = PrivateAttr()
+    _hot: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    # message uuid -> (conversation segment id, position in the conversation), for the messages in memory
+    _positions: dict = PrivateAttr(default_factory=dict)
+    # the same for the last messages of the evicted conversations (which are the likeliest to be continued)
+    _evicted_tips: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _last_conversation_id: int = PrivateAttr(0)
+    _lock: Any = PrivateAttr(default_factory=threading.RLock)
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        if not isinstance(getattr(self, "data", None), dict):
+            raise TypeError("SQLiteBotManager expects InMemoryBotManager to keep its objects in a `data` dict")
+        self._store = MessageStore(self.db_file)
+        self._last_conversation_id = self._store.last_conversation_id()
+        existing_objects = list(self.data.values())
+        self.data = _ObservedData(self, self.data)
+        for obj in existing_objects:
+            self.on_new_object(obj)
+
+    async def get_full_conversion(self, message: MergedMessage, include_this: bool = True) -> list[MergedMessage]:
+        """
+        The same messages `message.get_full_conversion(include_this)` would return, without walking `previous_msg`
+        (even if some of the messages were evicted from memory).
+        """
+        with self._lock:
+            position = self._positions.get(message.uuid)
+            parts = []
+            if position is not None:
+                conversation_id, upto_seq = position
+                if not include_this:
+                    upto_seq -= 1
+                while conversation_id in self._hot:
+                    self._hot.move_to_end(conversation_id)
+                    hot = self._hot[conversation_id]
+                    parts.append(hot.messages[: upto_seq - hot.first_seq + 1])
+                    conversation_id, upto_seq = hot.parent_id, hot.parent_seq
+
+        if position is None:
+            position = await disk_io_executor.run(self._store.position, message.uuid)
+            if position is None:
+                return await message.get_full_conversion(include_this)
+            conversation_id, upto_seq = position
+            if not include_this:
+                upto_seq -= 1
+
+        messages = []
+        if conversation_id is not None and upto_seq >= 0:
+            messages = await disk_io_executor.run(self._load_conversation, conversation_id, upto_seq)
+        for part in reversed(parts):
+            messages.extend(part)
+        return [msg for msg in messages if msg.is_visible_to_bots]
+
+    def close(self) -> None:
+        """Write the queued messages to the database."""
+        self._store.close()
+
+    def on_new_object(self, obj: Any) -> None:
+        """Queue a new object to be written (and evict the least recently active conversations if it is a message)."""
+        if isinstance(obj, MergedMessage):
+            with self._lock:
+                self._add_message(obj)
+        elif isinstance(obj, MergedParticipant):
+            fields = {name: value for name, value in vars(obj).items() if name not in _PARTICIPANT_SKIPPED_ATTRIBUTES}
+            self._store.put_participant((obj.uuid, type(obj).__name__, _json_fields(fields)))
+
+    def _add_message(self, msg: MergedMessage) -> None:
+        previous_position = None
+        if msg.previous_msg is not None:
+            # (the last resort is an indexed lookup that does not wait for the writer - the message is either still
+            # queued or already written; see the docstring of the class for when it is needed)
+            previous_position = (
+                self._positions.get(msg.previous_msg.uuid)
+                or self._evicted_tips.pop(msg.previous_msg.uuid, None)
+                or self._store.position(msg.previous_msg.uuid)
+            )
+
+        if previous_position is None:
+            conversation_id, seq = self._start_conversation(None, None, 0), 0
+        else:
+            previous_conversation_id, previous_seq = previous_position
+            hot = self._hot.get(previous_conversation_id)
+            if hot is not None and hot.first_seq + len(hot.messages) - 1 == previous_seq:
+                conversation_id = previous_conversation_id
+            else:
+                # the conversation branches (or continues after it was evicted from memory)
+                conversation_id = self._start_conversation(previous_conversation_id, previous_seq, previous_seq + 1)
+            seq = previous_seq + 1
+
+        self._hot[conversation_id].messages.append(msg)
+        self._hot.move_to_end(conversation_id)
+        self._positions[msg.uuid] = (conversation_id, seq)
+
+        extra = {name: value for name, value in vars(msg).items() if name not in _MESSAGE_COLUMNS}
+        in_fulfillment_of = getattr(msg, "in_fulfillment_of", None)
+        self._store.put_message(
+            (
+                msg.uuid,
+                conversation_id,
+                seq,
+                type(msg).__name__,
+                msg.previous_msg.uuid if msg.previous_msg is not None else None,
+                in_fulfillment_of.uuid if in_fulfillment_of is not None else None,
+                msg.sender.uuid,
+                msg.originator.uuid,
+                msg.content,
+                bool(msg.is_still_typing),
+                bool(msg.is_visible_to_bots),
+                _json_fields(msg.custom_fields or {}),
+                _json_fields(extra),
+            )
+        )
+        self._evict()
+
+    def _start_conversation(self, parent_id: int | None, parent_seq: int | None, first_seq: int) -> int:
+        self._last_conversation_id += 1
+        conversation_id = self._last_conversation_id
+        self._hot[conversation_id] = _HotConversation(parent_id, parent_seq, first_seq, [])
+        self._store.put_conversation(conversation_id, parent_id, parent_seq)
+        return conversation_id
+
+    def _evict(self) -> None:
+        while len(self._hot) > self.hot_conversations:
+            _, hot = self._hot.popitem(last=False)
+            if hot.messages:
+                self._evicted_tips[hot.messages[-1].uuid] = self._positions[hot.messages[-1].uuid]
+            for msg in hot.messages:
+                self._positions.pop(msg.uuid, None)
+                # not `del`, so that `_ObservedData` does not get involved
+                dict.pop(self.data, msg.uuid, None)
+        while len(self._evicted_tips) > self.evicted_tips:
+            self._evicted_tips.popitem(last=False)
+
+    def _load_conversation(self, conversation_id: int, upto_seq: int) -> list[MergedMessage]:
+        """Recreate the messages of a conversation from the database (reusing the ones that are still in memory)."""
+        self._store.flush()
+        messages: dict[str, MergedMessage] = {}
+        participants: dict[str, MergedParticipant] = {}
+        previous_msg = None
+        for row in self._store.load_conversation(conversation_id, upto_seq):
+            msg = self.data.get(row["uuid"])
+            if msg is None:
+                in_fulfillment_of_uuid = row["in_fulfillment_of_uuid"]
+                msg = getattr(mergedbots, row["kind"], MergedMessage)(
+                    manager=self,
+                    uuid=row["uuid"],
+                    previous_msg=previous_msg,
+                    in_fulfillment_of=(
+                        messages.get(in_fulfillment_of_uuid) or self.data.get(in_fulfillment_of_uuid)
+                        if in_fulfillment_of_uuid
+                        else None
+                    ),
+                    sender=self._participant(row["sender_uuid"], participants),
+                    originator=self._participant(row["originator_uuid"], participants),
+                    content=row["content"],
+                    is_still_typing=bool(row["is_still_typing"]),
+                    is_visible_to_bots=bool(row["is_visible_to_bots"]),
+                    custom_fields=json.loads(row["custom_fields"]),
+                    **json.loads(row["extra"]),
+                )
+            messages[msg.uuid] = msg
+            previous_msg = msg
+        return list(messages.values())
+
+    def _participant(self, participant_uuid: str, participants: dict[str, MergedParticipant]) -> MergedParticipant:
+        participant = self.data.get(participant_uuid) or participants.get(participant_uuid)
+        if participant is None:
+            row = self._store.load_participant(participant_uuid)
+            if row is None:
+                raise KeyError(f"participant {participant_uuid} is neither in memory nor in {self._store.db_file}")
+            participant = getattr(mergedbots, row["kind"], MergedParticipant)(
+                manager=self, uuid=participant_uuid, **json.loads(row["fields"])
+            )
+            participants[participant_uuid] = participant
+        return participant
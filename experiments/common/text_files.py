@@ -0,0 +1,154 @@
+"""Telling text files from binary ones without calling libmagic for every single file."""
+import codecs
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable
+
+import magic
+
+SNIFF_SIZE = 8192
+
+TEXT_EXTENSIONS = frozenset(
+    (
+        ".bat .c .cfg .cmake .cpp .cs .css .csv .cxx .dart .env .go .gradle .graphql .h .hpp .htm .html .in .ini "
+        ".java .js .json .jsx .kt .kts .less .lock .lua .m .md .mjs .php .pl .properties .proto .ps1 .py .pyi .r .rb "
+        ".rs .rst .sass .scala .scss .sh .sql .swift .tf .toml .ts .tsx .txt .vue .xml .yaml .yml .zsh"
+    ).split()
+)
+BINARY_EXTENSIONS = frozenset(
+    (
+        ".7z .a .avi .bin .bmp .bz2 .class .db .dll .dylib .eot .exe .faiss .flac .gif .gz .ico .jar .jpeg .jpg .lib "
+        ".mkv .mov .mp3 .mp4 .npy .npz .o .obj .ogg .otf .parquet .pdf .pickle .pkl .png .pyc .pyd .pyo .rar .so "
+        ".sqlite .sqlite3 .tar .tgz .tif .tiff .ttf .wasm .wav .webm .webp .whl .woff .woff2 .xz .zip"
+    ).split()
+)
+
+
+class TextFileClassifier:
+    """
+    Decides whether a file is a text file. The decision is made in tiers, from the cheapest to the most expensive:
+
+    1. empty files are not considered text (libmagic reports them as `inode/x-empty`);
+    2. known text and known binary extensions are decided right away;
+    3. for the rest of the files the first `SNIFF_SIZE` bytes are read - a NUL byte means binary, valid UTF-8 means
+       text;
+    4. only if neither of the above is conclusive libmagic is consulted.
+
+    Verdicts of tiers 3 and 4 are memoized in a cache keyed by (path, mtime, size) which can be persisted to disk (it
+    is read on first use). Each repo index keeps a classifier of its own and drops the verdicts of the files that are
+    gone (see `retain()` and `forget()`), so the cache does not outgrow the repo.
+    """
+
+    def __init__(self, cache_file: str | Path | None = None) -> None:
+        self.cache_file = Path(cache_file) if cache_file else None
+        self._lock = threading.Lock()
+        self._cache: dict[str, list] | None = None
+        self._cache_changed = False
+
+    def is_text_file(self, file_path: str | Path, stat: os.stat_result | None = None) -> bool:
+        """Check whether a file is a text file (pass `stat` if it is already known to save a syscall)."""
+        if stat is None:
+            stat = os.stat(file_path)
+        if not stat.st_size:
+            return False
+
+        suffix = os.path.splitext(file_path)[1].lower()
+        if suffix in TEXT_EXTENSIONS:
+            return True
+        if suffix in BINARY_EXTENSIONS:
+            return False
+
+        cache_key = os.fspath(file_path)
+        with self._lock:
+            cached = self._loaded_cache().get(cache_key)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        is_text = sniff_text(file_path)
+        if is_text is None:
+            is_text = is_text_file_by_libmagic(file_path)
+
+        with self._lock:
+            self._cache[cache_key] = [stat.st_mtime_ns, stat.st_size, is_text]
+            self._cache_changed = True
+        return is_text
+
+    def retain(self, file_paths: Iterable[str | Path]) -> None:
+        """Drop the memoized verdicts of all the files but these ones (e.g. after a full scan of a repo)."""
+        keep = {os.fspath(file_path) for file_path in file_paths}
+        with self._lock:
+            cache = self._loaded_cache()
+            stale_keys = [cache_key for cache_key in cache if cache_key not in keep]
+            for cache_key in stale_keys:
+                del cache[cache_key]
+            self._cache_changed = self._cache_changed or bool(stale_keys)
+
+    def forget(self, file_path: str | Path) -> None:
+        """Drop the memoized verdict of a file (e.g. because it was removed)."""
+        with self._lock:
+            if self._loaded_cache().pop(os.fspath(file_path), None) is not None:
+                self._cache_changed = True
+
+    def save(self) -> None:
+        """Persist the memoized verdicts (if there are any new ones)."""
+        if not self.cache_file:
+            return
+        with self._lock:
+            if not self._cache_changed:
+                return
+            cache_content = json.dumps(self._cache)
+            self._cache_changed = False
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(cache_content, encoding="utf-8")
+        os.replace(tmp_file, self.cache_file)
+
+    def _loaded_cache(self) -> dict[str, list]:
+        """The memoized verdicts (read from disk on first use - the caller holds the lock)."""
+        if self._cache is None:
+            self._cache = self._read_cache()
+        return self._cache
+
+    def _read_cache(self) -> dict[str, list]:
+        if not self.cache_file or not self.cache_file.is_file():
+            return {}
+        try:
+            return json.loads(self.cache_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+
+def sniff_text(file_path: str | Path, sniff_size: int = SNIFF_SIZE) -> bool | None:
+    """
+    Look at the first `sniff_size` bytes of a file. Returns False if there is a NUL byte, True if the bytes are valid
+    UTF-8 and None if the verdict is inconclusive (e.g. the file is text, but in some other encoding).
+    """
+    with open(file_path, "rb") as file:
+        head = file.read(sniff_size)
+    if b"\0" in head:
+        return False
+    try:
+        # a multibyte character may be cut in half at the end of the head, unless the whole file was read
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=len(head) < sniff_size)
+    except UnicodeDecodeError:
+        return None
+    return True
+
+
+def is_text_file_by_libmagic(file_path: str | Path) -> bool:
+    """Check whether a file is a text file by its mime type as reported by libmagic."""
+    file_mime = magic.from_file(file_path, mime=True)
+    # TODO is this the exhaustive list of mime types that we want to index ?
+    return file_mime.startswith("text/") or file_mime.startswith("application/json")
+
+
+# (the verdicts of the files outside of repo indexes are only memoized for the lifetime of the process)
+text_file_classifier = TextFileClassifier()
+
+
+def is_text_file(file_path: str | Path, stat: os.stat_result | None = None) -> bool:
+    """Check whether a file is a text file using the process-wide classifier."""
+    return text_file_classifier.is_text_file(file_path, stat)
@@ -0,0 +1,226 @@
+"""Caching the results of agent tools, so that an agent does not redo the same work over and over again."""
+import asyncio
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from langchain.tools.base import BaseTool
+
+from experiments.common.executors import disk_io_executor
+from experiments.common.repo_index import get_repo_index
+
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", 512))
+
+
+class _ToolResult(NamedTuple):
+    result: Any
+    repo_dir: str
+    # the repo paths the result depends on (None - it may depend on any file in the repo)
+    paths: frozenset[str] | None
+
+
+class ToolResultCache:
+    """Tool results keyed by (tool name, normalized arguments, repo index version), in an LRU."""
+
+    def __init__(self, max_size: int = TOOL_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+        self._results: OrderedDict[tuple, _ToolResult] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> _ToolResult | None:
+        """Look a result up (the hit or the miss is counted under the tool name)."""
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None:
+                self.misses[key[0]] += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits[key[0]] += 1
+            return cached
+
+    def put(self, key: tuple, result: Any, repo_dir: str, paths: frozenset[str] | None) -> None:
+        """Cache a result."""
+        with self._lock:
+            self._results[key] = _ToolResult(result, repo_dir, paths)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def invalidate_path(self, repo_dir: str, path: str) -> None:
+        """Drop the results that may depend on a file of a repo."""
+        with self._lock:
+            for key in [
+                key
+                for key, cached in self._results.items()
+                if cached.repo_dir == repo_dir and (cached.paths is None or path in cached.paths)
+            ]:
+                del self._results[key]
+
+
+# the results of read-only tools that are shared by all the sessions
+shared_tool_results = ToolResultCache()
+
+
+def _normalize_path(path: Any) -> str:
+    return os.path.normpath(str(path).strip())
+
+
+def _file_fingerprint(abs_path: Path) -> tuple[int, int] | None:
+    """(mtime, size) of a file - in-place edits change it, even though they don't change the repo index version."""
+    try:
+        stat = os.stat(abs_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# the tasks that report cache hits of synchronous tool calls (referenced, so that they are not garbage-collected)
+_hit_reports: set[asyncio.Task] = set()
+
+
+class CachedTool(BaseTool):
+    """
+    A wrapper that caches the results of a tool in a session cache (and, if the tool is `shared`, in
+    `shared_tool_results` as well, so other sessions benefit from them too). The wrapper takes the arguments of the
+    tool it wraps and works both with `run` and `arun`.
+
+    The results of a tool with a `path_arg` (the argument with the path of the file the tool reads) are keyed by the
+    tool name, the normalized arguments and the mtime and the size of the file, the results of the other tools are
+    keyed by the tool name, the normalized arguments and the version of the index of `repo_dir` (which is refreshed
+    before every call, so that the files that were added or removed since the last call are noticed).
+
+    A tool that `writes` is never cached - instead, it drops the cached results that may depend on the file it wrote
+    to (`path_arg` names the argument with the path) and marks the file as changed in the repo index.
+
+    `on_hit` (if given) is awaited with the name of the tool every time a result is served from the cache (when the
+    tool is called synchronously, it is scheduled on the running event loop, if there is one).
+    """
+
+    tool: BaseTool
+    session_cache: ToolResultCache
+    repo_dir: str = ""
+    path_arg: str | None = None
+    shared: bool = False
+    writes: bool = False
+    on_hit: Callable[[str], Awaitable[None]] | None = None
+
+    def __init__(self, tool: BaseTool, session_cache: ToolResultCache, **kwargs: Any) -> None:
+        super().__init__(
+            tool=tool,
+            session_cache=session_cache,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema,
+            **kwargs,
+        )
+
+    @property
+    def args(self) -> dict:
+        return self.tool.args
+
+    @property
+    def is_single_input(self) -> bool:
+        return self.tool.is_single_input
+
+    def _run(self, *args: Any, **kwargs: Any) -> Any:
+        tool_input = args[0] if args else kwargs
+        if self.writes:
+            result = self.tool.run(tool_input)
+            self._invalidate(tool_input)
+            return result
+
+        key = self._key(tool_input)
+        cached = self._lookup(key)
+        if cached is not None:
+            if self.on_hit:
+                try:
+                    task = asyncio.get_running_loop().create_task(self.on_hit(self.name))
+                except RuntimeError:
+                    pass
+                else:
+                    _hit_reports.add(task)
+                    task.add_done_callback(_hit_reports.discard)
+            return cached.result
+
+        result = self.tool.run(tool_input)
+        self._store(key, tool_input, result)
+        return result
+
+    async def _arun(self, *args: Any, **kwargs: Any) -> Any:
+        tool_input = args[0] if args else kwargs
+        if self.writes:
+            result = await self.tool.arun(tool_input)
+            await disk_io_executor.run(self._invalidate, tool_input)
+            return result
+
+        key = await disk_io_executor.run(self._key, tool_input)
+        cached = self._lookup(key)
+        if cached is not None:
+            if self.on_hit:
+                await self.on_hit(self.name)
+            return cached.result
+
+        result = await self.tool.arun(tool_input)
+        self._store(key, tool_input, result)
+        return result
+
+    def _caches(self) -> list[ToolResultCache]:
+        return [self.session_cache, shared_tool_results] if self.shared else [self.session_cache]
+
+    def _normalize_args(self, tool_input: str | dict) -> dict[str, Any]:
+        if isinstance(tool_input, str):
+            return {"input": " ".join(tool_input.split())}
+        args = dict(tool_input)
+        if self.tool.args_schema is not None:
+            try:
+                # fill in the defaults, so that omitted arguments and explicit defaults are the same thing
+                args = self.tool.args_schema.parse_obj(args).dict()
+            except Exception:  # pylint: disable=broad-exception-caught
+                pass
+        if self.path_arg and self.path_arg in args:
+            args[self.path_arg] = _normalize_path(args[self.path_arg])
+        return args
+
+    def _path(self, tool_input: str | dict) -> str | None:
+        return self._normalize_args(tool_input).get(self.path_arg) if self.path_arg else None
+
+    def _key(self, tool_input: str | dict) -> tuple:
+        """The cache key of a call (does blocking I/O - stats the file or refreshes the repo index)."""
+        normalized_args = self._normalize_args(tool_input)
+        path = normalized_args.get(self.path_arg) if self.path_arg else None
+        if path is not None:
+            state = _file_fingerprint(Path(self.repo_dir, path))
+        elif self.repo_dir:
+            state = get_repo_index(self.repo_dir).refresh()
+        else:
+            state = None
+        return self.name, json.dumps(normalized_args, sort_keys=True, default=str), state
+
+    def _lookup(self, key: tuple) -> _ToolResult | None:
+        for cache in self._caches():
+            cached = cache.get(key)
+            if cached is not None:
+                if cache is not self.session_cache:
+                    self.session_cache.put(key, cached.result, cached.repo_dir, cached.paths)
+                return cached
+        return None
+
+    def _store(self, key: tuple, tool_input: str | dict, result: Any) -> None:
+        path = self._path(tool_input)
+        paths = frozenset([path]) if path is not None else None
+        for cache in self._caches():
+            cache.put(key, result, self.repo_dir, paths)
+
+    def _invalidate(self, tool_input: str | dict) -> None:
+        path = self._path(tool_input)
+        if path is None:
+            return
+        for cache in (self.session_cache, shared_tool_results):
+            cache.invalidate_path(self.repo_dir, path)
+        if self.repo_dir:
+            get_repo_index(self.repo_dir).mark_dirty(Path(self.repo_dir, path))
@@ -0,0 +1,184 @@
+"""Conversation transcripts that are built incrementally instead of being re-collected and re-formatted every turn."""
+import functools
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+import tiktoken
+from mergedbots import MergedMessage
+
+from experiments.common.history import window_start
+from experiments.common.sqlite_bot_manager import SQLiteBotManager
+
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", 10_000))
+# how far back `TranscriptCache.aget()` looks for a cached transcript before it asks the bot manager for the history
+TRANSCRIPT_MAX_WALK = int(os.environ.get("TRANSCRIPT_MAX_WALK", 20))
+
+
+@functools.cache
+def get_token_encoding() -> tiktoken.Encoding:
+    """The encoding of both gpt-3.5-turbo and gpt-4 (loaded on first use - tiktoken may need to download it)."""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text the way gpt-3.5-turbo and gpt-4 would."""
+    return len(get_token_encoding().encode(text, disallowed_special=()))
+
+
+class TranscriptFormat(NamedTuple):
+    """
+    How the messages of a conversation are rendered for a prompt. `format_message` may return anything (e.g. a
+    `ChatMessage`), `get_text` extracts the text whose tokens are counted.
+    """
+
+    name: str
+    format_message: Callable[[MergedMessage], Any]
+    get_text: Callable[[Any], str] = str
+
+
+class _TranscriptBuffer:
+    """Bot-visible messages of a conversation along with their formatted versions and cumulative token counts."""
+
+    def __init__(self, messages: list[MergedMessage] | None = None) -> None:
+        self.messages: list[MergedMessage] = messages or []
+        self.formatted: dict[str, list[Any]] = {}
+        # cumulative_tokens[fmt][i] is the number of tokens in the first i formatted messages
+        self.cumulative_tokens: dict[str, list[int]] = {}
+        self.lock = threading.Lock()
+
+    def fork(self, length: int) -> "_TranscriptBuffer":
+        """A copy of the first `length` messages (for when a conversation branches)."""
+        with self.lock:
+            buffer = _TranscriptBuffer(self.messages[:length])
+            for fmt_name, formatted in self.formatted.items():
+                buffer.formatted[fmt_name] = formatted[:length]
+                buffer.cumulative_tokens[fmt_name] = self.cumulative_tokens[fmt_name][: length + 1]
+        return buffer
+
+    def ensure_formatted(self, fmt: TranscriptFormat, length: int) -> None:
+        """Format (and count the tokens of) the messages that were not formatted in this format yet."""
+        with self.lock:
+            formatted = self.formatted.setdefault(fmt.name, [])
+            cumulative_tokens = self.cumulative_tokens.setdefault(fmt.name, [0])
+            for msg in self.messages[len(formatted) : length]:
+                formatted_msg = fmt.format_message(msg)
+                formatted.append(formatted_msg)
+                cumulative_tokens.append(cumulative_tokens[-1] + count_tokens(fmt.get_text(formatted_msg)))
+
+
+class Transcript:
+    """The bot-visible messages of a conversation up to (and including) a certain message."""
+
+    def __init__(self, buffer: _TranscriptBuffer, length: int) -> None:
+        self._buffer = buffer
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def messages(self) -> list[MergedMessage]:
+        """The same messages `MergedMessage.get_full_conversion()` would return."""
+        return self._buffer.messages[: self._length]
+
+    def formatted(self, fmt: TranscriptFormat, start: int = 0) -> list[Any]:
+        """The messages (starting from `start`) rendered in a format (every message is only rendered once)."""
+        self._buffer.ensure_formatted(fmt, self._length)
+        return self._buffer.formatted[fmt.name][start : self._length]
+
+    def tokens_before(self, fmt: TranscriptFormat, index: int) -> int:
+        """The number of tokens in the first `index` messages rendered in a format."""
+        self._buffer.ensure_formatted(fmt, self._length)
+        return self._buffer.cumulative_tokens[fmt.name][min(index, self._length)]
+
+    def window_start(self, fmt: TranscriptFormat, token_budget: int) -> int:
+        """The index of the first message of the most recent messages that fit into a token budget in a format."""
+        self._buffer.ensure_formatted(fmt, self._length)
+        return window_start(self._buffer.cumulative_tokens[fmt.name], token_budget, end=self._length)
+
+    def total_tokens(self, fmt: TranscriptFormat) -> int:
+        """The number of tokens in all the messages rendered in a format."""
+        return self.tokens_before(fmt, self._length)
+
+
+class TranscriptCache:
+    """
+    Transcripts of conversations keyed by the uuid of their last message. A transcript of a new message is built by
+    walking back through `previous_msg` only until a message with a cached transcript is found - the new messages are
+    appended to the buffer of that transcript (which is shared, not copied, unless the conversation branches).
+    """
+
+    def __init__(self, max_size: int = TRANSCRIPT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        # message uuid -> (buffer, number of bot-visible messages up to and including the message)
+        self._transcripts: OrderedDict[str, tuple[_TranscriptBuffer, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, message: MergedMessage) -> Transcript:
+        """Get the transcript of the conversation that ends with a message."""
+        with self._lock:
+            new_messages = []
+            msg = message
+            cached = None
+            while msg is not None:
+                cached = self._transcripts.get(msg.uuid)
+                if cached is not None:
+                    self._transcripts.move_to_end(msg.uuid)
+                    break
+                new_messages.append(msg)
+                msg = msg.previous_msg
+
+            buffer, length = cached or (_TranscriptBuffer(), 0)
+            if new_messages:
+                with buffer.lock:
+                    is_tip = length == len(buffer.messages)
+                if not is_tip:
+                    buffer = buffer.fork(length)
+
+                for msg in reversed(new_messages):
+                    if msg.is_visible_to_bots:
+                        with buffer.lock:
+                            buffer.messages.append(msg)
+                        length += 1
+                    self._transcripts[msg.uuid] = (buffer, length)
+
+                self._evict()
+            return Transcript(buffer, length)
+
+    async def aget(self, message: MergedMessage, max_walk: int = TRANSCRIPT_MAX_WALK) -> Transcript:
+        """
+        Same as `get()`, but when the conversation is managed by a `SQLiteBotManager` and there is no cached transcript
+        within `max_walk` messages back, the history is fetched with the indexed `get_full_conversion()` of the
+        manager instead of walking `previous_msg` all the way back.
+        """
+        if not isinstance(getattr(message, "manager", None), SQLiteBotManager) or self._is_cached_nearby(
+            message, max_walk
+        ):
+            return self.get(message)
+
+        messages = await message.manager.get_full_conversion(message)
+        with self._lock:
+            cached = self._transcripts.get(message.uuid)
+            if cached is None:
+                cached = self._transcripts[message.uuid] = (_TranscriptBuffer(list(messages)), len(messages))
+                self._evict()
+            return Transcript(*cached)
+
+    def _is_cached_nearby(self, message: MergedMessage, max_walk: int) -> bool:
+        with self._lock:
+            msg = message
+            for _ in range(max_walk + 1):
+                if msg is None or msg.uuid in self._transcripts:
+                    # (a conversation that ends soon enough is as good as a cached one)
+                    return True
+                msg = msg.previous_msg
+            return False
+
+    def _evict(self) -> None:
+        while len(self._transcripts) > self.max_size:
+            self._transcripts.popitem(last=False)
+
+
+transcript_cache = TranscriptCache()
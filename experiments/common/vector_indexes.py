@@ -0,0 +1,153 @@
+"""FAISS indexes that start exact and switch to approximate nearest neighbour search as they grow."""
+import math
+import os
+from typing import Any, Awaitable, Callable, Iterable
+
+import faiss
+import numpy as np
+from langchain import FAISS, InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+
+EMBEDDING_SIZE = 1536
+
+# "flat" (exact search, never migrated), "hnsw" or "ivfpq"
+VECTOR_INDEX_MODE = os.environ.get("VECTOR_INDEX_MODE", "hnsw")
+# stores start as flat indexes and are migrated to VECTOR_INDEX_MODE once they have this many vectors
+VECTOR_INDEX_MIGRATION_THRESHOLD = int(os.environ.get("VECTOR_INDEX_MIGRATION_THRESHOLD", 10_000))
+
+HNSW_M = int(os.environ.get("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 80))
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 64))
+IVFPQ_SUBQUANTIZERS = int(os.environ.get("IVFPQ_SUBQUANTIZERS", 64))
+IVFPQ_NPROBE = int(os.environ.get("IVFPQ_NPROBE", 16))
+IVFPQ_MAX_TRAINING_VECTORS = 50_000
+
+INDEX_MODES = ("flat", "hnsw", "ivfpq")
+
+
+def create_index(mode: str, dimension: int = EMBEDDING_SIZE, training_vectors: np.ndarray | None = None) -> Any:
+    """
+    Create an empty FAISS index. IVF-PQ indexes need to be trained, hence `training_vectors` are mandatory for them
+    (and there should be at least a few thousand of them).
+    """
+    if mode == "flat":
+        return faiss.IndexFlatL2(dimension)
+
+    if mode == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+
+    if mode == "ivfpq":
+        if training_vectors is None:
+            raise ValueError("IVF-PQ index cannot be created without training vectors")
+        # roughly 4 * sqrt(n) inverted lists, but no less than 39 training vectors per list (faiss recommendation)
+        nlist = max(1, min(int(4 * math.sqrt(len(training_vectors))), len(training_vectors) // 39))
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatL2(dimension), dimension, nlist, math.gcd(dimension, IVFPQ_SUBQUANTIZERS), 8
+        )
+        if len(training_vectors) > IVFPQ_MAX_TRAINING_VECTORS:
+            sample = np.random.default_rng(0).choice(len(training_vectors), IVFPQ_MAX_TRAINING_VECTORS, replace=False)
+            training_vectors = training_vectors[sample]
+        index.train(training_vectors)
+        index.nprobe = IVFPQ_NPROBE
+        return index
+
+    raise ValueError(f"unknown vector index mode: {mode!r} (expected one of {INDEX_MODES})")
+
+
+def index_mode(index: Any) -> str:
+    """Tell which of the supported modes an index was created in."""
+    if isinstance(index, faiss.IndexHNSWFlat):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    return "flat"
+
+
+def migrate_index(index: Any, mode: str) -> Any:
+    """
+    Build an index of a different mode out of the vectors of an existing one. The order of the vectors is preserved,
+    so the mapping from index positions to docstore ids stays valid. Works for flat and HNSW source indexes (IVF-PQ
+    vectors are lossy and cannot be reconstructed exactly).
+    """
+    vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.empty((0, index.d), dtype=np.float32)
+    new_index = create_index(mode, index.d, training_vectors=vectors)
+    if len(vectors):
+        new_index.add(vectors)
+    return new_index
+
+
+class AdaptiveFAISS(FAISS):
+    """
+    A FAISS vector store that starts with an exact (flat) index and migrates to an approximate one (`index_mode`)
+    once it has `migration_threshold` vectors. If `embed_documents` is given, texts that are added together are
+    embedded in a single call. `aembed_query` (if given) embeds a query without blocking the event loop.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable,
+        index: Any,
+        docstore: InMemoryDocstore,
+        index_to_docstore_id: dict[int, str],
+        index_mode: str = VECTOR_INDEX_MODE,
+        migration_threshold: int = VECTOR_INDEX_MIGRATION_THRESHOLD,
+        embed_documents: Callable[[list[str]], list[list[float]]] | None = None,
+        aembed_query: Callable[[str], Awaitable[list[float]]] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(embedding_function, index, docstore, index_to_docstore_id, **kwargs)
+        if index_mode not in INDEX_MODES:
+            raise ValueError(f"unknown vector index mode: {index_mode!r} (expected one of {INDEX_MODES})")
+        self.index_mode = index_mode
+        self.migration_threshold = migration_threshold
+        self.embed_documents = embed_documents
+        self.aembed_query = aembed_query
+
+    @classmethod
+    def empty(cls, embeddings: Embeddings, dimension: int = EMBEDDING_SIZE, **kwargs: Any) -> "AdaptiveFAISS":
+        """Create an empty store."""
+        return cls(
+            embeddings.embed_query,
+            create_index("flat", dimension),
+            InMemoryDocstore({}),
+            {},
+            embed_documents=embeddings.embed_documents,
+            aembed_query=getattr(embeddings, "aembed_query", None),
+            **kwargs,
+        )
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, **kwargs: Any) -> list[str]:
+        """Add texts (`embeddings` of the texts that were computed in advance, see `embed_texts()`, can be passed)."""
+        texts = list(texts)
+        embeddings = kwargs.pop("embeddings", None)
+        if embeddings is None:
+            embeddings = self.embed_texts(texts)
+        return self.add_embeddings(zip(texts, embeddings), metadatas, **kwargs)
+
+    def embed_texts(self, texts: list[str]) -> list[list[float]]:
+        """Embed texts the way `add_texts()` would."""
+        if self.embed_documents:
+            return self.embed_documents(texts)
+        return [self.embedding_function(text) for text in texts]
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[tuple[str, list[float]]],
+        metadatas: list[dict] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        ids = super().add_embeddings(text_embeddings, metadatas, **kwargs)
+        self.maybe_migrate()
+        return ids
+
+    def maybe_migrate(self) -> bool:
+        """Migrate the index if it has crossed the threshold (returns True if it did)."""
+        if self.index_mode == "flat" or self.index.ntotal < self.migration_threshold:
+            return False
+        if index_mode(self.index) != "flat":
+            return False
+        self.index = migrate_index(self.index, self.index_mode)
+        return True
@@ -1,17 +1,25 @@
+import atexit
 import datetime
 import math
+import os
+from pathlib import Path
 from typing import Any, AsyncGenerator
 
-import faiss
-from langchain import FAISS, InMemoryDocstore
-from langchain.chat_models import PromptLayerChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.experimental import GenerativeAgentMemory
 from langchain.retrievers import TimeWeightedVectorStoreRetriever
 from langchain.schema import Document
 from mergedbots import MergedBot, MergedMessage
 
+from experiments.common.async_memory import AsyncShardedMemory
 from experiments.common.bot_manager import FAST_GPT_MODEL, bot_manager
+from experiments.common.embeddings import get_embedding_service
+from experiments.common.llm_clients import get_chat_llm, in_llm_request, llm_request
+from experiments.common.llm_scheduler import LLMPriority
+from experiments.common.memory_shards import MemoryShardManager
+from experiments.common.memory_store import MEMORY_DIR, PersistentFAISS
+from experiments.common.reflection import DeferredReflectionMemory, ReflectionScheduler
+
+# acknowledge memory writes right away and apply them in the background
+MEMORY_BACKGROUND_WRITES = os.environ.get("MEMORY_BACKGROUND_WRITES", "true").lower() in ("1", "true", "yes")
 
 
 class PatchedTimeWeightedVectorStoreRetriever(TimeWeightedVectorStoreRetriever):
@@ -35,43 +43,75 @@ def relevance_score_fn(score: float) -> float:
     return 1.0 - score / math.sqrt(2)
 
 
-def create_new_memory_retriever():
-    """Create a new vector store retriever unique to the agent."""
-    # Define your embedding model
-    embeddings_model = OpenAIEmbeddings()
-    # Initialize the vectorstore as empty
-    embedding_size = 1536
-    # TODO save it to disk after every interaction ?
-    index = faiss.IndexFlatL2(embedding_size)
-    vectorstore = FAISS(
-        embeddings_model.embed_query, index, InMemoryDocstore({}), {}, relevance_score_fn=relevance_score_fn
+def create_new_memory_retriever(store_dir: str | Path):
+    """
+    Create a vector store retriever unique to the agent. The memories are persisted in `store_dir` and the ones that
+    are already there are loaded (without re-embedding them).
+    """
+    vectorstore = PersistentFAISS.load(store_dir, get_embedding_service(), relevance_score_fn=relevance_score_fn)
+    # the documents in the docstore share their metadata with the memory stream, so `last_accessed_at` updates made by
+    # the retriever end up in the snapshots
+    memory_stream = sorted(vectorstore.documents(), key=lambda doc: doc.metadata["buffer_idx"])
+    return PatchedTimeWeightedVectorStoreRetriever(
+        vectorstore=vectorstore, memory_stream=memory_stream, other_score_keys=["importance"], k=15
+    )
+
+
+LLM = get_chat_llm(FAST_GPT_MODEL, max_tokens=1500)  # TODO shouldn't this be SLOW_GPT_MODEL ?
+
+
+def create_memory(shard_id: str) -> DeferredReflectionMemory:
+    """Create (load) the memory of a single user."""
+    return DeferredReflectionMemory(
+        llm=LLM,
+        memory_retriever=create_new_memory_retriever(MEMORY_DIR / "shards" / shard_id),
+        verbose=False,
+        reflection_threshold=8,  # we will give this a relatively low number to show how reflection works
+        shard_id=shard_id,
+        reflection_scheduler=reflection_scheduler,
     )
-    return PatchedTimeWeightedVectorStoreRetriever(vectorstore=vectorstore, other_score_keys=["importance"], k=15)
 
 
-LLM = PromptLayerChatOpenAI(
-    model_name=FAST_GPT_MODEL,  # TODO shouldn't this be SLOW_GPT_MODEL ?
-    max_tokens=1500,
-    pl_tags=["memory"],
-)  # Can be any LLM you want.
+def reflect_on_memory(shard_id: str) -> None:
+    """Reflect on the recent memories of a single user (called by the reflection scheduler in the background)."""
+    with llm_request(user=shard_id, pl_tags=["memory", "reflection"], priority=LLMPriority.BACKGROUND):
+        # the lock is released while the LLM thinks, so the pin is what keeps the shard from being spilled meanwhile
+        with memory_shards.pinned(shard_id) as memory:
+            memory.reflect(memory_shards.lock(shard_id))
 
-# TODO memory instance per user
-memory = GenerativeAgentMemory(
-    llm=LLM,
-    memory_retriever=create_new_memory_retriever(),
-    verbose=False,
-    reflection_threshold=8,  # we will give this a relatively low number to show how reflection works
-)
+
+memory_shards = MemoryShardManager(create_memory, lambda memory: memory.memory_retriever.vectorstore)
+async_memory = AsyncShardedMemory(memory_shards)
+reflection_scheduler = ReflectionScheduler(reflect_on_memory)
+atexit.register(async_memory.close)
+atexit.register(reflection_scheduler.close)
 
 
 @bot_manager.create_bot(handle="MemoryBot")
 async def memory_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
-    memory.add_memory(f"{message.sender.name.upper()} SAYS: {message.content}")
-    yield await message.service_followup_as_final_response(bot, "`MEMORY UPDATED`")
+    reflection_scheduler.note_activity()
+    shard_id = str(message.originator.uuid)
+    memory_content = f"{message.sender.name.upper()} SAYS: {message.content}"
+    if MEMORY_BACKGROUND_WRITES:
+        # the background job inherits the LLM request context from here
+        with llm_request(user=shard_id, pl_tags=["memory"], priority=LLMPriority.BACKGROUND):
+            async_memory.add_memory_in_background(shard_id, memory_content)
+        yield await message.service_followup_as_final_response(bot, "`MEMORY UPDATE QUEUED`")
+    else:
+        await in_llm_request(
+            async_memory.add_memory(shard_id, memory_content),
+            user=shard_id,
+            pl_tags=["memory"],
+            priority=LLMPriority.BACKGROUND,
+        )
+        yield await message.service_followup_as_final_response(bot, "`MEMORY UPDATED`")
 
 
 @bot_manager.create_bot(handle="RecallBot")
 async def recall_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
-    memory_docs = memory.fetch_memories(f"{message.sender.name.upper()} SAYS: {message.content}")
+    reflection_scheduler.note_activity()
+    memory_docs = await async_memory.fetch_memories(
+        str(message.originator.uuid), f"{message.sender.name.upper()} SAYS: {message.content}"
+    )
     for doc in memory_docs:
         yield await message.service_followup_as_final_response(bot, f"```\n{doc.page_content}\n```")
@@ -1,4 +1,8 @@
-from typing import List
+import asyncio
+import json
+import os
+import time
+from typing import Callable, List
 from typing import Optional
 
 from langchain.callbacks.manager import (
@@ -8,8 +12,10 @@ from langchain.callbacks.manager import (
 from langchain.chains.llm import LLMChain
 from langchain.chat_models.base import BaseChatModel
 from langchain.experimental.autonomous_agents.autogpt.output_parser import (
+    AutoGPTAction,
     AutoGPTOutputParser,
     BaseAutoGPTOutputParser,
+    preprocess_json_input,
 )
 from langchain.experimental.autonomous_agents.autogpt.prompt import AutoGPTPrompt
 from langchain.experimental.autonomous_agents.autogpt.prompt_generator import (
@@ -28,6 +34,15 @@ from mergedbots import MergedMessage, MergedBot
 from mergedbots.experimental.sequential import ConversationSequence
 from pydantic import ValidationError
 
+from experiments.common.executors import memory_executor
+from experiments.common.history import AUTOGPT_HISTORY_TOKEN_BUDGET, CachedTokenCounter, TokenBudgetedHistory
+from experiments.common.observations import OBSERVATION_MAX_TOKENS, BlobStore, ObservationCompactor, ReadBlobTool
+from experiments.common.vector_indexes import AdaptiveFAISS
+
+# with more than one command per turn the agent may ask for several independent commands at once
+AUTOGPT_MAX_COMMANDS_PER_TURN = int(os.environ.get("AUTOGPT_MAX_COMMANDS_PER_TURN", 1))
+AUTOGPT_TOOL_CONCURRENCY = int(os.environ.get("AUTOGPT_TOOL_CONCURRENCY", 4))
+
 
 class HumanInputRun(BaseTool):
     """Tool that adds the capability to ask user for input."""
@@ -81,15 +96,29 @@ class AutoGPT:
         output_parser: BaseAutoGPTOutputParser,
         tools: List[BaseTool],
         feedback_tool: HumanInputRun,
+        token_counter: Callable[[str], int],
+        max_commands_per_turn: int = AUTOGPT_MAX_COMMANDS_PER_TURN,
+        tool_concurrency: int = AUTOGPT_TOOL_CONCURRENCY,
+        observation_compactor: Optional[ObservationCompactor] = None,
     ):
         self.ai_name = ai_name
         self.memory = memory
-        self.full_message_history: List[BaseMessage] = []
+        self.message_history = TokenBudgetedHistory(AUTOGPT_HISTORY_TOKEN_BUDGET, token_counter)
         self.next_action_count = 0
         self.chain = chain
         self.output_parser = output_parser
         self.tools = tools
+        self.tools_by_name = {tool.name: tool for tool in tools}
         self.feedback_tool = feedback_tool
+        self.max_commands_per_turn = max_commands_per_turn
+        self.tool_concurrency = tool_concurrency
+        self.observation_compactor = observation_compactor
+        # the prompt tokens the compaction of observations saved over the whole session (an observation saves tokens
+        # in every prompt it takes part in)
+        self.prompt_tokens_saved = 0
+        # the history messages with compacted observations and the tokens each of them saves
+        self._compacted_messages: list[tuple[BaseMessage, int]] = []
+        self._memory_write: asyncio.Task | None = None
 
     @classmethod
     def from_llm_and_tools(
@@ -102,12 +131,20 @@ class AutoGPT:
         feedback_tool: Optional[HumanInputRun],
         output_parser: Optional[BaseAutoGPTOutputParser] = None,
     ) -> "AutoGPT":
+        # the prompt counts the tokens of the same texts (its own base prompt included) over and over again
+        token_counter = CachedTokenCounter(llm.get_num_tokens)
+        observation_compactor = None
+        if OBSERVATION_MAX_TOKENS:
+            # large command outputs are kept out of the prompt, the agent reads them on demand
+            blob_store = BlobStore()
+            observation_compactor = ObservationCompactor(blob_store, token_counter)
+            tools = [*tools, ReadBlobTool(blob_store=blob_store)]
         prompt = AutoGPTPrompt(
             ai_name=ai_name,
             ai_role=ai_role,
             tools=tools,
             input_variables=["memory", "messages", "goals", "user_input"],
-            token_counter=llm.get_num_tokens,
+            token_counter=token_counter,
         )
         chain = LLMChain(llm=llm, prompt=prompt)
         return cls(
@@ -117,68 +154,160 @@ class AutoGPT:
             output_parser or AutoGPTOutputParser(),
             tools,
             feedback_tool,
+            token_counter,
+            observation_compactor=observation_compactor,
         )
 
     async def arun(self, goals: List[str]) -> str:
         user_input = "Determine which next command to use, " "and respond using the format specified above:"
+        if self.max_commands_per_turn > 1:
+            user_input += (
+                f" If there are several commands that do not depend on each other's results, you may use up to "
+                f"{self.max_commands_per_turn} of them at once (they will run at the same time) - put a \"commands\" "
+                f'list of {{"name": ..., "args": {{...}}}} objects into your response instead of the "command" object.'
+            )
+        start_time = time.perf_counter()
         # Interaction Loop
         loop_count = 0
-        while True:
-            # Discontinue if continuous limit is reached
-            loop_count += 1
-
-            # Send message to AI, get response
-            assistant_reply = await self.chain.arun(
-                goals=goals,
-                messages=self.full_message_history,
-                memory=self.memory,
-                user_input=user_input,
-            )
+        try:
+            while True:
+                # Discontinue if continuous limit is reached
+                loop_count += 1
 
-            # Print Assistant thoughts
-            await self.feedback_tool.send_feedback(f"```json\n{assistant_reply}\n```")
-
-            # TODO replace this history with the mergedbots history ?
-            self.full_message_history.append(HumanMessage(content=user_input))
-            self.full_message_history.append(AIMessage(content=assistant_reply))
-
-            # Get command name and arguments
-            action = self.output_parser.parse(assistant_reply)
-            tools = {t.name: t for t in self.tools}
-            if action.name == FINISH_NAME:
-                if self.feedback_tool is not None:
-                    await self.feedback_tool.send_feedback(
-                        f"FINISHED: {action.args['response']}", is_still_typing=False
-                    )
-                return action.args["response"]
-
-            tool = None
-            if action.name in tools:
-                tool = tools[action.name]
-                try:
-                    observation = await tool.arun(action.args)
-                except ValidationError as e:
-                    observation = f"Validation Error in args: {str(e)}, args: {action.args}"
-                except Exception as e:
-                    observation = f"Error: {str(e)}, {type(e).__name__}, args: {action.args}"
-                result = f"Command {tool.name} returned: {observation}"
-            elif action.name == "ERROR":
-                result = f"Error: {action.args}. "
-            else:
-                result = (
-                    f"Unknown command '{action.name}'. "
-                    f"Please refer to the 'COMMANDS' list for available "
-                    f"commands and only respond in the specified JSON format."
+                # Send message to AI, get response (the memory of the previous step might still be being written)
+                messages = self.message_history.messages()
+                self._count_prompt_tokens_saved(messages)
+                await self._embed_memory_query(messages)
+                assistant_reply = await self.chain.arun(
+                    goals=goals,
+                    messages=messages,
+                    memory=self.memory,
+                    user_input=user_input,
                 )
 
-            memory_to_add = f"Assistant Reply: {assistant_reply} " f"\nResult: {result} "
-            if not isinstance(tool, HumanInputRun):
-                await self.feedback_tool.send_feedback(result)
-                feedback = await self.feedback_tool.arun("Input: ")
-                if feedback in {"q", "stop"}:
-                    await self.feedback_tool.send_feedback("EXITING", is_still_typing=False)
-                    return "EXITING"
-                memory_to_add += f"\n{feedback}"
+                # Print Assistant thoughts
+                await self.feedback_tool.send_feedback(f"```json\n{assistant_reply}\n```")
+
+                # TODO replace this history with the mergedbots history ?
+                self.message_history.append(HumanMessage(content=user_input))
+                self.message_history.append(AIMessage(content=assistant_reply))
 
+                # Get command names and arguments
+                actions = self.parse_actions(assistant_reply)
+                finish_action = next((action for action in actions if action.name == FINISH_NAME), None)
+                if finish_action:
+                    if self.feedback_tool is not None:
+                        await self.feedback_tool.send_feedback(
+                            f"FINISHED: {finish_action.args['response']}", is_still_typing=False
+                        )
+                    print(f"AUTOGPT: goals reached in {time.perf_counter() - start_time:.1f}s, {loop_count} turns")
+                    return finish_action.args["response"]
+
+                # independent commands run concurrently, but no more than `tool_concurrency` at a time
+                semaphore = asyncio.Semaphore(self.tool_concurrency)
+                tokens_saved_before = self.observation_compactor.tokens_saved if self.observation_compactor else 0
+                results = await asyncio.gather(*(self._execute(action, semaphore) for action in actions))
+                result = "\n".join(results)
+                tokens_saved = (
+                    self.observation_compactor.tokens_saved - tokens_saved_before if self.observation_compactor else 0
+                )
+
+                memory_to_add = f"Assistant Reply: {assistant_reply} " f"\nResult: {result} "
+                if not any(isinstance(self.tools_by_name.get(action.name), HumanInputRun) for action in actions):
+                    await self.feedback_tool.send_feedback(result)
+                    feedback = await self.feedback_tool.arun("Input: ")
+                    if feedback in {"q", "stop"}:
+                        await self.feedback_tool.send_feedback("EXITING", is_still_typing=False)
+                        return "EXITING"
+                    memory_to_add += f"\n{feedback}"
+
+                await self._remember(memory_to_add)
+                result_message = SystemMessage(content=result)
+                self.message_history.append(result_message)
+                if tokens_saved:
+                    self._compacted_messages.append((result_message, tokens_saved))
+        finally:
+            if self._memory_write is not None:
+                await self._memory_write
+            if self.observation_compactor and self.observation_compactor.compacted_observations:
+                print(
+                    f"AUTOGPT: {self.observation_compactor.compacted_observations} observations compacted, "
+                    f"{self.prompt_tokens_saved} prompt tokens saved"
+                )
+
+    def parse_actions(self, assistant_reply: str) -> list[AutoGPTAction]:
+        """The commands of a reply (more than one only if `max_commands_per_turn` allows it)."""
+        if self.max_commands_per_turn > 1:
+            try:
+                parsed = json.loads(preprocess_json_input(assistant_reply), strict=False)
+            except json.JSONDecodeError:
+                parsed = None
+            commands = parsed.get("commands") if isinstance(parsed, dict) else None
+            if isinstance(commands, list) and commands:
+                return [
+                    AutoGPTAction(name=command["name"], args=command.get("args") or {})
+                    if isinstance(command, dict) and "name" in command
+                    else AutoGPTAction(name="ERROR", args={"error": f"Incomplete command: {command}"})
+                    for command in commands[: self.max_commands_per_turn]
+                ]
+        return [self.output_parser.parse(assistant_reply)]
+
+    async def _execute(self, action: AutoGPTAction, semaphore: asyncio.Semaphore) -> str:
+        if action.name in self.tools_by_name:
+            tool = self.tools_by_name[action.name]
+            try:
+                async with semaphore:
+                    observation = await tool.arun(action.args)
+            except ValidationError as e:
+                observation = f"Validation Error in args: {str(e)}, args: {action.args}"
+            except Exception as e:
+                observation = f"Error: {str(e)}, {type(e).__name__}, args: {action.args}"
+            if self.observation_compactor and not isinstance(tool, ReadBlobTool):
+                observation = await self.observation_compactor.compact(str(observation))
+            return f"Command {tool.name} returned: {observation}"
+        if action.name == "ERROR":
+            return f"Error: {action.args}. "
+        return (
+            f"Unknown command '{action.name}'. "
+            f"Please refer to the 'COMMANDS' list for available "
+            f"commands and only respond in the specified JSON format."
+        )
+
+    def _count_prompt_tokens_saved(self, messages: list[BaseMessage]) -> None:
+        # the window of the history only moves forward, so the messages that left it are forgotten
+        in_window = {id(message) for message in messages}
+        self._compacted_messages = [
+            (message, saved) for message, saved in self._compacted_messages if id(message) in in_window
+        ]
+        self.prompt_tokens_saved += sum(saved for _, saved in self._compacted_messages)
+
+    async def _embed_memory_query(self, messages: list[BaseMessage]) -> None:
+        """
+        Embed the query the prompt looks the relevant memories up with (the prompt does it synchronously, on the event
+        loop) without blocking the event loop - the prompt then finds the embedding in the cache of the embeddings.
+        """
+        vectorstore = getattr(self.memory, "vectorstore", None)
+        if isinstance(vectorstore, AdaptiveFAISS) and vectorstore.aembed_query:
+            # (the same query `AutoGPTPrompt.format_messages()` makes)
+            await vectorstore.aembed_query(str(messages[-10:]))
+
+    async def _remember(self, memory_to_add: str) -> None:
+        """
+        Start writing a memory. The embedding is computed in the background, while the agent goes on with its next LLM
+        call, and the vector is added to the store on the event loop (where the prompt reads the store as well).
+        Memories are written one at a time, in order.
+        """
+        if self._memory_write is not None:
+            await self._memory_write
+            self._memory_write = None
+
+        vectorstore = getattr(self.memory, "vectorstore", None)
+        if not isinstance(vectorstore, AdaptiveFAISS) or not vectorstore.embed_documents:
             self.memory.add_documents([Document(page_content=memory_to_add)])
-            self.full_message_history.append(SystemMessage(content=result))
+            return
+
+        async def write() -> None:
+            embeddings = await memory_executor.run(vectorstore.embed_documents, [memory_to_add])
+            vectorstore.add_embeddings(zip([memory_to_add], embeddings))
+
+        self._memory_write = asyncio.create_task(write())
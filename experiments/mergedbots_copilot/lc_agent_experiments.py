@@ -2,38 +2,60 @@ import secrets
 from pathlib import Path
 
 from langchain.agents import initialize_agent, AgentType
-from langchain.chat_models import PromptLayerChatOpenAI
 from mergedbots import MergedBot
 from mergedbots.experimental.sequential import SequentialMergedBotWrapper, ConversationSequence
 
 from experiments.common.bot_manager import SLOW_GPT_MODEL, bot_manager
+from experiments.common.llm_clients import get_chat_llm, llm_request
+from experiments.common.llm_scheduler import LLMPriority
 from experiments.common.repo_access_utils import ListRepoTool, ReadFileTool, WriteFileTool
+from experiments.common.tool_cache import CachedTool, ToolResultCache
 
 
 @SequentialMergedBotWrapper(bot_manager.create_bot(handle="LcAgentExperiments"))
 async def lc_agent_experiments(bot: MergedBot, conv_sequence: ConversationSequence) -> None:
     root_dir = (Path(__file__).parents[3] / "mergedbots").as_posix()
+    model_name = SLOW_GPT_MODEL
+    message = await conv_sequence.wait_for_incoming()
+
+    async def report_cache_hit(tool_name: str) -> None:
+        await conv_sequence.yield_outgoing(
+            await message.service_followup_for_user(bot, f"`{tool_name}`: cached result")
+        )
+
+    # the results of the reading tools are reused until the writing tool touches the files they depend on
+    tool_results = ToolResultCache()
     tools = [
-        ListRepoTool(root_dir=root_dir),
-        ReadFileTool(root_dir=root_dir),
-        WriteFileTool(root_dir=root_dir),
+        CachedTool(
+            ListRepoTool(root_dir=root_dir), tool_results, repo_dir=root_dir, shared=True, on_hit=report_cache_hit
+        ),
+        CachedTool(
+            ReadFileTool(root_dir=root_dir),
+            tool_results,
+            repo_dir=root_dir,
+            path_arg="file_path",
+            shared=True,
+            on_hit=report_cache_hit,
+        ),
+        CachedTool(
+            WriteFileTool(root_dir=root_dir), tool_results, repo_dir=root_dir, path_arg="file_path", writes=True
+        ),
     ]
 
-    model_name = SLOW_GPT_MODEL
-    message = await conv_sequence.wait_for_incoming()
     await conv_sequence.yield_outgoing(await message.service_followup_for_user(bot, f"`{model_name}`"))
 
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=model_name,
-        temperature=0,
-        model_kwargs={
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["lc_agent_exp", secrets.token_hex(4)],
+    react = initialize_agent(
+        tools, get_chat_llm(model_name, temperature=0.0), agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION
     )
-    react = initialize_agent(tools, chat_llm, agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION)
 
-    while True:
-        # TODO feed in the dialog history too ?
-        await conv_sequence.yield_outgoing(await message.final_bot_response(bot, await react.arun(message.content)))
-        message = await conv_sequence.wait_for_incoming()
+    with llm_request(
+        user=str(message.originator.uuid),
+        pl_tags=["lc_agent_exp", secrets.token_hex(4)],
+        priority=LLMPriority.AGENT_STEP,
+    ):
+        while True:
+            # TODO feed in the dialog history too ?
+            await conv_sequence.yield_outgoing(
+                await message.final_bot_response(bot, await react.arun(message.content))
+            )
+            message = await conv_sequence.wait_for_incoming()
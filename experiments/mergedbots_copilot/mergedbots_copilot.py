@@ -4,19 +4,23 @@ import secrets
 from typing import Any
 from uuid import uuid4
 
-import faiss
-from langchain import LLMChain, FAISS, InMemoryDocstore
-from langchain.chat_models import PromptLayerChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
+from langchain import LLMChain
 from langchain.prompts import HumanMessagePromptTemplate, SystemMessagePromptTemplate, ChatPromptTemplate
 from langchain.tools import BaseTool
 from mergedbots import MergedBot, MergedMessage, MergedParticipant
 from mergedbots.experimental.sequential import SequentialMergedBotWrapper, ConversationSequence
 from pydantic import Field
 
+from experiments.common.bot_calls import BotCallCache, bot_call_session
 from experiments.common.bot_manager import bot_manager, FAST_GPT_MODEL, SLOW_GPT_MODEL
+from experiments.common.embeddings import get_embedding_service
+from experiments.common.llm_cache import CachePolicy
+from experiments.common.llm_clients import get_chat_llm, in_llm_request
+from experiments.common.llm_scheduler import LLMPriority
+from experiments.common.tool_cache import CachedTool, ToolResultCache
+from experiments.common.vector_indexes import AdaptiveFAISS
 from experiments.mergedbots_copilot.autogpt import AutoGPT, HumanInputRun
-from experiments.mergedbots_copilot.repo_bots import list_repo_tool, read_file_bot
+from experiments.mergedbots_copilot.repo_bots import REPO_DIR, list_repo_tool, read_file_bot
 
 AICONFIG_PROMPT = ChatPromptTemplate.from_messages(
     [
@@ -59,20 +63,17 @@ uncertainty to ensure your marketing strategy remains on track."""
 
 @bot_manager.create_bot(handle="AutoGPTConfigBot")
 async def autogpt_aiconfig(bot: MergedBot, message: MergedMessage) -> None:
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=FAST_GPT_MODEL,
-        temperature=0.0,
-        model_kwargs={
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["autogpt_conf"],
-    )
     llm_chain = LLMChain(
-        llm=chat_llm,
+        llm=get_chat_llm(FAST_GPT_MODEL, temperature=0.0),
         prompt=AICONFIG_PROMPT,
     )
 
-    output = await llm_chain.arun(user_prompt=message.content)
+    output = await in_llm_request(
+        llm_chain.arun(user_prompt=message.content),
+        user=str(message.originator.uuid),
+        pl_tags=["autogpt_conf"],
+        cache=CachePolicy("autogpt_conf"),
+    )
 
     try:
         ai_name = re.search(r"Name(?:\s*):(?:\s*)(.*)", output, re.IGNORECASE).group(1)
@@ -96,10 +97,7 @@ async def autogpt_aiconfig(bot: MergedBot, message: MergedMessage) -> None:
 
 @SequentialMergedBotWrapper(bot_manager.create_bot(handle="AutoGPT"))
 async def autogpt(bot: MergedBot, conv_sequence: ConversationSequence) -> None:
-    embeddings_model = OpenAIEmbeddings()
-    embedding_size = 1536
-    index = faiss.IndexFlatL2(embedding_size)
-    vectorstore = FAISS(embeddings_model.embed_query, index, InMemoryDocstore({}), {})
+    vectorstore = AdaptiveFAISS.empty(get_embedding_service())
 
     message = await conv_sequence.wait_for_incoming()
 
@@ -111,28 +109,45 @@ async def autogpt(bot: MergedBot, conv_sequence: ConversationSequence) -> None:
         await message.interim_bot_response(aiconfig_response.sender, aiconfig_response.content)
     )
 
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=SLOW_GPT_MODEL,
-        temperature=0.0,
-        model_kwargs={
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["mb_autogpt", secrets.token_hex(4)],
-    )
+    chat_llm = get_chat_llm(SLOW_GPT_MODEL, temperature=0.0)
 
     human_input_run = HumanInputRun(
         bot=bot,
         conv_sequence=conv_sequence,
         latest_inbound_msg=message,
     )
+
+    async def report_cache_hit(tool_name: str) -> None:
+        await human_input_run.send_feedback(f"`{tool_name}`: cached result")
+
+    # the file list is reused within the session and shared with other sessions (until the repo changes)
+    tool_results = ToolResultCache()
+    # the repo bots share one conversation and the results of their sub-bots (the repo dir, the file list) for the
+    # whole session, and the agent only needs their final responses
+    channel_id = str(uuid4())
+    bot_calls = BotCallCache()
     tools = [
-        MergedBotTool(
-            originator=bot,
-            target_bot=list_repo_tool.bot,
+        CachedTool(
+            MergedBotTool(
+                originator=bot,
+                target_bot=list_repo_tool.bot,
+                channel_id=channel_id,
+                bot_calls=bot_calls,
+                final_responses_only=True,
+            ),
+            tool_results,
+            repo_dir=REPO_DIR.as_posix(),
+            shared=True,
+            on_hit=report_cache_hit,
         ),
+        # not cached - which file a request is about is only known once the bot resolves it, so there would be no
+        # telling when a cached result went stale (the bot reuses the file list and the path resolution by itself)
         MergedBotTool(
             originator=bot,
             target_bot=read_file_bot.bot,
+            channel_id=channel_id,
+            bot_calls=bot_calls,
+            final_responses_only=True,
         ),
         human_input_run,
     ]
@@ -147,14 +162,27 @@ async def autogpt(bot: MergedBot, conv_sequence: ConversationSequence) -> None:
     )
     # autogpt_agent.chain.verbose = True
 
-    await autogpt_agent.arun([aiconfig_response.custom_fields["autogpt_goals"]])
+    await in_llm_request(
+        autogpt_agent.arun([aiconfig_response.custom_fields["autogpt_goals"]]),
+        user=str(message.originator.uuid),
+        pl_tags=["mb_autogpt", secrets.token_hex(4)],
+        priority=LLMPriority.AGENT_STEP,
+    )
 
 
 class MergedBotTool(BaseTool):
+    """
+    A tool that asks a bot on a virtual channel. The sub-bot calls the bot makes are memoized in `bot_calls` (per
+    channel) for as long as the tool lives. With `final_responses_only` the bot skips the interim messages that only
+    serve to show progress.
+    """
+
     channel_id: str = Field(default_factory=lambda: str(uuid4()))
     originator: MergedParticipant
     target_bot: MergedBot
     new_conversation_every_time: bool = False
+    bot_calls: BotCallCache = Field(default_factory=BotCallCache)
+    final_responses_only: bool = False
 
     def __init__(self, target_bot: MergedBot, **kwargs) -> None:
         super().__init__(target_bot=target_bot, name=target_bot.name, description=target_bot.description, **kwargs)
@@ -176,5 +204,6 @@ class MergedBotTool(BaseTool):
             content=query,
             new_conversation=self.new_conversation_every_time,
         )
-        response = await self.target_bot.get_final_response(originator_message)
+        with bot_call_session(self.bot_calls, self.channel_id, final_responses_only=self.final_responses_only):
+            response = await self.target_bot.get_final_response(originator_message)
         return response.content
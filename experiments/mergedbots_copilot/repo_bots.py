@@ -1,14 +1,26 @@
+import re
+import time
 from pathlib import Path
 from typing import AsyncGenerator
 
 from langchain import LLMChain
-from langchain.chat_models import PromptLayerChatOpenAI
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
 from mergedbots import MergedBot, MergedMessage
 from mergedbots.ext.discord_integration import DISCORD_MSG_LIMIT
 
+from experiments.common.bot_calls import final_responses_only, in_bot_call_session, memoized_final_response
 from experiments.common.bot_manager import bot_manager, FAST_GPT_MODEL
-from experiments.common.repo_access_utils import list_files_in_repo
+from experiments.common.executors import disk_io_executor
+from experiments.common.file_resolver import file_resolution_stats, get_file_path_resolver
+from experiments.common.llm_cache import CachePolicy
+from experiments.common.llm_clients import get_chat_llm, in_llm_request
+from experiments.common.repo_access_utils import alist_files_in_repo, read_file_chunk
+from experiments.common.repo_index import get_repo_index
+
+REPO_DIR = (Path(__file__).parents[3] / "mergedbots").resolve()
+READ_FILE_CHUNK_SIZE = DISCORD_MSG_LIMIT - 10
+READ_FILE_PAGE_CHUNKS = 5
+OFFSET_REGEX = re.compile(r"\boffset\W*(\d+)", re.IGNORECASE)
 
 # `gpt-3.5-turbo` (unlike `gpt-4`) might pay more attention to `user` messages than it would to `system` messages
 EXTRACT_FILE_PATH_PROMPT = ChatPromptTemplate.from_messages(
@@ -44,24 +56,28 @@ YOUR RESPONSE:
 
 @bot_manager.create_bot(handle="RepoPathBot")
 async def repo_path_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
-    feedback = await (await bot.manager.find_bot("FeedbackBot")).get_final_response(
-        await message.final_bot_response(bot, "hey, say something!")
-    )
-    yield feedback
-    repo_dir = (Path(__file__).parents[3] / "mergedbots").resolve().as_posix()
-    yield await message.final_bot_response(bot, repo_dir)
+    if not final_responses_only():
+        feedback = await (await bot.manager.find_bot("FeedbackBot")).get_final_response(
+            await message.final_bot_response(bot, "hey, say something!")
+        )
+        yield feedback
+    yield await message.final_bot_response(bot, REPO_DIR.as_posix())
 
 
 @bot_manager.create_bot(handle="ListRepoTool", description="Lists all the files in a repo.")
 async def list_repo_tool(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
-    repo_dir_msg = None
-    async for result in repo_path_bot.bot.fulfill(message):
-        repo_dir_msg = result
-        yield result
+    if in_bot_call_session():
+        # the repo dir does not depend on the request
+        repo_dir_msg = await memoized_final_response(repo_path_bot.bot, message, key="")
+    else:
+        repo_dir_msg = None
+        async for result in repo_path_bot.bot.fulfill(message):
+            repo_dir_msg = result
+            yield result
 
     repo_dir = Path(repo_dir_msg.content)
 
-    file_list = list_files_in_repo(repo_dir)
+    file_list = await alist_files_in_repo(repo_dir)
     file_list_strings = [file.as_posix() for file in file_list]
     file_list_string = "\n".join(file_list_strings)
 
@@ -71,42 +87,114 @@ async def list_repo_tool(bot: MergedBot, message: MergedMessage) -> AsyncGenerat
         f"{file_list_string}\n"
         f"```"
     )
-    yield await message.final_bot_response(bot, result, custom_fields={"file_list": file_list_strings})
+    yield await message.final_bot_response(
+        bot,
+        result,
+        custom_fields={
+            "file_list": file_list_strings,
+            "repo_dir": repo_dir.as_posix(),
+            "index_version": get_repo_index(repo_dir).version,
+        },
+    )
+
+
+def _is_file_list_current(file_list_msg: MergedMessage) -> bool:
+    return (
+        get_repo_index(file_list_msg.custom_fields["repo_dir"]).version == file_list_msg.custom_fields["index_version"]
+    )
 
 
 @bot_manager.create_bot(handle="ReadFileBot", description="Reads a file from the repo.")
 async def read_file_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
-    file_list_msg = await list_repo_tool.bot.get_final_response(message)
-    file_set = set(file_list_msg.custom_fields["file_list"])
-
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=FAST_GPT_MODEL,
-        temperature=0.0,
-        model_kwargs={
-            "stop": ['"', "\n"],
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["read_file_bot"],
-    )
-    llm_chain = LLMChain(
-        llm=chat_llm,
-        prompt=EXTRACT_FILE_PATH_PROMPT,
+    # the file list does not depend on the request, only on the state of the repo (the index of the repo the list is
+    # of is refreshed, so that a memoized file list is only reused while the repo stays the same)
+    file_list_msg = await memoized_final_response(list_repo_tool.bot, message, key="", is_valid=_is_file_list_current)
+    await disk_io_executor.run(get_repo_index(file_list_msg.custom_fields["repo_dir"]).refresh)
+    if not _is_file_list_current(file_list_msg):
+        file_list_msg = await memoized_final_response(
+            list_repo_tool.bot, message, key="", is_valid=_is_file_list_current
+        )
+    resolver = get_file_path_resolver(
+        file_list_msg.custom_fields["repo_dir"],
+        file_list_msg.custom_fields["index_version"],
+        file_list_msg.custom_fields["file_list"],
     )
-    file_path = await llm_chain.arun(request=message.content, file_list=file_list_msg.content)
-
-    if file_path and file_path in file_set:
-        yield await message.interim_bot_response(bot, file_path)
 
+    # try to find the file deterministically first - the LLM is only asked when the request is ambiguous
+    resolver_start_time = time.perf_counter()
+    file_path, candidates = resolver.resolve(message.content)
+    resolver_seconds = time.perf_counter() - resolver_start_time
+    if file_path:
+        file_resolution_stats.record_hit(resolver_seconds)
+        resolved_by = "resolver"
+    else:
+        llm_chain = LLMChain(
+            llm=get_chat_llm(FAST_GPT_MODEL, temperature=0.0, stop=['"', "\n"]),
+            prompt=EXTRACT_FILE_PATH_PROMPT,
+        )
+        # if the resolver narrowed the choice down to a few candidates, there is no need to send the whole list
+        file_list = "\n".join(candidates) if candidates else file_list_msg.content
+        llm_start_time = time.perf_counter()
+        file_path = await in_llm_request(
+            llm_chain.arun(request=message.content, file_list=file_list),
+            user=str(message.originator.uuid),
+            pl_tags=["read_file_bot"],
+            # the same request against the same file list gets the same answer until the repo changes
+            cache=CachePolicy(
+                "read_file_bot",
+                scope=f"repo:{file_list_msg.custom_fields['repo_dir']}",
+                scope_version=file_list_msg.custom_fields["index_version"],
+            ),
+        )
+        file_resolution_stats.record_llm_fallback(resolver_seconds, time.perf_counter() - llm_start_time)
+        resolved_by = "llm"
+
+    if file_path and file_path in resolver.file_set:
+        # the interim messages only show progress - the final one carries the content (along with where in the file
+        # it is) and has the path and the content in its custom fields as well
+        show_progress = not final_responses_only()
+        if show_progress:
+            yield await message.interim_bot_response(bot, file_path)
+
+        # stream a page of the file in chunks that fit into Discord messages instead of reading the whole file
+        offset = int(offset_match.group(1)) if (offset_match := OFFSET_REGEX.search(message.content)) else 0
+        page_start = offset
+        full_path = Path(file_list_msg.custom_fields["repo_dir"], file_path)
+        page_chunks = []
+        chunk = None
+        for _ in range(READ_FILE_PAGE_CHUNKS):
+            chunk = await disk_io_executor.run(
+                read_file_chunk, full_path, offset, max_bytes=READ_FILE_CHUNK_SIZE, whole_lines=True
+            )
+            page_chunks.append(chunk.content)
+            if chunk.content and show_progress:
+                yield await message.interim_bot_response(bot, chunk.content)
+            if chunk.next_offset is None:
+                break
+            offset = chunk.next_offset
+
+        page_end = chunk.file_size if chunk.next_offset is None else chunk.next_offset
+        cursor_note = f"`{file_path}`: bytes {page_start}-{page_end} of {chunk.file_size}"
+        if chunk.next_offset is not None:
+            cursor_note += f", ask for `{file_path}` with offset {chunk.next_offset} to continue"
+        content = "".join(page_chunks)
         yield await message.final_bot_response(
             bot,
-            Path(REPO_DIR, file_path).read_text(encoding="utf-8"),
-            custom_fields={"success": True},
+            f"{content}\n{cursor_note}",
+            custom_fields={
+                "success": True,
+                "resolved_by": resolved_by,
+                "file_path": file_path,
+                "content": content,
+                "next_offset": chunk.next_offset,
+                "file_size": chunk.file_size,
+            },
         )
     else:
         yield await message.final_bot_response(
             bot,
             f"{file_list_msg.content}\n" f"Please specify the file you want to read.",
-            custom_fields={"success": False},
+            custom_fields={"success": False, "resolved_by": resolved_by},
         )
 
 
@@ -114,28 +202,18 @@ async def read_file_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerato
 async def edit_file_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[MergedMessage, None]:
     read_file_responses = await read_file_bot.bot.list_responses(message)
 
-    file_path_msg = None
-    file_content_msg = None
-    if read_file_responses[-1].custom_fields.get("success"):
-        file_path_msg = read_file_responses[-2]
-        file_content_msg = read_file_responses[-1]
-
-    if file_content_msg:
-        yield file_path_msg
-        yield await message.final_bot_response(bot, f"```\n{file_content_msg.content[:DISCORD_MSG_LIMIT - 10]}\n```")
+    read_file_msg = read_file_responses[-1]
+    if read_file_msg.custom_fields.get("success"):
+        # (whether the interim messages were yielded or not, the final one has both the path and the content)
+        yield await message.interim_bot_response(bot, read_file_msg.custom_fields["file_path"])
+        content = read_file_msg.custom_fields["content"]
+        yield await message.final_bot_response(bot, f"```\n{content[:DISCORD_MSG_LIMIT - 10]}\n```")
     else:
-        yield read_file_responses[-1]
-
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=FAST_GPT_MODEL,
-        temperature=0.0,
-        model_kwargs={
-            "stop": ['"', "\n"],
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["edit_file_bot"],
-    )
+        yield read_file_msg
+
+    chat_llm = get_chat_llm(FAST_GPT_MODEL, temperature=0.0, stop=['"', "\n"])
     # llm_chain = LLMChain(
     #     llm=chat_llm,
     #     prompt=...,
     # )
+    # await in_llm_request(llm_chain.arun(...), user=str(message.originator.uuid), pl_tags=["edit_file_bot"])
@@ -1,12 +1,20 @@
 """A bot that uses either GPT-4 or ChatGPT to generate responses without any hidden prompts."""
 from typing import AsyncGenerator
 
-from langchain.chat_models import PromptLayerChatOpenAI
 from langchain.schema import ChatMessage
 from mergedbots import MergedMessage, MergedBot
 from mergedbots.ext.langchain_integration import LangChainParagraphStreamingCallback
 
 from experiments.common.bot_manager import SLOW_GPT_MODEL, bot_manager
+from experiments.common.history import PLAIN_GPT_HISTORY_TOKEN_BUDGET
+from experiments.common.llm_clients import get_chat_llm, in_llm_request
+from experiments.common.transcripts import TranscriptFormat, transcript_cache
+
+CHAT_MESSAGE_FORMAT = TranscriptFormat(
+    "plain_gpt_chat_message",
+    lambda msg: ChatMessage(role="user" if msg.is_sent_by_originator else "assistant", content=msg.content),
+    lambda chat_message: chat_message.content,
+)
 
 
 @bot_manager.create_bot(
@@ -27,26 +35,19 @@ async def plain_gpt(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[Me
 
     print()
     paragraph_streaming = LangChainParagraphStreamingCallback(bot, message, verbose=True)
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=model_name,
-        temperature=0.0,
-        streaming=True,
-        callbacks=[paragraph_streaming],
-        model_kwargs={"user": str(message.originator.uuid)},
-        pl_tags=["mb_plain_gpt"],
-    )
-    conversation = await message.get_full_conversion()
+    chat_llm = get_chat_llm(model_name, temperature=0.0, streaming=True)
+    transcript = await transcript_cache.aget(message)
+    start = transcript.window_start(CHAT_MESSAGE_FORMAT, PLAIN_GPT_HISTORY_TOKEN_BUDGET)
+    chat_messages = transcript.formatted(CHAT_MESSAGE_FORMAT, start)
+    if start:
+        chat_messages.insert(
+            0, ChatMessage(role="system", content=f"({start} earlier messages of this conversation are omitted)")
+        )
     async for msg in paragraph_streaming.stream_from_coroutine(
-        chat_llm.agenerate(
-            [
-                [
-                    ChatMessage(
-                        role="user" if msg.is_sent_by_originator else "assistant",
-                        content=msg.content,
-                    )
-                    for msg in conversation
-                ]
-            ],
+        in_llm_request(
+            chat_llm.agenerate([chat_messages], callbacks=[paragraph_streaming]),
+            user=str(message.originator.uuid),
+            pl_tags=["mb_plain_gpt"],
         )
     ):
         yield msg
@@ -1,14 +1,18 @@
 """A bot that routes messages to other bots based on the user's intent."""
 import json
+import time
 from typing import AsyncGenerator
 
 from langchain import LLMChain
-from langchain.chat_models import PromptLayerChatOpenAI
 from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from mergedbots import MergedMessage, MergedBot
 
 from experiments.active_listener import active_listener
 from experiments.common.bot_manager import FAST_GPT_MODEL, bot_manager
+from experiments.common.lexical_router import LexicalRouter
+from experiments.common.llm_cache import CachePolicy
+from experiments.common.llm_clients import get_chat_llm, in_llm_request
+from experiments.common.transcripts import TranscriptFormat, transcript_cache
 from experiments.plain_gpt import plain_gpt
 
 ROUTER_PROMPT = ChatPromptTemplate.from_messages(
@@ -27,6 +31,25 @@ BOT NAME: \""""
         ),
     ]
 )
+CONVERSATION_FORMAT = TranscriptFormat(
+    "router_conversation", lambda msg: f"{'USER' if msg.is_sent_by_originator else 'ASSISTANT'}: {msg.content}"
+)
+
+local_router = LexicalRouter()
+for _routable_bot in (plain_gpt.bot, active_listener.bot):
+    local_router.add_route(_routable_bot.handle, _routable_bot.description)
+
+
+def get_conversation_key(message: MergedMessage) -> str:
+    """
+    The key of the conversation a message belongs to (the routing sticks to a bot per conversation, and the same user
+    may have several conversations going on at the same time).
+    """
+    channel_id = getattr(message, "channel_id", None)
+    if channel_id is None:
+        # only the messages that start a request carry the channel they came from
+        return str(message.originator.uuid)
+    return f"{getattr(message, 'channel_type', '')}:{channel_id}"
 
 
 @bot_manager.create_bot(handle="RouterBot")
@@ -36,34 +59,40 @@ async def router_bot(bot: MergedBot, message: MergedMessage) -> AsyncGenerator[M
         yield await message.service_followup_as_final_response(bot, "```\nCONVERSATION RESTARTED\n```")
         return
 
-    chat_llm = PromptLayerChatOpenAI(
-        model_name=FAST_GPT_MODEL,
-        temperature=0.0,
-        max_tokens=10,
-        model_kwargs={
-            "stop": ['"', "\n"],
-            "user": str(message.originator.uuid),
-        },
-        pl_tags=["mb_router"],
-    )
-    llm_chain = LLMChain(
-        llm=chat_llm,
-        prompt=ROUTER_PROMPT,
-    )
+    started_at = time.monotonic()
+    conversation_key = get_conversation_key(message)
+    decision = local_router.route(conversation_key, message.content)
+    chosen_bot_handle = decision.bot_handle
 
-    bots_json = [
-        {"name": other_bot.handle, "description": other_bot.description}
-        for other_bot in (plain_gpt.bot, active_listener.bot)
-    ]
-    conversation = await message.get_full_conversion()
-    formatted_conv_parts = [
-        f"{'USER' if msg.is_sent_by_originator else 'ASSISTANT'}: {msg.content}" for msg in conversation
-    ]
+    if chosen_bot_handle is None:
+        llm_chain = LLMChain(
+            llm=get_chat_llm(FAST_GPT_MODEL, temperature=0.0, stop=['"', "\n"], max_tokens=10),
+            prompt=ROUTER_PROMPT,
+        )
+
+        bots_json = [
+            {"name": other_bot.handle, "description": other_bot.description}
+            for other_bot in (plain_gpt.bot, active_listener.bot)
+        ]
+        formatted_conv_parts = (await transcript_cache.aget(message)).formatted(CONVERSATION_FORMAT)
+
+        # choose a bot
+        chosen_bot_handle = await in_llm_request(
+            llm_chain.arun(conversation="\n\n".join(formatted_conv_parts), bots=json.dumps(bots_json)),
+            user=str(message.originator.uuid),
+            pl_tags=["mb_router"],
+            cache=CachePolicy("mb_router"),
+        )
+        # the local router learns from the decisions of the LLM
+        local_router.learn(chosen_bot_handle, message.content)
 
-    # choose a bot and run it
-    chosen_bot_handle = await llm_chain.arun(
-        conversation="\n\n".join(formatted_conv_parts), bots=json.dumps(bots_json)
+    if decision.tier != "sticky":
+        local_router.remember(conversation_key, chosen_bot_handle)
+    local_router.stats.record(decision.tier, time.monotonic() - started_at)
+    print(
+        f"ROUTING TO: {chosen_bot_handle} ({decision.tier}, confidence {decision.confidence:.2f}, "
+        f"LLM call rate {local_router.stats.llm_call_rate:.0%})"
     )
-    print(f"ROUTING TO: {chosen_bot_handle}")
+    # run the chosen bot
     async for msg in bot.manager.fulfill(chosen_bot_handle, message, fallback_bot_handle=plain_gpt.bot.handle):
         yield msg